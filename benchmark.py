@@ -0,0 +1,359 @@
+"""
+학습 없이 input pipeline (listing -> decode -> transform -> collate -> DataLoader) 속도만 재는 benchmark.
+
+`ID_gender_race_age/{mask1..5,incorrect_mask,normal}.jpg` 구조의 synthetic data 를 만들고 (이미 같은 설정으로
+만들어져 있으면 재사용), dataset.py / rembg_dataset.py 의 dataset class x augmentation class x num_workers 별로
+단계별 latency 와 images/sec 를 JSON 으로 저장합니다. commit 마다 결과 파일을 비교해서 regression 을 찾습니다.
+shuffle=True 와 sampler.BlockShuffleSampler 의 파일 read 속도 / locality / randomness 도 함께 비교합니다.
+
+    python benchmark.py --num_profiles 300 --num_workers 0 2 4 --output bench_$(git rev-parse --short HEAD).json
+"""
+import argparse
+import inspect
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import time
+from importlib import import_module
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, RandomSampler
+from torch.utils.data.dataloader import default_collate
+
+from dataset import MaskBaseDataset, compact_collate, create_dataloader, load_profile_index, profile_index_path
+from sampler import BlockShuffleSampler
+
+SYNTHETIC_FILE_NAMES = ("mask1", "mask2", "mask3", "mask4", "mask5", "incorrect_mask", "normal")
+DATASET_MODULES = ("dataset", "rembg_dataset")
+
+
+def _write_profile(args):
+    profile_dir, image_size, seed = args
+    rng = np.random.default_rng(seed)
+    os.makedirs(profile_dir, exist_ok=True)
+    for stem in SYNTHETIC_FILE_NAMES:
+        # 저해상도 random 색을 키우고 noise 를 더해서 실제 사진과 비슷한 크기 (수십 KB) 의 JPEG 을 만듭니다
+        base = Image.fromarray(rng.integers(0, 256, (12, 9, 3), dtype=np.uint8)).resize(
+            (image_size[1], image_size[0]), Image.BICUBIC)
+        pixels = np.asarray(base, dtype=np.int16) + rng.integers(-8, 9, (image_size[0], image_size[1], 3))
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(
+            os.path.join(profile_dir, f"{stem}.jpg"), "JPEG", quality=90)
+
+
+def make_synthetic_tree(out_dir, num_profiles, image_size=(512, 384), seed=42, num_workers=None):
+    """
+    out_dir/images 아래에 num_profiles 개의 profile 폴더를 만들고 data_dir 경로를 돌려줍니다.
+    out_dir/synthetic.json 에 저장된 설정이 같으면 다시 만들지 않습니다.
+    synthetic.json 이 있는 (이 함수가 만든) tree 만 지우고 다시 만들며, synthetic.json 없이
+    out_dir/images 에 이미 파일이 있으면 실제 data 일 수 있으므로 건드리지 않고 RuntimeError 를 냅니다.
+    """
+    data_dir = os.path.join(out_dir, "images")
+    config = {"num_profiles": num_profiles, "image_size": list(image_size), "seed": seed}
+    config_path = os.path.join(out_dir, "synthetic.json")
+    try:
+        with open(config_path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = None
+    if saved == config:
+        return data_dir
+    if saved is None and os.path.isdir(data_dir) and os.listdir(data_dir):
+        raise RuntimeError(
+            f"{data_dir} is not empty and has no {config_path}, refusing to overwrite it "
+            f"(use an empty --out_dir for the synthetic tree)")
+
+    rng = random.Random(seed)
+    jobs = []
+    for idx in range(num_profiles):
+        profile = f"{idx:06d}_{rng.choice(('male', 'female'))}_Asian_{rng.randint(18, 60)}"
+        jobs.append((os.path.join(data_dir, profile), tuple(image_size), seed * 1000003 + idx))
+
+    print(f"Generating {num_profiles} synthetic profiles into {data_dir}")
+    os.makedirs(out_dir, exist_ok=True)
+    # 만드는 도중에 중단되어도 다음 실행에서 이 함수가 만든 tree 로 알아보고 지울 수 있도록 먼저 표시해둡니다
+    with open(config_path, "w") as f:
+        json.dump({**config, "complete": False}, f)
+    if os.path.isdir(data_dir):
+        for name in os.listdir(data_dir):  # 설정이 바뀌었으면 이전 profile 을 지우고 다시 만듭니다
+            profile_dir = os.path.join(data_dir, name)
+            for file_name in os.listdir(profile_dir):
+                os.remove(os.path.join(profile_dir, file_name))
+            os.rmdir(profile_dir)
+    with multiprocessing.Pool(num_workers or multiprocessing.cpu_count()) as pool:
+        for _ in pool.imap_unordered(_write_profile, jobs, chunksize=16):
+            pass
+
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+    return data_dir
+
+
+def make_stub_masks(data_dir, mask_dir):
+    """rembg_dataset 의 class 들이 읽을 alpha mask 와 index.json 을 rembg 없이 (stub backend) 만듭니다."""
+    import rembg_gen
+    rembg_gen.segment_images(rembg_gen.list_images(data_dir), mask_dir, "stub", num_workers=0)
+
+
+def dataset_classes(module_name):
+    module = import_module(module_name)
+    return [
+        name for name, obj in vars(module).items()
+        if inspect.isclass(obj) and issubclass(obj, Dataset) and obj.__module__ == module_name
+        and hasattr(obj, "multi_class_labels")
+    ]
+
+
+def augmentation_classes(module_name):
+    module = import_module(module_name)
+    return [
+        name for name, obj in vars(module).items()
+        if inspect.isclass(obj) and "Augmentation" in name and obj.__module__ == module_name
+        and not issubclass(obj, torch.nn.Module)
+    ]
+
+
+def _mean_ms(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - start) / max(len(items), 1) * 1000
+
+
+def time_listing(data_dir):
+    """profile index 를 처음부터 scan (cold) / 저장된 index 재사용 (warm) 하는 시간 (초)"""
+    index_path = profile_index_path(data_dir)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    start = time.perf_counter()
+    load_profile_index(data_dir)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    load_profile_index(data_dir)
+    return {"cold_s": cold, "warm_s": time.perf_counter() - start}
+
+
+def time_stages(dataset, transform, num_samples, batch_size, seed):
+    """sample 당 decode / transform 과 batch 당 collate / batch_transform 평균 시간 (ms)"""
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(dataset), min(num_samples, len(dataset)), replace=False).tolist()
+
+    images = []
+
+    def decode(index):
+        image = dataset.read_image(index)
+        if hasattr(image, "load"):  # PIL 은 lazy 하므로 실제 decode 까지 측정
+            image.load()
+        images.append(image)
+
+    stages = {"decode": _mean_ms(decode, indices)}
+    stages["transform"] = _mean_ms(transform, images)
+
+    batch = [dataset[index] for index in indices[:batch_size]]
+    stages["collate"] = _mean_ms(lambda _: default_collate(batch), range(10))
+    stages["compact_collate"] = _mean_ms(lambda _: compact_collate(batch), range(10))
+
+    batch_transform = getattr(transform, "batch_transform", None)
+    if batch_transform is not None:
+        inputs = default_collate(batch)[0]
+        with torch.no_grad():
+            stages["batch_transform"] = _mean_ms(lambda _: batch_transform(inputs), range(10))
+    return stages
+
+
+def time_loader(dataset, batch_size, num_workers, num_batches, seed):
+    """DataLoader 의 첫 batch 까지 걸린 시간 (worker 시작 포함) 과 이후 images/sec"""
+    loader = create_dataloader(
+        dataset,
+        batch_size,
+        num_workers,
+        shuffle=True,
+        generator=torch.Generator().manual_seed(seed),
+    )
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator)
+    startup = time.perf_counter() - start
+
+    num_images = 0
+    start = time.perf_counter()
+    for idx, (inputs, _) in enumerate(iterator):
+        num_images += len(inputs)
+        if idx + 1 >= num_batches:
+            break
+    elapsed = time.perf_counter() - start
+    del iterator
+    return {
+        "num_workers": num_workers,
+        "startup_s": startup,
+        "images_per_sec": num_images / elapsed if elapsed > 0 else None,
+    }
+
+
+def evict_page_cache(paths):
+    """파일의 page cache 를 비워서 (POSIX_FADV_DONTNEED) 다음 read 가 실제 storage 에서 읽히게 합니다."""
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fdatasync(fd)  # 방금 만든 파일처럼 dirty page 가 남아 있으면 DONTNEED 로 비워지지 않습니다
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _entropy(labels):
+    p = np.bincount(labels) / len(labels)
+    p = p[p > 0]
+    return float(-(p * np.log2(p)).sum())
+
+
+def time_sampler(dataset, sampler, num_samples, batch_size):
+    """
+    sampler 순서대로 파일을 읽는 속도 (page cache 를 비운 뒤) 와 순서의 locality / randomness.
+        dir_switches_per_1k : 1000 번 읽는 동안 다른 폴더로 넘어간 횟수 (작을수록 순차 read)
+        dirs_per_1k         : 연속한 1000 번의 read 가 건드리는 서로 다른 폴더 수 (작을수록 좁은 working set)
+        profiles_per_batch  : batch 안의 서로 다른 사람 수 (클수록 잘 섞임)
+        label_entropy       : batch 안 18 class label 의 평균 entropy (bits)
+    """
+    order = np.fromiter(iter(sampler), dtype=np.int64, count=len(sampler))[:num_samples]
+    paths = [dataset.image_paths[int(index)] for index in order]
+    evict_page_cache(set(paths))
+
+    start = time.perf_counter()
+    num_bytes = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            num_bytes += len(f.read())
+    elapsed = time.perf_counter() - start
+
+    profiles = dataset.profile_idx[order]
+    labels = dataset.multi_class_labels()[order]
+    batches = range(0, len(order) - batch_size + 1, batch_size)
+    return {
+        "files_per_sec": len(paths) / elapsed if elapsed > 0 else None,
+        "mb_per_sec": num_bytes / 2 ** 20 / elapsed if elapsed > 0 else None,
+        "dir_switches_per_1k": float((np.diff(profiles) != 0).mean() * 1000) if len(profiles) > 1 else 0.,
+        "dirs_per_1k": float(np.mean([len(np.unique(profiles[i:i + 1000])) for i in range(0, len(profiles), 1000)])),
+        "profiles_per_batch": float(np.mean([len(np.unique(profiles[i:i + batch_size])) for i in batches])),
+        "label_entropy": float(np.mean([_entropy(labels[i:i + batch_size]) for i in batches])),
+    }
+
+
+def compare_samplers(data_dir, args):
+    """DataLoader(shuffle=True) 의 RandomSampler 와 profile 폴더 단위 BlockShuffleSampler 비교"""
+    dataset = MaskBaseDataset(data_dir=data_dir)
+    samplers = {"shuffle": RandomSampler(dataset, generator=torch.Generator().manual_seed(args.seed))}
+    for group in args.sampler_groups:
+        samplers[f"block_{group}"] = BlockShuffleSampler(
+            dataset.profile_idx, group=group, generator=torch.Generator().manual_seed(args.seed))
+
+    results = {}
+    for name, sampler in samplers.items():
+        results[name] = time_sampler(dataset, sampler, args.sampler_samples, args.batch_size)
+        print(f"{name}: {results[name]}")
+    return results
+
+
+def run_case(module_name, dataset_name, augmentation_name, data_dir, mask_dir, args):
+    dataset_module = getattr(import_module(module_name), dataset_name)
+    kwargs = {"mask_dir": mask_dir} if module_name == "rembg_dataset" else {}
+    dataset = dataset_module(data_dir=data_dir, **kwargs)
+
+    transform_module = getattr(import_module(module_name), augmentation_name)
+    transform = transform_module(resize=args.resize, mean=dataset.mean, std=dataset.std)
+    dataset.set_transform(transform)
+
+    result = {
+        "dataset": f"{module_name}.{dataset_name}",
+        "augmentation": f"{module_name}.{augmentation_name}",
+        "num_images": len(dataset),
+        "stages_ms": time_stages(dataset, transform, args.num_samples, args.batch_size, args.seed),
+        "loader": [],
+    }
+    for num_workers in args.num_workers:
+        result["loader"].append(time_loader(dataset, args.batch_size, num_workers, args.num_batches, args.seed))
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    data_dir = make_synthetic_tree(args.out_dir, args.num_profiles, args.image_size, args.seed)
+    mask_dir = os.path.join(args.out_dir, "rembg_masks")
+
+    report = {
+        "revision": git_revision(),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": multiprocessing.cpu_count(),
+        },
+        "args": vars(args),
+        "listing": time_listing(data_dir),
+        "samplers": compare_samplers(data_dir, args),
+        "results": [],
+    }
+
+    for module_name in DATASET_MODULES:
+        if module_name == "rembg_dataset":
+            make_stub_masks(data_dir, mask_dir)
+        datasets = [name for name in dataset_classes(module_name) if not args.datasets or name in args.datasets]
+        augmentations = [
+            name for name in augmentation_classes(module_name) if not args.augmentations or name in args.augmentations]
+        for dataset_name in datasets:
+            for augmentation_name in augmentations:
+                print(f"{module_name}.{dataset_name} + {augmentation_name}")
+                try:
+                    result = run_case(module_name, dataset_name, augmentation_name, data_dir, mask_dir, args)
+                except Exception as e:  # 한 조합이 실패해도 나머지는 계속 잽니다
+                    print(f"[Warning] failed: {e}")
+                    result = {
+                        "dataset": f"{module_name}.{dataset_name}",
+                        "augmentation": f"{module_name}.{augmentation_name}",
+                        "error": repr(e),
+                    }
+                report["results"].append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark Done! results saved in {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--num_profiles', type=int, default=300, help='number of synthetic profiles, 7 images each (default: 300)')
+    parser.add_argument('--image_size', nargs=2, type=int, default=[512, 384], help='synthetic image size H W (default: 512 384)')
+    parser.add_argument('--datasets', nargs='*', default=None, help='dataset class names to measure (default: every class)')
+    parser.add_argument('--augmentations', nargs='*', default=None, help='augmentation class names to measure (default: every class)')
+    parser.add_argument('--num_workers', nargs='+', type=int, default=[0, 2, 4], help='DataLoader num_workers to measure (default: 0 2 4)')
+    parser.add_argument("--resize", nargs="+", type=int, default=[128, 96], help='resize size for image when training')
+    parser.add_argument('--batch_size', type=int, default=64, help='input batch size (default: 64)')
+    parser.add_argument('--num_samples', type=int, default=256, help='number of images timed per stage (default: 256)')
+    parser.add_argument('--num_batches', type=int, default=20, help='number of batches timed per DataLoader (default: 20)')
+    parser.add_argument('--sampler_groups', nargs='*', type=int, default=[1, 2, 4], help='BlockShuffleSampler groups (profiles shuffled together) compared with shuffle=True (default: 1 2 4)')
+    parser.add_argument('--sampler_samples', type=int, default=4096, help='number of files read per sampler (default: 4096)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+
+    parser.add_argument('--out_dir', type=str, default='/tmp/mask_benchmark', help='where the synthetic tree and masks are kept (default: /tmp/mask_benchmark)')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='JSON result file (default: benchmark.json)')
+
+    args = parser.parse_args()
+    print(args)
+
+    run(args)
@@ -0,0 +1,153 @@
+"""
+model.py 의 class 별로 eager 실행과 --execution compile / torchscript 의 속도를 비교하는 benchmark.
+
+class 마다 같은 weight 의 model 을 mode 별로 복사해서 warm-up (compile) 시간과
+inference forward / 학습 step (forward + backward + SGD step) 의 평균 latency 를 재고,
+eager 대비 speedup 을 JSON 으로 저장합니다. compile 에 실패해서 eager 로 fallback 된 mode 는 "fallback": true 입니다.
+
+    python benchmark_model.py --models BaseModel ResNet50 --batch_size 64 --output model_bench_$(git rev-parse --short HEAD).json
+    python benchmark_model.py --models ResNet50 --memory_format channels_last --output model_bench_channels_last.json
+"""
+import argparse
+import copy
+import inspect
+import json
+import multiprocessing
+import platform
+import time
+from importlib import import_module
+
+import torch
+
+from benchmark import git_revision
+from execution import EXECUTION_MODES, MEMORY_FORMATS, TRAIN_EXECUTION_MODES, compile_model
+from precision import AMP_MODES, autocast, resolve_amp
+
+
+def model_classes():
+    module = import_module("model")
+    return [
+        name for name, obj in vars(module).items()
+        if inspect.isclass(obj) and issubclass(obj, torch.nn.Module) and obj.__module__ == "model"
+    ]
+
+
+def _mean_ms(fn, num_iters, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / num_iters * 1000
+
+
+def time_inference(model, inputs, amp, num_iters):
+    if hasattr(model, "training"):  # freeze 된 TorchScript module 은 이미 eval 전용
+        model.eval()
+
+    @torch.no_grad()
+    def step():
+        with autocast(inputs.device, amp):
+            model(inputs)
+    return _mean_ms(step, num_iters, inputs.device)
+
+
+def time_train_step(model, inputs, amp, num_iters):
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+
+    def step():
+        with autocast(inputs.device, amp):
+            outs = model(inputs)
+        outs.float().mean().backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    return _mean_ms(step, num_iters, inputs.device)
+
+
+def run_model(model_name, device, args):
+    """model_name 하나에 대해 args.executions 의 mode 별 warm-up / inference / train step 시간과 eager 대비 speedup"""
+    torch.manual_seed(args.seed)
+    model_module = getattr(import_module("model"), model_name)
+    memory_format = MEMORY_FORMATS[args.memory_format]
+    eager = model_module(num_classes=args.num_classes).to(device, memory_format=memory_format)
+    inputs = torch.randn(args.batch_size, 3, *args.resize, device=device).contiguous(memory_format=memory_format)
+    amp = resolve_amp(args.amp, device)
+
+    modes = {}
+    for execution in args.executions:
+        model = copy.deepcopy(eager)  # 모든 mode 가 같은 weight 에서 시작
+        train = execution in TRAIN_EXECUTION_MODES
+        start = time.perf_counter()
+        compiled = compile_model(model, execution, inputs, amp, train=train)
+        result = {
+            "warm_up_s": time.perf_counter() - start,
+            "fallback": execution != "eager" and compiled is model,
+            "inference_ms": time_inference(compiled, inputs, amp, args.num_iters),
+        }
+        if train:
+            result["train_step_ms"] = time_train_step(compiled, inputs, amp, args.num_iters)
+        modes[execution] = result
+        print(f"{model_name} [{execution}]: {result}")
+    torch._dynamo.reset()
+
+    baseline = modes["eager"]
+    for execution, result in modes.items():
+        result["inference_speedup"] = baseline["inference_ms"] / result["inference_ms"]
+        if "train_step_ms" in result:
+            result["train_step_speedup"] = baseline["train_step_ms"] / result["train_step_ms"]
+    return {"model": model_name, "modes": modes}
+
+
+def run(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # speedup 의 기준이 되는 eager 는 항상 먼저 잽니다
+    args.executions = ["eager"] + [execution for execution in args.executions if execution != "eager"]
+    report = {
+        "revision": git_revision(),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": multiprocessing.cpu_count(),
+            "device": torch.cuda.get_device_name(device) if device.type == "cuda" else "cpu",
+        },
+        "args": vars(args),
+        "results": [],
+    }
+
+    for model_name in args.models or model_classes():
+        print(model_name)
+        try:
+            result = run_model(model_name, device, args)
+        except Exception as e:  # pretrained weight download 실패 등, 한 model 이 실패해도 나머지는 계속 잽니다
+            print(f"[Warning] failed: {e}")
+            result = {"model": model_name, "error": repr(e)}
+        report["results"].append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark Done! results saved in {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--models', nargs='*', default=None, help='model.py class names to measure (default: every class)')
+    parser.add_argument('--executions', nargs='+', default=list(EXECUTION_MODES), choices=EXECUTION_MODES, help='execution modes compared with eager (default: eager compile torchscript)')
+    parser.add_argument('--amp', type=str, default='off', choices=AMP_MODES, help='mixed precision: off, bf16 or fp16 (default: off)')
+    parser.add_argument('--memory_format', type=str, default='contiguous', choices=list(MEMORY_FORMATS), help='model / input layout, run once per layout to compare (default: contiguous)')
+    parser.add_argument("--resize", nargs="+", type=int, default=[128, 96], help='resize size for image when training')
+    parser.add_argument('--batch_size', type=int, default=64, help='input batch size (default: 64)')
+    parser.add_argument('--num_classes', type=int, default=18, help='model output size, 8 for the multi-head scripts (default: 18)')
+    parser.add_argument('--num_iters', type=int, default=10, help='number of timed steps per mode (default: 10)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+
+    parser.add_argument('--output', type=str, default='model_benchmark.json', help='JSON result file (default: model_benchmark.json)')
+
+    args = parser.parse_args()
+    print(args)
+
+    run(args)
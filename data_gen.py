@@ -0,0 +1,119 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+
+import numpy as np
+from albumentations import Compose, ShiftScaleRotate, HorizontalFlip, ColorJitter, RandomBrightnessContrast
+from PIL import Image
+
+from dataset import is_image_file, _list_profiles, _scan_profile
+
+# 1장씩만 있는 incorrect_mask, normal 을 {stem}2 ~ {stem}5 로 4장씩 늘립니다.
+SOURCE_STEMS = ("incorrect_mask", "normal")
+COPIES = range(2, 6)
+
+trfm = Compose([
+        ShiftScaleRotate(p=1.0),
+        HorizontalFlip(p=0.5),
+        ColorJitter(0.1, 0.1, 0.1, 0.1),
+        RandomBrightnessContrast(brightness_limit=(-0.3, 0.3), contrast_limit=(-0.3, 0.3), p=1.0),
+    ], p=1.0)
+
+
+def save_format(path):
+    # 확장자가 말하는 format 으로 저장합니다. (예전 notebook 은 .jpg 이름에 PNG 를 저장했음)
+    ext = os.path.splitext(path)[1].lower()
+    return Image.registered_extensions()[ext]
+
+
+def file_seed(seed, rel_path):
+    # 실행 순서 / worker 수와 관계없이 같은 파일은 항상 같은 augmentation 을 받습니다.
+    digest = hashlib.md5(f"{seed}:{rel_path}".encode()).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+def is_up_to_date(src_path, out_path):
+    try:
+        if os.stat(out_path).st_mtime_ns < os.stat(src_path).st_mtime_ns:
+            return False
+        with Image.open(out_path) as image:
+            return image.format == save_format(out_path)
+    except (OSError, KeyError):
+        return False
+
+
+def collect_jobs(data_dir, force=False):
+    jobs = []
+    skipped = 0
+    for profile in _list_profiles(data_dir):
+        profile_dir = os.path.join(data_dir, profile)
+        for file_name in _scan_profile(profile_dir):
+            stem, ext = os.path.splitext(file_name)
+            if stem not in SOURCE_STEMS or not is_image_file(file_name):
+                continue
+
+            src_path = os.path.join(profile_dir, file_name)
+            for i in COPIES:
+                out_path = os.path.join(profile_dir, f"{stem}{i}{ext}")
+                if not force and is_up_to_date(src_path, out_path):
+                    skipped += 1
+                    continue
+                jobs.append((src_path, out_path, os.path.join(profile, f"{stem}{i}{ext}")))
+    return jobs, skipped
+
+
+def generate(args):
+    src_path, out_path, rel_path = args
+    seed = file_seed(_seed, rel_path)
+    # albumentations 는 python random 과 numpy 의 global RNG 를 모두 사용합니다.
+    random.seed(seed)
+    np.random.seed(seed)
+
+    image = np.array(Image.open(src_path))
+    changed_image = Image.fromarray(trfm(image=image)["image"])
+
+    # 중간에 끊겨도 잘린 파일이 up-to-date 로 보이지 않도록 tmp 에 쓰고 rename 합니다.
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    changed_image.save(tmp_path, save_format(out_path), quality=95)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+_seed = 42
+
+
+def _init_worker(seed):
+    global _seed
+    _seed = seed
+
+
+def run(data_dir, args):
+    jobs, skipped = collect_jobs(data_dir, force=args.force)
+    print(f"{len(jobs)} images to generate, {skipped} already up to date")
+    if not jobs:
+        return
+
+    num_workers = args.num_workers or multiprocessing.cpu_count()
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(args.seed,)) as pool:
+        for idx, _ in enumerate(pool.imap_unordered(generate, jobs, chunksize=16)):
+            if (idx + 1) % 1000 == 0:
+                print(f"[{idx + 1}/{len(jobs)}]")
+    print("Generate Done!")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(), help='number of augmentation processes')
+    parser.add_argument('--force', action='store_true', help='regenerate every output even if it is up to date')
+
+    # Container environment
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images'))
+
+    args = parser.parse_args()
+    print(args)
+
+    run(args.data_dir, args)
@@ -1,14 +1,23 @@
+import hashlib
+import json
+import multiprocessing
 import os
 import random
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from typing import Tuple, List
 
 import numpy as np
+import pandas as pd
 import torch
 from PIL import Image
-from torch.utils.data import Dataset, Subset, random_split
-from torchvision.transforms import Resize, ToTensor, Normalize, Compose, CenterCrop, ColorJitter, RandomErasing
+from torch.utils.data import Dataset, IterableDataset, Subset, random_split
+from torchvision.transforms import Resize, ToTensor, Normalize, Compose, CenterCrop, ColorJitter, RandomErasing, PILToTensor, \
+    RandomAffine, RandomHorizontalFlip
+
+from decoder import create_decoder, PILDecoder
 
 IMG_EXTENSIONS = [
     ".jpg", ".JPG", ".jpeg", ".JPEG", ".png",
@@ -20,22 +29,246 @@ def is_image_file(filename):
     return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
 
 
+PROFILE_INDEX_VERSION = 1
+
+
+def profile_index_path(data_dir):
+    # data_dir 안에 쓰면 data_dir 의 mtime 이 바뀌므로 옆에 저장합니다. e.g. train/.images_gen.index.npz
+    data_dir = os.path.abspath(data_dir)
+    return os.path.join(os.path.dirname(data_dir), f".{os.path.basename(data_dir)}.index.npz")
+
+
+def _mask_type(stem):
+    if stem.startswith("incorrect"):
+        return MaskLabels.INCORRECT
+    elif stem.startswith("mask"):
+        return MaskLabels.MASK
+    elif stem.startswith("normal"):
+        return MaskLabels.NORMAL
+    return -1
+
+
+def _stat_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+
+def _scan_profile(profile_dir):
+    with os.scandir(profile_dir) as entries:
+        return sorted(entry.name for entry in entries if not entry.name.startswith(".") and entry.is_file())
+
+
+def _list_profiles(data_dir):
+    with os.scandir(data_dir) as entries:
+        return sorted(entry.name for entry in entries if not entry.name.startswith(".") and entry.is_dir())
+
+
+def _load_index_file(index_path):
+    try:
+        with np.load(index_path) as f:
+            index = {key: f[key] for key in f.files}
+    except (OSError, ValueError, KeyError):
+        return None
+    if int(index.get("version", -1)) != PROFILE_INDEX_VERSION:
+        return None
+    return index
+
+
+def _save_index_file(index_path, index):
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **index)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"[Warning] Could not save profile index to {index_path}: {e}")
+
+
+class PathTable:
+    """
+    sample 마다 경로 문자열을 들고 있지 않고 (profile 폴더, 파일 이름) 테이블의 index 만 저장합니다.
+    DataLoader worker 로 넘어갈 때도 numpy 배열 몇 개만 pickle 됩니다.
+    """
+    def __init__(self, root, dirs, dir_idx, names, name_idx):
+        self.root = root
+        self.dirs = np.asarray(dirs, dtype=str)
+        self.dir_idx = np.asarray(dir_idx, dtype=np.int32)
+        self.names = np.asarray(names, dtype=str)
+        self.name_idx = np.asarray(name_idx, dtype=np.int32)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return os.path.join(self.root, str(self.dirs[self.dir_idx[index]]), str(self.names[self.name_idx[index]]))
+        return PathTable(self.root, self.dirs, self.dir_idx[index], self.names, self.name_idx[index])
+
+    def __len__(self):
+        return len(self.dir_idx)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def tolist(self):
+        return list(self)
+
+
+def _index_fingerprint(index):
+    """data_dir 과 profile 폴더들의 mtime hash, 폴더 안의 파일이 추가 / 삭제 / 이름 변경되면 바뀝니다."""
+    digest = hashlib.md5()
+    for key in ("root_mtime", "profile_mtime"):
+        digest.update(np.ascontiguousarray(index[key], dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _expand_index(data_dir, index):
+    """profile 단위 column 을 파일 단위로 펼쳐서 setup 에서 바로 쓸 수 있게 합니다."""
+    profile_idx = index["profile_idx"]
+    names, name_idx = np.unique(index["file_name"], return_inverse=True)
+    stems = np.asarray([os.path.splitext(name)[0] for name in names.tolist()], dtype=str)
+    return {
+        "paths": PathTable(data_dir, index["profiles"], profile_idx, names, name_idx),
+        "profile_idx": profile_idx,
+        "profiles": index["profiles"],
+        "file_name": index["file_name"],
+        "stem": stems[name_idx],
+        "mask": index["mask"],
+        "id": index["id"][profile_idx],
+        "gender": index["gender"][profile_idx],
+        "race": index["race"][profile_idx],
+        "age": index["age"][profile_idx],
+        "fingerprint": _index_fingerprint(index),
+    }
+
+
+def load_profile_index(data_dir, num_workers=16):
+    """
+    data_dir 아래 `ID_gender_race_age/파일` 구조를 columnar index 로 읽습니다.
+
+    profile 폴더들을 thread pool 에서 병렬로 os.scandir 하고, 결과를 data_dir 옆의
+    `.{data_dir 이름}.index.npz` 에 저장합니다. 다음 실행부터는 data_dir 과 각 profile 폴더의
+    mtime 만 확인해서 바뀐 폴더만 다시 scan 합니다.
+
+    Returns:
+        dict: 파일 단위 column (paths, profile_idx, file_name, stem, mask, id, gender, race, age)
+              와 profile 이름 목록 (profiles), 폴더 mtime 의 hash (fingerprint)
+    """
+    index_path = profile_index_path(data_dir)
+    cached = _load_index_file(index_path)
+    root_mtime = _stat_mtime(data_dir)
+
+    if cached is not None and int(cached["root_mtime"]) == root_mtime:
+        profiles = cached["profiles"].tolist()
+    else:
+        profiles = _list_profiles(data_dir)
+    profile_dirs = [os.path.join(data_dir, profile) for profile in profiles]
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        mtimes = list(pool.map(_stat_mtime, profile_dirs))
+
+        cached_files = {}
+        if cached is not None:
+            cached_profiles = cached["profiles"].tolist()
+            if cached_profiles == profiles and cached["profile_mtime"].tolist() == mtimes:
+                return _expand_index(data_dir, cached)
+
+            # mtime 이 그대로인 profile 은 이전 scan 결과를 재사용합니다
+            cached_mtimes = dict(zip(cached_profiles, cached["profile_mtime"].tolist()))
+            unchanged = {profile for profile, mtime in zip(profiles, mtimes) if cached_mtimes.get(profile) == mtime}
+            cached_files = {profile: [] for profile in unchanged}
+            for profile_idx, name in zip(cached["profile_idx"].tolist(), cached["file_name"].tolist()):
+                profile = cached_profiles[profile_idx]
+                if profile in unchanged:
+                    cached_files[profile].append(name)
+
+        stale = [idx for idx, profile in enumerate(profiles) if profile not in cached_files]
+        for idx, file_names in zip(stale, pool.map(_scan_profile, [profile_dirs[idx] for idx in stale])):
+            cached_files[profiles[idx]] = file_names
+
+    ids, genders, races, ages = [], [], [], []
+    for profile in profiles:
+        id, gender, race, age = profile.split("_")
+        try:
+            age = int(age)
+        except ValueError:
+            raise ValueError(f"Age value should be numeric, {age}")
+        ids.append(id)
+        genders.append(GenderLabels.from_str(gender))
+        races.append(race)
+        ages.append(age)
+
+    profile_idx, file_names = [], []
+    for idx, profile in enumerate(profiles):
+        names = cached_files[profile]
+        profile_idx.extend([idx] * len(names))
+        file_names.extend(names)
+
+    index = {
+        "version": np.asarray(PROFILE_INDEX_VERSION),
+        "root_mtime": np.asarray(root_mtime, dtype=np.int64),
+        "profiles": np.asarray(profiles, dtype=str),
+        "profile_mtime": np.asarray(mtimes, dtype=np.int64),
+        "id": np.asarray(ids, dtype=str),
+        "gender": np.asarray(genders, dtype=np.int8),
+        "race": np.asarray(races, dtype=str),
+        "age": np.asarray(ages, dtype=np.int16),
+        "profile_idx": np.asarray(profile_idx, dtype=np.int32),
+        "file_name": np.asarray(file_names, dtype=str),
+        "mask": np.asarray([_mask_type(os.path.splitext(name)[0]) for name in file_names], dtype=np.int8),
+    }
+    _save_index_file(index_path, index)
+    return _expand_index(data_dir, index)
+
+
+def draft_size_of(resize):
+    """
+    Resize 에 넘기는 resize 가 (H, W) 이면 JPEG 을 그 크기 이상까지만 축소 decode (draft) 해도 됩니다.
+    full decode 후 resize 한 결과와 완전히 같지는 않고 (DCT 축소 decode 의 filter 가 다름) 픽셀 값이 근사적으로 같습니다.
+    """
+    return tuple(resize) if resize is not None and len(resize) == 2 else None
+
+
+# dataset 의 기본 image reader, (path, draft_size) 를 받는 callable 이면 무엇이든 바꿔 끼울 수 있습니다.
+# (decoder.py 의 backend 들, rembg_dataset.MaskedImageReader)
+open_image = PILDecoder()
+
+
 class BaseAugmentation:
+    # pack_dataset.py 에서 resize 전에 적용할 crop (None 이면 crop 없이 resize 만)
+    crop = None
+
     def __init__(self, resize, mean, std, **args):
-        self.transform = Compose([
+        # 첫 연산이 Resize 이므로 resize 크기까지 축소 decode 가능
+        self.draft_size = draft_size_of(resize)
+        # prefix: 매 epoch 같은 결과가 나오는 앞단 (PrefixCache 로 sample 별 cache 가능)
+        # suffix: 매 epoch 다시 실행되는 뒷단
+        self.prefix = Compose([
             Resize(resize, Image.BILINEAR),
+        ])
+        self.suffix = Compose([
             ToTensor(),
             Normalize(mean=mean, std=std),
         ])
+        self.transform = Compose([self.prefix, self.suffix])
 
     def __call__(self, image):
         return self.transform(image)
-    
+
+
 class CustomAugmentation:
-    def __init__(self, resize, mean, std, **args):
-        self.transform = Compose([
-            CenterCrop((320, 256)),
+    crop = (320, 256)
+
+    def __init__(self, resize, mean, std, pre_resized=False, **args):
+        # pre_resized: packed store 처럼 이미 crop + resize 된 이미지를 받는 경우 앞단을 생략
+        # 픽셀 단위 CenterCrop 이 먼저 오므로 full resolution 으로 decode 해야 합니다
+        self.draft_size = None
+        geometric = [] if pre_resized else [
+            CenterCrop(self.crop),
             Resize(resize, Image.BILINEAR),
+        ]
+        self.prefix = Compose(geometric)
+        self.suffix = Compose([
             #RandomHorizontalFlip(0.5),
             ColorJitter(0.1, 0.1, 0.1, 0.1),
             ToTensor(),
@@ -43,11 +276,426 @@ class CustomAugmentation:
             AddGaussianNoise(),
             RandomErasing(p=0.1, value='random'),
         ])
+        self.transform = Compose([self.prefix, self.suffix])
+
+    def __call__(self, image):
+        return self.transform(image)
+
+
+def _memory_format(images):
+    """images 의 layout (NCHW 혹은 channels_last)"""
+    if not images.is_contiguous() and images.is_contiguous(memory_format=torch.channels_last):
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def _rgb_to_hsv(images):
+    r, g, b = images.unbind(dim=1)
+    max_c, _ = images.max(dim=1)
+    min_c, _ = images.min(dim=1)
+    delta = max_c - min_c
+    safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+
+    s = delta / torch.where(max_c > 0, max_c, torch.ones_like(max_c))
+    h = torch.where(max_c == r, (g - b) / safe_delta,
+        torch.where(max_c == g, 2. + (b - r) / safe_delta, 4. + (r - g) / safe_delta))
+    h = torch.where(delta > 0, (h / 6.) % 1., torch.zeros_like(h))
+    return torch.stack([h, s, max_c], dim=1)
+
+
+def _hsv_to_rgb(images):
+    h, s, v = images.unbind(dim=1)
+    i = torch.floor(h * 6.)
+    f = h * 6. - i
+    i = i.long() % 6
+    p = v * (1. - s)
+    q = v * (1. - s * f)
+    t = v * (1. - s * (1. - f))
+    candidates = torch.stack([
+        torch.stack([v, q, p, p, t, v], dim=1),
+        torch.stack([t, v, v, q, p, p], dim=1),
+        torch.stack([p, p, t, v, v, q], dim=1),
+    ], dim=1)  # B x 3 x 6 x H x W
+    index = i.unsqueeze(1).unsqueeze(2).expand(-1, 3, 1, -1, -1)
+    return candidates.gather(2, index).squeeze(2)
+
+
+class BatchAugmentation(torch.nn.Module):
+    """
+    collate 된 batch (B x C x H x W, uint8 0~255 또는 float 0~1) 에 flip / ColorJitter / Normalize /
+    AddGaussianNoise / RandomErasing 을 적용합니다. random 값은 sample 마다 따로 뽑지만
+    연산은 batch 전체에 대해 tensor 연산 한 번씩으로 처리합니다.
+    eval() 상태에서는 Normalize 만 합니다.
+    """
+    def __init__(self, mean, std, flip_p=0., brightness=0., contrast=0., saturation=0., hue=0.,
+                 noise_mean=0., noise_std=0., erasing_p=0., erasing_scale=(0.02, 0.33), erasing_ratio=(0.3, 3.3)):
+        super().__init__()
+        self.register_buffer("mean", torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1))
+        self.flip_p = flip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.noise_mean = noise_mean
+        self.noise_std = noise_std
+        self.erasing_p = erasing_p
+        self.erasing_scale = erasing_scale
+        self.erasing_ratio = erasing_ratio
+
+    def _uniform(self, images, low, high):
+        return torch.empty(images.size(0), 1, 1, 1, device=images.device).uniform_(low, high)
+
+    def _flip(self, images):
+        flip = torch.rand(images.size(0), 1, 1, 1, device=images.device) < self.flip_p
+        return torch.where(flip, images.flip(-1), images)
+
+    @staticmethod
+    def _gray(images):
+        r, g, b = images.unbind(dim=1)
+        return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+    def _jitter(self, images):
+        ops = []
+        if self.brightness > 0:
+            factor = self._uniform(images, max(0., 1 - self.brightness), 1 + self.brightness)
+            ops.append(lambda x, factor=factor: (x * factor).clamp_(0, 1))
+        if self.contrast > 0:
+            factor = self._uniform(images, max(0., 1 - self.contrast), 1 + self.contrast)
+            ops.append(lambda x, factor=factor: (factor * x + (1 - factor) * self._gray(x).mean(dim=(-2, -1), keepdim=True)).clamp_(0, 1))
+        if self.saturation > 0:
+            factor = self._uniform(images, max(0., 1 - self.saturation), 1 + self.saturation)
+            ops.append(lambda x, factor=factor: (factor * x + (1 - factor) * self._gray(x)).clamp_(0, 1))
+        if self.hue > 0:
+            shift = self._uniform(images, -self.hue, self.hue).squeeze(1)
+
+            def adjust_hue(x):
+                hsv = _rgb_to_hsv(x)
+                hsv = torch.stack([(hsv[:, 0] + shift) % 1., hsv[:, 1], hsv[:, 2]], dim=1)
+                # stack 의 결과는 항상 NCHW 이므로 입력이 channels_last 면 같은 layout 으로 돌려줍니다
+                return _hsv_to_rgb(hsv).contiguous(memory_format=_memory_format(x))
+            ops.append(adjust_hue)
+
+        # ColorJitter 처럼 연산 순서를 섞습니다 (batch 단위)
+        for op_idx in torch.randperm(len(ops)).tolist():
+            images = ops[op_idx](images)
+        return images
+
+    def _erase(self, images):
+        batch_size, channels, height, width = images.shape
+        device = images.device
+        area = height * width
+
+        # RandomErasing 처럼 최대 10 번 시도해서 이미지 안에 들어가는 첫 번째 크기를 씁니다
+        attempts = 10
+        target_area = torch.empty(batch_size, attempts, device=device).uniform_(*self.erasing_scale) * area
+        log_ratio = torch.empty(batch_size, attempts, device=device).uniform_(
+            float(np.log(self.erasing_ratio[0])), float(np.log(self.erasing_ratio[1])))
+        ratio = torch.exp(log_ratio)
+        h = torch.sqrt(target_area * ratio).round().long()
+        w = torch.sqrt(target_area / ratio).round().long()
+        fits = (h < height) & (w < width)
+        first = torch.argmax(fits.int(), dim=1, keepdim=True)
+        h = h.gather(1, first).squeeze(1)
+        w = w.gather(1, first).squeeze(1)
+        apply = (torch.rand(batch_size, device=device) < self.erasing_p) & fits.any(dim=1)
+
+        top = (torch.rand(batch_size, device=device) * (height - h + 1).clamp(min=1)).long()
+        left = (torch.rand(batch_size, device=device) * (width - w + 1).clamp(min=1)).long()
+        rows = torch.arange(height, device=device).view(1, -1)
+        cols = torch.arange(width, device=device).view(1, -1)
+        in_rows = (rows >= top.view(-1, 1)) & (rows < (top + h).view(-1, 1))
+        in_cols = (cols >= left.view(-1, 1)) & (cols < (left + w).view(-1, 1))
+        region = (in_rows.unsqueeze(2) & in_cols.unsqueeze(1) & apply.view(-1, 1, 1)).unsqueeze(1)
+        return torch.where(region, torch.randn_like(images), images)
+
+    def forward(self, images):
+        if images.dtype == torch.uint8:
+            images = images.float().div_(255)
+        if self.training:
+            if self.flip_p > 0:
+                images = self._flip(images)
+            images = self._jitter(images)
+
+        images = (images - self.mean) / self.std
+
+        if self.training:
+            if self.noise_std > 0 or self.noise_mean != 0:
+                images = images + torch.randn_like(images) * self.noise_std + self.noise_mean
+            if self.erasing_p > 0:
+                images = self._erase(images)
+        return images
+
+
+class BatchBaseAugmentation:
+    """
+    BaseAugmentation 과 같지만 worker 에서는 resize 후 uint8 tensor 만 만들고,
+    Normalize 는 batch_transform 으로 학습 loop 에서 (GPU 에서) 합니다.
+    """
+    crop = None
+
+    def __init__(self, resize, mean, std, **args):
+        self.draft_size = draft_size_of(resize)
+        self.prefix = Compose([
+            Resize(resize, Image.BILINEAR),
+        ])
+        self.suffix = Compose([
+            PILToTensor(),
+        ])
+        self.transform = Compose([self.prefix, self.suffix])
+        self.batch_transform = BatchAugmentation(mean, std)
 
     def __call__(self, image):
         return self.transform(image)
 
 
+class BatchCustomAugmentation:
+    """
+    CustomAugmentation 의 random 연산 (ColorJitter, AddGaussianNoise, RandomErasing) 을
+    batch_transform 으로 옮긴 버전입니다. 학습 loop 에서 inputs = batch_transform(inputs) 로 적용합니다.
+    """
+    crop = (320, 256)
+
+    def __init__(self, resize, mean, std, pre_resized=False, flip_p=0., **args):
+        self.draft_size = None
+        geometric = [] if pre_resized else [
+            CenterCrop(self.crop),
+            Resize(resize, Image.BILINEAR),
+        ]
+        self.prefix = Compose(geometric)
+        self.suffix = Compose([
+            PILToTensor(),
+        ])
+        self.transform = Compose([self.prefix, self.suffix])
+        self.batch_transform = BatchAugmentation(
+            mean, std, flip_p=flip_p, brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1,
+            noise_std=1., erasing_p=0.1)
+
+    def __call__(self, image):
+        return self.transform(image)
+
+
+class PrefixCache:
+    """
+    augmentation prefix 결과 (uint8 H x W x C) 를 sample index 별로 저장하는 LRU cache 입니다.
+    저장된 크기가 max_bytes 를 넘으면 가장 오래 쓰지 않은 sample 부터 지웁니다.
+
+    RAM cache 는 DataLoader worker 마다 따로 있고 공유되지 않습니다. shuffle / sampler 를 쓰면 모든 worker 가
+    결국 모든 sample 을 보게 되므로 메모리는 최대 num_workers * max_bytes 까지 늘어나고, 한 worker 의 cache 가
+    전체 dataset 을 담을 만큼 크지 않으면 hit rate 가 낮습니다. (worker 간 공유가 필요하면 ByteCache 를 쓰세요)
+    cache_dir 을 주면 RAM 대신 디스크에 .npy 로 저장하고, 다른 worker 가 써 둔 파일도 읽으므로 worker 간에 공유됩니다.
+    (max_bytes 는 이 경우에도 worker 별 LRU 한도입니다)
+    worker 가 가진 cache 는 persistent_workers=True 일 때만 epoch 간에 유지됩니다.
+    """
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.root_dir = cache_dir
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()  # index -> array (RAM) / nbytes (disk)
+        self.nbytes = 0
+
+    def reset(self, key):
+        """prefix 가 바뀌면 (set_transform) 이전 결과를 버리고 key 별 디렉토리를 씁니다."""
+        self.entries.clear()
+        self.nbytes = 0
+        if self.root_dir is not None:
+            self.cache_dir = os.path.join(self.root_dir, hashlib.md5(key.encode()).hexdigest()[:12])
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, index):
+        return os.path.join(self.cache_dir, f"{index}.npy")
+
+    def get(self, index):
+        if self.cache_dir is None:
+            image = self.entries.get(index)
+            if image is not None:
+                self.entries.move_to_end(index)
+            return image
+
+        try:
+            image = np.load(self._path(index))
+        except (OSError, ValueError):
+            self.entries.pop(index, None)
+            return None
+        if index in self.entries:
+            self.entries.move_to_end(index)
+        else:
+            self._add(index, image.nbytes, image.nbytes)
+        return image
+
+    def put(self, index, image):
+        if image.nbytes > self.max_bytes:
+            return
+        if self.cache_dir is None:
+            self._add(index, image, image.nbytes)
+            return
+
+        tmp_path = f"{self._path(index)}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, image)
+            os.replace(tmp_path, self._path(index))
+        except OSError:
+            return
+        self._add(index, image.nbytes, image.nbytes)
+
+    def _add(self, index, value, nbytes):
+        if index in self.entries:
+            return
+        self.entries[index] = value
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            evicted, value = self.entries.popitem(last=False)
+            self.nbytes -= value if self.cache_dir is not None else value.nbytes
+            if self.cache_dir is not None:
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+
+
+class ByteCache:
+    """
+    이미지 파일의 encoded bytes 를 shared memory 에 max_bytes 까지 보관하는 cache 입니다.
+    decode 된 이미지 대신 파일 내용 (~50KB) 만 들고 있으므로 같은 RAM 에 약 10배 많은 이미지가 들어가고,
+    cache 된 파일은 open / read / stat 없이 메모리에서 바로 decode 합니다.
+
+    bytes 는 DataLoader worker 를 만들기 전에 할당한 shared memory ring buffer 에 쓰이므로 모든 worker 가
+    같은 cache 를 봅니다. 공간이 모자라면 가장 먼저 들어온 파일부터 지우고, 지워질 차례가 가까운
+    (ring 의 오래된 절반에 있는) 파일이 다시 읽히면 앞쪽으로 옮겨 쓰므로 LRU 에 가깝게 동작합니다.
+    start_read_ahead 는 background thread pool 로 파일을 미리 읽어서 cache 가 찰 때까지 채웁니다.
+    """
+    def __init__(self, image_paths, max_bytes):
+        # 같은 파일을 여러 sample 이 쓰는 경우 (MaskVirtualDataset) 파일 단위로 한 번만 저장합니다
+        keys = image_paths.dir_idx.astype(np.int64) * len(image_paths.names) + image_paths.name_idx
+        _, first_sample, self.file_of_sample = np.unique(keys, return_index=True, return_inverse=True)
+        self.file_paths = image_paths[first_sample]
+        num_files = len(first_sample)
+
+        self.max_bytes = max_bytes
+        self.arena = torch.empty(max_bytes, dtype=torch.uint8).share_memory_()
+        self.offsets = torch.zeros(num_files, dtype=torch.int64).share_memory_()
+        self.lengths = torch.zeros(num_files, dtype=torch.int64).share_memory_()  # 0 이면 cache 되지 않은 파일
+        # 들어온 순서대로 (file, offset) 을 쌓는 FIFO, 오래된 것부터 ring 에서 지웁니다
+        self.queue = torch.zeros(2 * num_files + 16, 2, dtype=torch.int64).share_memory_()
+        self.state = torch.zeros(4, dtype=torch.int64).share_memory_()  # head, queue 시작, queue 끝, 누적 bytes
+        self.lock = multiprocessing.Lock()
+        self._read_ahead = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_read_ahead"] = []  # thread 는 worker 로 넘기지 않습니다
+        return state
+
+    def __len__(self):
+        return int((self.lengths > 0).sum())
+
+    @property
+    def nbytes(self):
+        return int(self.lengths.sum())
+
+    def _pop(self):
+        start = int(self.state[1])
+        file, offset = self.queue[start % len(self.queue)].tolist()
+        if int(self.offsets[file]) == offset:  # 옮겨 쓴 파일의 이전 위치면 이미 무효
+            self.lengths[file] = 0
+        self.state[1] = start + 1
+        return offset
+
+    def _queue_offset(self, position):
+        return int(self.queue[position % len(self.queue), 1])
+
+    def _put(self, file, data):
+        size = len(data)
+        head, start, end = self.state[:3].tolist()
+        if head + size > self.max_bytes:
+            # ring 끝에 남은 공간은 건너뛰고 0 부터 씁니다. 건너뛴 구간에 있는 파일이 가장 오래된 것들입니다
+            while start < end and self._queue_offset(start) >= head:
+                self._pop()
+                start += 1
+            head = 0
+        # [head, head + size) 를 덮어쓰게 될 파일과, queue 가 가득 찼으면 가장 오래된 파일을 지웁니다
+        while start < end and (end - start >= len(self.queue) or head <= self._queue_offset(start) < head + size):
+            self._pop()
+            start += 1
+
+        self.arena[head:head + size].numpy()[:] = np.frombuffer(data, dtype=np.uint8)
+        self.offsets[file] = head
+        self.lengths[file] = size
+        self.queue[end % len(self.queue), 0] = file
+        self.queue[end % len(self.queue), 1] = head
+        self.state[0] = head + size
+        self.state[2] = end + 1
+        self.state[3] += size
+
+    def _is_old(self, file):
+        head = int(self.state[0])
+        offset = int(self.offsets[file])
+        return (head - offset) % self.max_bytes > self.max_bytes // 2
+
+    def get(self, file):
+        with self.lock:
+            size = int(self.lengths[file])
+            if size == 0:
+                return None
+            offset = int(self.offsets[file])
+            data = self.arena[offset:offset + size].numpy().tobytes()
+            if self._is_old(file):
+                self._put(file, data)
+        return data
+
+    def put(self, file, data):
+        if not 0 < len(data) <= self.max_bytes // 2:
+            return
+        with self.lock:
+            if int(self.lengths[file]) == 0:
+                self._put(file, data)
+
+    def load(self, index):
+        """sample index 의 파일 내용, cache 에 없으면 파일을 읽고 cache 에 넣습니다."""
+        file = int(self.file_of_sample[index])
+        data = self.get(file)
+        if data is None:
+            with open(self.file_paths[file], "rb") as f:
+                data = f.read()
+            self.put(file, data)
+        return data
+
+    def start_read_ahead(self, num_threads=8):
+        """background thread 들이 파일 순서대로 읽어서 cache 가 찰 때까지 채웁니다."""
+        files = iter(range(len(self.lengths)))
+        files_lock = threading.Lock()
+        budget = self.max_bytes - int(self.state[3])
+
+        def read_ahead():
+            nonlocal budget
+            while True:
+                with files_lock:
+                    file = next(files, None)
+                    if file is None or budget <= 0:
+                        return
+                if int(self.lengths[file]) > 0:
+                    continue
+                try:
+                    with open(self.file_paths[file], "rb") as f:
+                        data = f.read()
+                except OSError:
+                    continue
+                with files_lock:
+                    budget -= len(data)
+                    if budget < 0:  # 이미 읽은 파일을 밀어내지 않도록 가득 차면 멈춥니다
+                        return
+                self.put(file, data)
+
+        self._read_ahead = [threading.Thread(target=read_ahead, daemon=True) for _ in range(num_threads)]
+        for thread in self._read_ahead:
+            thread.start()
+
+    def wait_read_ahead(self):
+        for thread in self._read_ahead:
+            thread.join()
+
+
 class AddGaussianNoise(object):
     def __init__(self, mean=0., std=1.):
         self.std = std
@@ -60,6 +708,180 @@ class AddGaussianNoise(object):
         return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
 
 
+def _pack_image(args):
+    image_path, resize, crop, reader = args
+    image = reader(image_path, resize if crop is None else None)
+    image = image.convert("RGB")
+    if crop is not None:
+        image = CenterCrop(crop)(image)
+    image = Resize(resize, Image.BILINEAR)(image)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def pack_dataset(dataset, pack_dir, resize, crop=None, num_workers=None):
+    """
+    dataset 의 모든 이미지를 한 번만 decode (+ center crop) + resize 해서
+    pack_dir 에 N x H x W x 3 uint8 memmap 으로 저장합니다.
+
+    pack_dir/
+    ├── images.npy  : (N, H, W, 3) uint8, np.load(mmap_mode="r") 로 바로 읽을 수 있는 형식
+    ├── paths.npy   : 각 행에 해당하는 원본 이미지 경로
+    └── meta.json   : resize / crop 정보
+
+    label 은 저장하지 않습니다. label 은 경로 (+ age_thresholds) 에서 정해지므로 학습할 때 scan 한 값을 그대로 씁니다.
+
+    Args:
+        dataset: setup 이 끝난 MaskBaseDataset / MaskMultiLabelDataset
+        pack_dir (str): 저장 경로
+        resize (list): [H, W]
+        crop (tuple): resize 전에 적용할 CenterCrop 크기, None 이면 생략
+        num_workers (int): decode 에 사용할 process 수
+    """
+    if len(resize) != 2:
+        raise ValueError(f"resize should be [height, width] to pack images, {resize}")
+    height, width = resize
+    num_workers = num_workers or max(multiprocessing.cpu_count() // 2, 1)
+    os.makedirs(pack_dir, exist_ok=True)
+
+    image_paths = list(dataset.image_paths)
+    images = np.lib.format.open_memmap(
+        os.path.join(pack_dir, "images.npy"), mode="w+", dtype=np.uint8,
+        shape=(len(image_paths), height, width, 3))
+    reader = getattr(dataset, "image_reader", open_image)
+    jobs = [(path, (height, width), crop, reader) for path in image_paths]
+    with multiprocessing.Pool(num_workers) as pool:
+        for idx, image in enumerate(pool.imap(_pack_image, jobs, chunksize=64)):
+            images[idx] = image
+    images.flush()
+    del images
+
+    np.save(os.path.join(pack_dir, "paths.npy"), np.asarray(image_paths))
+    with open(os.path.join(pack_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"resize": [height, width], "crop": crop, "length": len(image_paths)}, f, indent=4)
+
+
+class PackedImages:
+    """
+    pack_dataset 으로 만든 memmap 을 dataset index 순서로 읽어줍니다.
+    memmap 은 처음 접근할 때 열기 때문에 DataLoader worker 마다 따로 mmap 됩니다.
+    """
+    def __init__(self, pack_dir, image_paths):
+        self.pack_dir = pack_dir
+        with open(os.path.join(pack_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        packed_paths = np.load(os.path.join(pack_dir, "paths.npy"))
+        row_of = {path: row for row, path in enumerate(packed_paths.tolist())}
+        missing = [path for path in image_paths if path not in row_of]
+        if missing:
+            raise ValueError(
+                f"{len(missing)} images are not in the packed store {pack_dir}, re-run pack_dataset.py (e.g. {missing[0]})")
+        self.rows = np.asarray([row_of[path] for path in image_paths], dtype=np.int64)
+        self._images = None
+
+    def check(self, resize, crop):
+        """pack 할 때의 resize / crop 이 지금 학습의 --resize / transform.crop 과 같은지 확인합니다."""
+        expected = {"resize": list(resize), "crop": list(crop) if crop is not None else None}
+        packed = {key: self.meta.get(key) for key in expected}
+        if packed != expected:
+            raise ValueError(
+                f"packed store {self.pack_dir} was made with {packed} but training uses {expected}, "
+                f"re-run pack_dataset.py with the same --resize and --augmentation")
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.pack_dir, "images.npy"), mmap_mode="r")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __getitem__(self, index):
+        return Image.fromarray(np.array(self.images[self.rows[index]]))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _image_moments(args):
+    image_path, reader = args
+    pixels = np.asarray(reader(image_path), dtype=np.float64)
+    pixels = pixels.reshape(-1, pixels.shape[-1])
+    mean = pixels.mean(axis=0)
+    return len(pixels), mean, np.square(pixels - mean).sum(axis=0)
+
+
+def calc_image_statistics(image_paths, reader=open_image, num_samples=None, seed=42, num_workers=None):
+    """
+    channel 별 mean / std (0~1 scale) 를 process pool 에서 한 번에 계산합니다.
+    이미지별 (pixel 수, mean, M2) 를 Chan 의 병렬 Welford 식으로 합치기 때문에 메모리는 일정합니다.
+
+    Args:
+        reader (callable): 이미지 경로를 PIL 이미지로 읽는 함수, process pool 로 넘어가므로 pickle 가능해야 합니다
+        num_samples (int): None 이면 전체, 아니면 seed 로 고정된 random sample 만 사용
+    """
+    image_paths = list(image_paths)
+    if num_samples is not None and num_samples < len(image_paths):
+        rows = np.random.default_rng(seed).choice(len(image_paths), num_samples, replace=False)
+        image_paths = [image_paths[row] for row in np.sort(rows)]
+    num_workers = num_workers or max(multiprocessing.cpu_count() // 2, 1)
+
+    count, mean, m2 = 0, 0., 0.
+    jobs = [(path, reader) for path in image_paths]
+    with multiprocessing.Pool(num_workers) as pool:
+        for n, image_mean, image_m2 in pool.imap_unordered(_image_moments, jobs, chunksize=32):
+            delta = image_mean - mean
+            total = count + n
+            mean = mean + delta * n / total
+            m2 = m2 + image_m2 + delta ** 2 * count * n / total
+            count = total
+
+    return mean / 255, np.sqrt(m2 / count) / 255
+
+
+def statistics_path(data_dir):
+    data_dir = os.path.abspath(data_dir)
+    return os.path.join(os.path.dirname(data_dir), f".{os.path.basename(data_dir)}.statistics.json")
+
+
+def load_statistics(data_dir, image_paths, variant="default", reader=open_image, num_samples=None, seed=42,
+                    fingerprint=None):
+    """
+    data_dir 옆의 `.{data_dir 이름}.statistics.json` 에 variant (default / rembg) 별로 저장된
+    mean / std 를 읽고, 없거나 이미지 수 혹은 profile index 의 fingerprint (폴더 mtime) 가 바뀌었으면
+    calc_image_statistics 로 다시 계산해서 저장합니다.
+
+    Args:
+        fingerprint (str): load_profile_index(data_dir)["fingerprint"], None 이면 profile index 를 읽어서 구합니다
+    """
+    if fingerprint is None:
+        fingerprint = load_profile_index(data_dir)["fingerprint"]
+    path = statistics_path(data_dir)
+    key = variant if num_samples is None else f"{variant}_{num_samples}_{seed}"
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+
+    cached = saved.get(key)
+    if cached is not None and cached["num_images"] == len(image_paths) and cached.get("fingerprint") == fingerprint:
+        return np.asarray(cached["mean"]), np.asarray(cached["std"])
+
+    print("[Warning] Calculating statistics... It can take a long time depending on your CPU machine")
+    mean, std = calc_image_statistics(image_paths, reader, num_samples, seed)
+    saved[key] = {"mean": mean.tolist(), "std": std.tolist(), "num_images": len(image_paths), "fingerprint": fingerprint}
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(saved, f, indent=4)
+    except OSError as e:
+        print(f"[Warning] Could not save statistics to {path}: {e}")
+    return mean, std
+
+
 class MaskLabels(int, Enum):
     MASK = 0
     INCORRECT = 1
@@ -82,6 +904,10 @@ class GenderLabels(int, Enum):
                 f"Gender value should be either 'male' or 'female', {value}")
 
 
+# 나이 구간 경계, dataset 의 age_thresholds 로 바꿀 수 있습니다
+AGE_THRESHOLDS = (29, 57)
+
+
 class AgeLabels(int, Enum):
     YOUNG = 0
     MIDDLE = 1
@@ -94,12 +920,33 @@ class AgeLabels(int, Enum):
         except Exception:
             raise ValueError(f"Age value should be numeric, {value}")
 
-        if value < 29:
-            return cls.YOUNG
-        elif value < 57:
-            return cls.MIDDLE
-        else:
-            return cls.OLD
+        return cls(int(np.digitize(value, AGE_THRESHOLDS)))
+
+
+def age_labels_of(ages, thresholds=AGE_THRESHOLDS):
+    """
+    나이 배열을 한 번에 YOUNG / MIDDLE / OLD 로 나눕니다. thresholds=(29, 57) 이면
+    29 미만 -> YOUNG, 29 이상 57 미만 -> MIDDLE, 57 이상 -> OLD 입니다.
+    """
+    thresholds = np.asarray(thresholds)
+    if thresholds.shape != (len(AgeLabels) - 1,) or np.any(np.diff(thresholds) <= 0):
+        raise ValueError(f"Age thresholds should be {len(AgeLabels) - 1} increasing numbers, {thresholds.tolist()}")
+    return np.digitize(ages, thresholds).astype(np.int8)
+
+
+def _assign_samples(dataset, index, rows):
+    """index 의 rows 를 dataset 의 sample 로 지정합니다. label 은 모두 int8 column 으로 저장됩니다."""
+    rows = np.asarray(rows, dtype=np.int64)
+    stems, stem_idx = np.unique(index["stem"][rows], return_inverse=True)
+    mask_of_stem = np.asarray([dataset._file_names[stem] for stem in stems.tolist()], dtype=np.int8)
+
+    dataset.image_paths = index["paths"][rows]
+    dataset.index_fingerprint = index["fingerprint"]
+    dataset.profile_idx = index["profile_idx"][rows]
+    dataset.ages = index["age"][rows].astype(np.int16)
+    dataset.mask_labels = mask_of_stem[stem_idx]
+    dataset.gender_labels = index["gender"][rows].astype(np.int8)
+    dataset.age_labels = age_labels_of(dataset.ages, dataset.age_thresholds)
 
 
 class MaskBaseDataset(Dataset):
@@ -124,95 +971,125 @@ class MaskBaseDataset(Dataset):
         "normal5": MaskLabels.NORMAL,
     }
 
-    image_paths = []
-    mask_labels = []
-    gender_labels = []
-    age_labels = []
+    age_thresholds = AGE_THRESHOLDS
+    _statistics_variant = "default"
+    image_reader = open_image
 
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
+    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2, packed_dir=None,
+                 decoder=None, age_thresholds=None):
         self.data_dir = data_dir
         self.mean = mean
         self.std = std
         self.val_ratio = val_ratio
+        self.packed_dir = packed_dir
+        if age_thresholds is not None:
+            self.age_thresholds = tuple(age_thresholds)
 
         self.transform = None
+        self.draft_size = None
+        self.prefix_cache = None
+        self.byte_cache = None
         self.setup()
+        if decoder is not None:
+            self.set_decoder(decoder)
         self.calc_statistics()
+        self.packed = PackedImages(packed_dir, self.image_paths) if packed_dir is not None else None
 
     def setup(self):
-        profiles = os.listdir(self.data_dir)
-        for profile in profiles:
-            if profile.startswith("."):
-                continue
-
-            img_folder = os.path.join(self.data_dir, profile)
-            for file_name in os.listdir(img_folder):
-                _file_name, ext = os.path.splitext(file_name)
-                if _file_name not in self._file_names:
-                    continue
+        index = load_profile_index(self.data_dir)
+        rows = np.flatnonzero(np.isin(index["stem"], list(self._file_names)))  # invalid 한 파일은 무시합니다
+        _assign_samples(self, index, rows)
 
-                img_path = os.path.join(self.data_dir, profile, file_name)
-
-                id, gender, race, age = profile.split("_")
-                gender_label = GenderLabels.from_str(gender)
-                age_label = AgeLabels.from_number(age)
-
-                self.image_paths.append(img_path)
-                self.mask_labels.append(mask_label)
-                self.gender_labels.append(gender_label)
-                self.age_labels.append(age_label)
-
-    def calc_statistics(self):
+    def calc_statistics(self, num_samples=None, seed=42):
         has_statistics = self.mean is not None and self.std is not None
         if not has_statistics:
-            print(
-                "[Warning] Calculating statistics... It can take a long time depending on your CPU machine")
-            sums = []
-            squared = []
-            for image_path in self.image_paths[:3000]:
-                image = np.array(Image.open(image_path)).astype(np.int32)
-                sums.append(image.mean(axis=(0, 1)))
-                squared.append((image ** 2).mean(axis=(0, 1)))
-
-            self.mean = np.mean(sums, axis=0) / 255
-            self.std = (np.mean(squared, axis=0) - self.mean ** 2) ** 0.5 / 255
+            self.mean, self.std = load_statistics(
+                self.data_dir, self.image_paths, self._statistics_variant, self.image_reader, num_samples, seed,
+                self.index_fingerprint)
+
+    def set_decoder(self, decoder):
+        """decoder: 'pil', 'cv2', 'torchvision' 혹은 'auto' (image_paths 의 format 으로 benchmark 해서 선택)"""
+        decoder = create_decoder(decoder, self.image_paths, self.draft_size)
+        if hasattr(self.image_reader, "decoder"):  # rembg_dataset.MaskedImageReader 는 decode 만 바꿉니다
+            self.image_reader.decoder = decoder
+        else:
+            self.image_reader = decoder
+
+    def set_age_thresholds(self, thresholds):
+        """다시 scan 하지 않고 저장된 나이 (ages) 로 age_labels 만 새로 계산합니다."""
+        self.age_labels = age_labels_of(self.ages, thresholds)
+        self.age_thresholds = tuple(thresholds)
 
     def set_transform(self, transform):
         self.transform = transform
+        self.draft_size = getattr(transform, "draft_size", None)
+        if self.prefix_cache is not None:
+            self.prefix_cache.reset(repr(getattr(transform, "prefix", None)))
+
+    def enable_prefix_cache(self, max_bytes, cache_dir=None):
+        """
+        transform 의 deterministic prefix 결과를 sample 별로 cache 합니다. (PrefixCache 참고)
+        max_bytes 는 DataLoader worker 하나의 한도이고, cache_dir 을 준 디스크 cache 만 worker 간에 공유됩니다.
+        """
+        self.prefix_cache = PrefixCache(max_bytes, cache_dir)
+        self.prefix_cache.reset(repr(getattr(self.transform, "prefix", None)))
+
+    def enable_byte_cache(self, max_bytes, num_threads=8):
+        """파일 내용을 worker 들이 공유하는 RAM 에 cache 하고 background 로 미리 읽습니다. (ByteCache 참고)"""
+        self.byte_cache = ByteCache(self.image_paths, max_bytes)
+        self.byte_cache.start_read_ahead(num_threads)
+
+    def transform_image(self, index):
+        prefix = getattr(self.transform, "prefix", None)
+        if self.prefix_cache is None or prefix is None:
+            return self.transform(self.read_image(index))
+
+        image = self.prefix_cache.get(index)
+        if image is None:
+            image = np.asarray(prefix(self.read_image(index)))
+            self.prefix_cache.put(index, image)
+        return self.transform.suffix(Image.fromarray(image))
 
     def __getitem__(self, index):
         assert self.transform is not None, ".set_tranform 메소?���? ?��?��?��?�� transform ?�� 주입?��주세?��"
 
-        image = self.read_image(index)
         mask_label = self.get_mask_label(index)
         gender_label = self.get_gender_label(index)
         age_label = self.get_age_label(index)
         multi_class_label = self.encode_multi_class(
             mask_label, gender_label, age_label)
 
-        image_transform = self.transform(image)
+        image_transform = self.transform_image(index)
         return image_transform, multi_class_label
 
     def __len__(self):
         return len(self.image_paths)
 
     def get_mask_label(self, index) -> MaskLabels:
-        return self.mask_labels[index]
+        return MaskLabels(int(self.mask_labels[index]))
 
     def get_gender_label(self, index) -> GenderLabels:
-        return self.gender_labels[index]
+        return GenderLabels(int(self.gender_labels[index]))
 
     def get_age_label(self, index) -> AgeLabels:
-        return self.age_labels[index]
+        return AgeLabels(int(self.age_labels[index]))
 
     def read_image(self, index):
-        image_path = self.image_paths[index]
-        return Image.open(image_path)
+        if self.packed is not None:
+            return self.packed[index]
+        if self.byte_cache is not None and hasattr(self.image_reader, "decode"):
+            return self.image_reader.decode(self.byte_cache.load(index), self.draft_size)
+        return self.image_reader(self.image_paths[index], self.draft_size)
 
     @staticmethod
     def encode_multi_class(mask_label, gender_label, age_label) -> int:
         return mask_label * 6 + gender_label * 3 + age_label
 
+    def multi_class_labels(self) -> np.ndarray:
+        """전체 sample 의 18 class label 을 한 번에 계산합니다."""
+        return self.encode_multi_class(
+            self.mask_labels.astype(np.int64), self.gender_labels.astype(np.int64), self.age_labels.astype(np.int64))
+
     @staticmethod
     def decode_multi_class(multi_class_label) -> Tuple[MaskLabels, GenderLabels, AgeLabels]:
         mask_label = (multi_class_label // 6) % 3
@@ -257,95 +1134,123 @@ class MaskMultiLabelDataset(Dataset):
         "normal5": MaskLabels.NORMAL,
     }
 
-    image_paths = []
-    mask_labels = []
-    gender_labels = []
-    age_labels = []
+    age_thresholds = AGE_THRESHOLDS
+    _statistics_variant = "default"
+    image_reader = open_image
 
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
+    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2, packed_dir=None,
+                 decoder=None, age_thresholds=None):
         self.data_dir = data_dir
         self.mean = mean
         self.std = std
         self.val_ratio = val_ratio
+        self.packed_dir = packed_dir
+        if age_thresholds is not None:
+            self.age_thresholds = tuple(age_thresholds)
 
         self.transform = None
+        self.draft_size = None
+        self.prefix_cache = None
+        self.byte_cache = None
         self.setup()
+        if decoder is not None:
+            self.set_decoder(decoder)
         self.calc_statistics()
+        self.packed = PackedImages(packed_dir, self.image_paths) if packed_dir is not None else None
 
     def setup(self):
-        profiles = os.listdir(self.data_dir)
-        for profile in profiles:
-            if profile.startswith("."):  # "." �? ?��?��?��?�� ?��?��??? 무시?��?��?��
-                continue
-
-            img_folder = os.path.join(self.data_dir, profile)
-            for file_name in os.listdir(img_folder):
-                _file_name, ext = os.path.splitext(file_name)
-                if _file_name not in self._file_names:  # "." �? ?��?��?��?�� ?��?�� �? invalid ?�� ?��?��?��??? 무시?��?��?��
-                    continue
+        index = load_profile_index(self.data_dir)
+        rows = np.flatnonzero(np.isin(index["stem"], list(self._file_names)))  # invalid 한 파일은 무시합니다
+        _assign_samples(self, index, rows)
 
-                # (resized_data, 000004_male_Asian_54, mask1.jpg)
-                img_path = os.path.join(self.data_dir, profile, file_name)
-                mask_label = self._file_names[_file_name]
-
-                id, gender, race, age = profile.split("_")
-                gender_label = GenderLabels.from_str(gender)
-                age_label = AgeLabels.from_number(age)
-
-                self.image_paths.append(img_path)
-                self.mask_labels.append(mask_label)
-                self.gender_labels.append(gender_label)
-                self.age_labels.append(age_label)
-
-    def calc_statistics(self):
+    def calc_statistics(self, num_samples=None, seed=42):
         has_statistics = self.mean is not None and self.std is not None
         if not has_statistics:
-            print(
-                "[Warning] Calculating statistics... It can take a long time depending on your CPU machine")
-            sums = []
-            squared = []
-            for image_path in self.image_paths[:3000]:
-                image = np.array(Image.open(image_path)).astype(np.int32)
-                sums.append(image.mean(axis=(0, 1)))
-                squared.append((image ** 2).mean(axis=(0, 1)))
-
-            self.mean = np.mean(sums, axis=0) / 255
-            self.std = (np.mean(squared, axis=0) - self.mean ** 2) ** 0.5 / 255
+            self.mean, self.std = load_statistics(
+                self.data_dir, self.image_paths, self._statistics_variant, self.image_reader, num_samples, seed,
+                self.index_fingerprint)
+
+    def set_decoder(self, decoder):
+        """decoder: 'pil', 'cv2', 'torchvision' 혹은 'auto' (image_paths 의 format 으로 benchmark 해서 선택)"""
+        decoder = create_decoder(decoder, self.image_paths, self.draft_size)
+        if hasattr(self.image_reader, "decoder"):  # rembg_dataset.MaskedImageReader 는 decode 만 바꿉니다
+            self.image_reader.decoder = decoder
+        else:
+            self.image_reader = decoder
+
+    def set_age_thresholds(self, thresholds):
+        """다시 scan 하지 않고 저장된 나이 (ages) 로 age_labels 만 새로 계산합니다."""
+        self.age_labels = age_labels_of(self.ages, thresholds)
+        self.age_thresholds = tuple(thresholds)
 
     def set_transform(self, transform):
         self.transform = transform
+        self.draft_size = getattr(transform, "draft_size", None)
+        if self.prefix_cache is not None:
+            self.prefix_cache.reset(repr(getattr(transform, "prefix", None)))
+
+    def enable_prefix_cache(self, max_bytes, cache_dir=None):
+        """
+        transform 의 deterministic prefix 결과를 sample 별로 cache 합니다. (PrefixCache 참고)
+        max_bytes 는 DataLoader worker 하나의 한도이고, cache_dir 을 준 디스크 cache 만 worker 간에 공유됩니다.
+        """
+        self.prefix_cache = PrefixCache(max_bytes, cache_dir)
+        self.prefix_cache.reset(repr(getattr(self.transform, "prefix", None)))
+
+    def enable_byte_cache(self, max_bytes, num_threads=8):
+        """파일 내용을 worker 들이 공유하는 RAM 에 cache 하고 background 로 미리 읽습니다. (ByteCache 참고)"""
+        self.byte_cache = ByteCache(self.image_paths, max_bytes)
+        self.byte_cache.start_read_ahead(num_threads)
+
+    def transform_image(self, index):
+        prefix = getattr(self.transform, "prefix", None)
+        if self.prefix_cache is None or prefix is None:
+            return self.transform(self.read_image(index))
+
+        image = self.prefix_cache.get(index)
+        if image is None:
+            image = np.asarray(prefix(self.read_image(index)))
+            self.prefix_cache.put(index, image)
+        return self.transform.suffix(Image.fromarray(image))
 
     def __getitem__(self, index):
         assert self.transform is not None, ".set_tranform 메소?���? ?��?��?��?�� transform ?�� 주입?��주세?��"
-        image = self.read_image(index)
         mask_label = self.get_mask_label(index)
         gender_label = self.get_gender_label(index)
         age_label = self.get_age_label(index)
 #         multi_class_label = self.encode_multi_class(mask_label, gender_label, age_label)
 
-        image_transform = self.transform(image)
+        image_transform = self.transform_image(index)
         return image_transform, (mask_label, gender_label, age_label)
 
     def __len__(self):
         return len(self.image_paths)
 
     def get_mask_label(self, index) -> MaskLabels:
-        return self.mask_labels[index]
+        return MaskLabels(int(self.mask_labels[index]))
 
     def get_gender_label(self, index) -> GenderLabels:
-        return self.gender_labels[index]
+        return GenderLabels(int(self.gender_labels[index]))
 
     def get_age_label(self, index) -> AgeLabels:
-        return self.age_labels[index]
+        return AgeLabels(int(self.age_labels[index]))
 
     def read_image(self, index):
-        image_path = self.image_paths[index]
-        return Image.open(image_path)
+        if self.packed is not None:
+            return self.packed[index]
+        if self.byte_cache is not None and hasattr(self.image_reader, "decode"):
+            return self.image_reader.decode(self.byte_cache.load(index), self.draft_size)
+        return self.image_reader(self.image_paths[index], self.draft_size)
 
     @staticmethod
     def encode_multi_class(mask_label, gender_label, age_label) -> int:
         return mask_label * 6 + gender_label * 3 + age_label
 
+    def multi_class_labels(self) -> np.ndarray:
+        """전체 sample 의 18 class label 을 한 번에 계산합니다."""
+        return self.encode_multi_class(
+            self.mask_labels.astype(np.int64), self.gender_labels.astype(np.int64), self.age_labels.astype(np.int64))
+
     @staticmethod
     def decode_multi_class(multi_class_label) -> Tuple[MaskLabels, GenderLabels, AgeLabels]:
         mask_label = (multi_class_label // 6) % 3
@@ -381,9 +1286,10 @@ class MaskSplitByProfileDataset(MaskBaseDataset):
         이후 Subset 으로 dataset 을 분기
     """
     # def __init__(self, data_dir, mean=(0.47237855, 0.42983933, 0.40898423), std=(0.24123258, 0.24687928, 0.49184509), val_ratio=0.2):
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
+    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2, packed_dir=None,
+                 decoder=None, age_thresholds=None):
         self.indices = defaultdict(list)
-        super().__init__(data_dir, mean, std, val_ratio)
+        super().__init__(data_dir, mean, std, val_ratio, packed_dir, decoder, age_thresholds)
 
     @staticmethod
     def _split_profile(profiles, val_ratio):
@@ -398,49 +1304,140 @@ class MaskSplitByProfileDataset(MaskBaseDataset):
         }
 
     def setup(self):
-        profiles = os.listdir(self.data_dir)
-        profiles = [profile for profile in profiles if not profile.startswith(".")]
+        index = load_profile_index(self.data_dir)
+        profiles = index["profiles"].tolist()
         split_profiles = self._split_profile(profiles, self.val_ratio)
-        under_sampling = list(range(18, 30)) + list(range(48, 60))
 
-        cnt = 0
+        rows_of = defaultdict(list)
+        valid = np.isin(index["stem"], list(self._file_names))  # invalid 한 파일 무시
+        for row in np.flatnonzero(valid).tolist():
+            rows_of[int(index["profile_idx"][row])].append(row)
+
+        order = []
         for phase, indices in split_profiles.items():
             for _idx in indices:
-                profile = profiles[_idx]
-                img_folder = os.path.join(self.data_dir, profile)
+                rows = rows_of[_idx]
+                # 나이별 undersampling 은 scan 이 아니라 sampler.UnderSampler 에서 epoch 마다 합니다.
+                self.indices[phase].extend(range(len(order), len(order) + len(rows)))
+                order.extend(rows)
 
-                id, gender, race, age = profile.split("_")
-                img_list = os.listdir(img_folder)
-                if int(age) in under_sampling and phase == "train":
-                    img_list = set(img_list) - set(random.sample(img_list[1:6], k=4))
+        _assign_samples(self, index, order)
 
-                for file_name in os.listdir(img_folder):
-                    _file_name, ext = os.path.splitext(file_name)
-                    if _file_name not in self._file_names:  # invalid 한 파일 무시
-                        continue
+    def split_dataset(self) -> List[Subset]:
+        return [Subset(self, indices) for phase, indices in self.indices.items()]
 
-                    img_path = os.path.join(self.data_dir, profile, file_name)
-                    mask_label = self._file_names[_file_name]
 
-                    id, gender, race, age = profile.split("_")
-                    gender_label = GenderLabels.from_str(gender)
-                    age_label = AgeLabels.from_number(age)
+# data_gen.py 의 offline augmentation 을 torchvision 으로 옮긴 것 (ShiftScaleRotate 는 RandomAffine 으로 대체)
+VIRTUAL_COPY_TRANSFORM = Compose([
+    RandomAffine(degrees=45, translate=(0.0625, 0.0625), scale=(0.9, 1.1)),
+    RandomHorizontalFlip(p=0.5),
+    ColorJitter(0.1, 0.1, 0.1, 0.1),
+    ColorJitter(brightness=0.3, contrast=0.3),
+])
 
-                    self.image_paths.append(img_path)
-                    self.mask_labels.append(mask_label)
-                    self.gender_labels.append(gender_label)
-                    self.age_labels.append(age_label)
 
-                    self.indices[phase].append(cnt)
-                    cnt += 1
+def _assign_virtual_samples(dataset, index):
+    """
+    profile 마다 원본 7장 (mask1~5, incorrect_mask, normal) 만 index 하고, mask 종류별
+    _repeat_factors 만큼 같은 파일을 반복해서 sample 로 넣습니다.
+    virtual_copy 가 0 이면 원본, 1 이상이면 load 할 때 VIRTUAL_COPY_TRANSFORM 을 적용할 가상 사본입니다.
+    """
+    rows = np.flatnonzero(np.isin(index["stem"], list(dataset._original_file_names)))
+    repeat_of_mask = np.zeros(len(MaskLabels), dtype=np.int64)
+    for mask_label, repeat in dataset._repeat_factors.items():
+        repeat_of_mask[mask_label] = repeat
+    repeats = repeat_of_mask[index["mask"][rows]]
+
+    copy_rows = np.repeat(rows, repeats)
+    starts = np.cumsum(repeats) - repeats
+    dataset.virtual_copy = (np.arange(len(copy_rows)) - np.repeat(starts, repeats)).astype(np.int8)
+    _assign_samples(dataset, index, copy_rows)
 
-    def split_dataset(self) -> List[Subset]:
-        return [Subset(self, indices) for phase, indices in self.indices.items()]
+
+def _split_virtual_samples(dataset):
+    """
+    random_split 처럼 val_ratio 만큼 나누되 원본 이미지 단위로 나눕니다.
+    가상 사본은 train 에만 들어가고 val 은 augmentation 없는 원본만 한 번씩 갖습니다.
+    (val 로 간 원본의 사본은 train 에도 넣지 않습니다)
+    """
+    is_original = dataset.virtual_copy == 0
+    source_of = np.cumsum(is_original) - 1  # sample 별 원본 번호, 사본은 원본 바로 뒤에 붙어 있음
+    num_sources = int(is_original.sum())
+    n_val = int(num_sources * dataset.val_ratio)
+    val_sources = np.zeros(num_sources, dtype=bool)
+    val_sources[torch.randperm(num_sources)[:n_val].numpy()] = True
+
+    in_val = val_sources[source_of]
+    train_idx = np.flatnonzero(~in_val)
+    val_idx = np.flatnonzero(in_val & is_original)
+    return Subset(dataset, train_idx.tolist()), Subset(dataset, val_idx.tolist())
+
+
+class MaskVirtualDataset(MaskBaseDataset):
+    """
+        data_gen.py 로 만든 normal2~5, incorrect_mask2~5 를 디스크에서 읽는 대신
+        원본 normal / incorrect_mask 를 5번씩 반복하고 load 할 때 random augmentation 을 적용합니다.
+        class 비율은 images_gen 과 같고, data_dir 에는 원본 7장만 있으면 됩니다.
+        split_dataset 의 val 에는 가상 사본을 넣지 않습니다.
+    """
+    _original_file_names = {
+        "mask1": MaskLabels.MASK,
+        "mask2": MaskLabels.MASK,
+        "mask3": MaskLabels.MASK,
+        "mask4": MaskLabels.MASK,
+        "mask5": MaskLabels.MASK,
+        "incorrect_mask": MaskLabels.INCORRECT,
+        "normal": MaskLabels.NORMAL,
+    }
+    _repeat_factors = {
+        MaskLabels.MASK: 1,
+        MaskLabels.INCORRECT: 5,
+        MaskLabels.NORMAL: 5,
+    }
+    virtual_transform = VIRTUAL_COPY_TRANSFORM
+
+    def setup(self):
+        _assign_virtual_samples(self, load_profile_index(self.data_dir))
+
+    def transform_image(self, index):
+        if self.virtual_copy[index] == 0:
+            return super().transform_image(index)
+        # 가상 사본은 매번 다른 이미지이므로 prefix cache 를 쓰지 않습니다.
+        return self.transform(self.virtual_transform(self.read_image(index)))
+
+    def split_dataset(self) -> Tuple[Subset, Subset]:
+        return _split_virtual_samples(self)
+
+
+class MaskVirtualMultiLabelDataset(MaskMultiLabelDataset):
+    _original_file_names = MaskVirtualDataset._original_file_names
+    _repeat_factors = MaskVirtualDataset._repeat_factors
+    virtual_transform = VIRTUAL_COPY_TRANSFORM
+
+    def setup(self):
+        _assign_virtual_samples(self, load_profile_index(self.data_dir))
+
+    def transform_image(self, index):
+        if self.virtual_copy[index] == 0:
+            return super().transform_image(index)
+        return self.transform(self.virtual_transform(self.read_image(index)))
+
+    def split_dataset(self) -> Tuple[Subset, Subset]:
+        return _split_virtual_samples(self)
 
 
 class TestDataset(Dataset):
-    def __init__(self, img_paths, resize, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246)):
+    image_reader = open_image
+
+    def __init__(self, img_paths, resize, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), decoder=None):
         self.img_paths = img_paths
+        self.draft_size = draft_size_of(resize)
+        if decoder is not None:
+            decoder = create_decoder(decoder, img_paths, self.draft_size)
+            if hasattr(self.image_reader, "decoder"):
+                self.image_reader.decoder = decoder
+            else:
+                self.image_reader = decoder
         self.transform = Compose([
             Resize(resize, Image.BILINEAR),
             ToTensor(),
@@ -448,7 +1445,7 @@ class TestDataset(Dataset):
         ])
 
     def __getitem__(self, index):
-        image = Image.open(self.img_paths[index])
+        image = self.image_reader(self.img_paths[index], self.draft_size)
 
         if self.transform:
             image = self.transform(image)
@@ -456,3 +1453,150 @@ class TestDataset(Dataset):
 
     def __len__(self):
         return len(self.img_paths)
+
+
+class StreamingTestDataset(IterableDataset):
+    """
+    info.csv 를 chunksize 행씩 읽으면서 (image, 행 번호) 를 generator 로 넘겨주는 TestDataset.
+    전체 경로 list 를 만들지 않으므로 eval set 크기와 관계없이 memory 가 일정합니다.
+
+    start 행부터 시작하고 (이어서 inference 할 때), DataLoader worker 들은 block_size 행씩 번갈아 맡습니다.
+    block_size 를 batch_size 와 같게 두면 DataLoader 가 돌려주는 batch 순서가 info.csv 순서와 같습니다.
+    """
+    image_reader = open_image
+
+    def __init__(self, info_path, img_root, resize, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246),
+                 start=0, chunksize=10000, block_size=1):
+        self.info_path = info_path
+        self.img_root = img_root
+        self.start = start
+        self.chunksize = chunksize
+        self.block_size = block_size
+        self.draft_size = draft_size_of(resize)
+        self.transform = Compose([
+            Resize(resize, Image.BILINEAR),
+            ToTensor(),
+            Normalize(mean=mean, std=std),
+        ])
+
+    def image_ids(self):
+        row = self.start
+        chunks = pd.read_csv(self.info_path, usecols=["ImageID"], chunksize=self.chunksize,
+                             skiprows=range(1, self.start + 1))
+        for chunk in chunks:
+            for image_id in chunk["ImageID"].tolist():
+                yield row, image_id
+                row += 1
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        for row, image_id in self.image_ids():
+            if (row - self.start) // self.block_size % num_workers != worker_id:
+                continue
+            image = self.image_reader(os.path.join(self.img_root, image_id), self.draft_size)
+            yield self.transform(image), row
+
+
+def compact_collate(batch):
+    """
+    (image, label) sample 들을 (B, C, H, W) image 와 int8 label tensor 하나로 묶는 collate_fn.
+
+    label 이 (mask, gender, age) 이면 [B, 3], 18 class 하나면 [B] 입니다. (DeviceLoader 가 device 에서 int64 로 풀어줍니다)
+    default_collate 처럼 label 자리마다 Python 으로 tensor 를 만들지 않고, DataLoader worker 안에서는
+    image batch 를 shared memory 에 미리 잡아두고 그 안에 바로 stack 하므로 main process 로 넘길 때 복사가 없습니다.
+    """
+    images, labels = zip(*batch)
+    first = images[0]
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        numel = len(images) * first.numel()
+        storage = first._typed_storage()._new_shared(numel, device=first.device)
+        out = first.new(storage).resize_(len(images), *first.shape)
+    return torch.stack(images, 0, out=out), torch.tensor(labels, dtype=torch.int8)
+
+
+def create_dataloader(dataset, batch_size, num_workers, **kwargs):
+    """
+    모든 학습 / inference / benchmark DataLoader 를 만드는 곳.
+    GPU 로 보낼 batch 는 pinned memory 에 만들어야 non_blocking 복사가 가능하고,
+    worker 는 epoch 마다 다시 띄우지 않도록 persistent 로 둡니다. (num_workers=0 이면 DataLoader 가 persistent_workers 를 거부함)
+    """
+    kwargs.setdefault('pin_memory', torch.cuda.is_available())
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        **kwargs,
+    )
+
+
+class DeviceLoader:
+    """
+    DataLoader 를 감싸서 batch 를 device 로 옮겨서 돌려줍니다.
+
+    CUDA 에서는 다음 batch 의 복사를 별도 stream 에 non_blocking 으로 먼저 걸어두고 현재 batch 를 넘겨주므로,
+    host -> device 복사가 현재 step 의 연산과 겹쳐서 step 시간에 포함되지 않습니다.
+    multi-label (mask, gender, age) label 은 [B, 3] tensor 하나로 묶어서 한 번에 복사한 뒤 다시 나눠줍니다.
+    compact_collate 의 int8 label 은 그대로 복사하고 device 에서 int64 로 바꿉니다.
+    복사가 실제로 비동기가 되려면 DataLoader 를 pin_memory=True 로 만들어야 합니다.
+    memory_format=torch.channels_last 면 image 를 device 로 옮기면서 channels_last 로 바꿉니다.
+    """
+    def __init__(self, loader, device, memory_format=torch.preserve_format):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):  # TestDataset 처럼 image 만 있는 경우
+            return batch.to(self.device, non_blocking=True, memory_format=self.memory_format)
+
+        inputs, labels = batch
+        inputs = inputs.to(self.device, non_blocking=True, memory_format=self.memory_format)
+        if isinstance(labels, (list, tuple)):
+            packed = torch.stack([torch.as_tensor(label) for label in labels], dim=1)
+            if self.device.type == "cuda":
+                packed = packed.pin_memory()
+            return inputs, tuple(packed.to(self.device, non_blocking=True).unbind(1))
+
+        labels = labels.to(self.device, non_blocking=True).long()
+        if labels.dim() == 2:  # compact_collate 의 [B, 3] multi-label
+            labels = tuple(labels.unbind(1))
+        return inputs, labels
+
+    @staticmethod
+    def _record_stream(batch, stream):
+        # copy stream 에서 할당된 tensor 를 compute stream 이 쓰는 동안 allocator 가 재사용하지 않도록 알려줍니다
+        if isinstance(batch, torch.Tensor):
+            tensors = [batch]
+        else:
+            inputs, labels = batch
+            tensors = [inputs, *labels] if isinstance(labels, tuple) else [inputs, labels]
+        for tensor in tensors:
+            tensor.record_stream(stream)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(copy_stream):
+                next_batch = self._to_device(next_batch)
+            if batch is not None:
+                yield batch
+
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_stream(copy_stream)
+            self._record_stream(next_batch, compute_stream)
+            batch = next_batch
+        if batch is not None:
+            yield batch
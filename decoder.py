@@ -0,0 +1,230 @@
+"""
+이미지 파일을 RGB PIL 이미지로 decode 하는 backend 들.
+
+모든 backend 는 (image_path, draft_size=None) 로 호출하거나 decode(data, draft_size=None) 로
+이미 읽어둔 bytes 를 decode 할 수 있고, 결과는 항상 RGB PIL 이미지입니다.
+RGBA 이미지 (e.g. rembg 결과) 는 배경이 검은색이 되도록 RGB * alpha 로 합성합니다.
+
+    decoder = create_decoder('auto', dataset.image_paths)  # 현재 machine / data_dir 에서 가장 빠른 backend
+"""
+import io
+import os
+import random
+import time
+from collections import defaultdict
+
+import numpy as np
+from PIL import Image
+
+# JPEG DCT scaling 으로 줄일 수 있는 배율
+REDUCE_FACTORS = (8, 4, 2)
+
+
+def draft_image(image, size):
+    """
+    JPEG 이면 decoder 에 size (H, W) 보다 작아지지 않는 선에서 1/2, 1/4, 1/8 scale 로
+    decode 하도록 요청합니다 (DCT scaling). PNG 등은 draft 를 지원하지 않아 그대로 full decode 됩니다.
+    """
+    if size is not None and image.format == "JPEG":
+        image.draft(None, (size[1], size[0]))
+    return image
+
+
+def reduce_factor(image_size, draft_size):
+    """(W, H) 이미지를 draft_size (H, W) 보다 작아지지 않게 줄일 수 있는 가장 큰 배율"""
+    if draft_size is None:
+        return 1
+    width, height = image_size
+    for factor in REDUCE_FACTORS:
+        if width // factor >= draft_size[1] and height // factor >= draft_size[0]:
+            return factor
+    return 1
+
+
+def premultiply_alpha(pixels):
+    """(H, W, 4) uint8 -> (H, W, 3) uint8, 투명한 부분을 검은색으로 합성합니다."""
+    rgb = pixels[..., :3].astype(np.uint16)
+    alpha = pixels[..., 3:].astype(np.uint16)
+    return ((rgb * alpha + 127) // 255).astype(np.uint8)
+
+
+def _to_rgb_image(pixels):
+    """(H, W), (H, W, 1), (H, W, 3), (H, W, 4) uint8 배열을 RGB PIL 이미지로 만듭니다."""
+    if pixels.ndim == 2:
+        pixels = pixels[..., None]
+    if pixels.shape[2] == 4:
+        pixels = premultiply_alpha(pixels)
+    elif pixels.shape[2] == 1:
+        pixels = np.repeat(pixels, 3, axis=2)
+    return Image.fromarray(np.ascontiguousarray(pixels))
+
+
+class Decoder:
+    name = None
+
+    def __call__(self, image_path, draft_size=None):
+        with open(image_path, "rb") as f:
+            return self.decode(f.read(), draft_size)
+
+    def decode(self, data, draft_size=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class PILDecoder(Decoder):
+    name = "pil"
+
+    def __call__(self, image_path, draft_size=None):
+        # 파일에서 바로 읽으면 bytes 를 한 번 더 복사하지 않아도 됩니다.
+        return self._convert(draft_image(Image.open(image_path), draft_size))
+
+    def decode(self, data, draft_size=None):
+        return self._convert(draft_image(Image.open(io.BytesIO(data)), draft_size))
+
+    @staticmethod
+    def _convert(image):
+        if image.mode == "RGB":
+            return image
+        if image.mode in ("RGBA", "LA", "PA", "P"):
+            return _to_rgb_image(np.asarray(image.convert("RGBA")))
+        return image.convert("RGB")
+
+
+class CV2Decoder(Decoder):
+    name = "cv2"
+
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        self.reduced_flags = {
+            2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8,
+        }
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def decode(self, data, draft_size=None):
+        cv2 = self.cv2
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        flag = cv2.IMREAD_UNCHANGED
+        if draft_size is not None and data[:2] == b"\xff\xd8":  # JPEG 은 alpha 가 없으므로 축소 decode
+            factor = reduce_factor(Image.open(io.BytesIO(data)).size, draft_size)  # header 만 읽음
+            flag = self.reduced_flags.get(factor, flag)
+        pixels = cv2.imdecode(buffer, flag)
+        if pixels is None:
+            raise ValueError("cv2 could not decode the image")
+        if pixels.ndim == 3:
+            code = cv2.COLOR_BGRA2RGBA if pixels.shape[2] == 4 else cv2.COLOR_BGR2RGB
+            pixels = cv2.cvtColor(pixels, code)
+        return _to_rgb_image(pixels)
+
+
+class TorchvisionDecoder(Decoder):
+    """torchvision.io.decode_image (libjpeg-turbo / libpng), JPEG 축소 decode 는 지원하지 않습니다."""
+    name = "torchvision"
+
+    def __init__(self):
+        import torch
+        from torchvision.io import decode_image, ImageReadMode
+        self.torch = torch
+        self._decode_image = decode_image
+        self._mode = ImageReadMode.UNCHANGED
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def decode(self, data, draft_size=None):
+        torch = self.torch
+        image = self._decode_image(torch.frombuffer(bytearray(data), dtype=torch.uint8), self._mode)
+        if image.shape[0] in (2, 4):  # alpha 가 있으면 (C, H, W) 그대로 검은 배경에 합성
+            color, alpha = image[:-1].to(torch.int32), image[-1:]
+            image = ((color * alpha + 127) // 255).to(torch.uint8)
+        return _to_rgb_image(image.permute(1, 2, 0).numpy())
+
+
+_decoder_entrypoints = {
+    'pil': PILDecoder,
+    'cv2': CV2Decoder,
+    'torchvision': TorchvisionDecoder,
+}
+
+
+def decoder_entrypoint(decoder_name):
+    return _decoder_entrypoints[decoder_name]
+
+
+def is_decoder(decoder_name):
+    return decoder_name in _decoder_entrypoints
+
+
+def available_decoders():
+    """import 가능한 backend 만 생성해서 돌려줍니다."""
+    decoders = {}
+    for name, create_fn in _decoder_entrypoints.items():
+        try:
+            decoders[name] = create_fn()
+        except ImportError:
+            continue
+    return decoders
+
+
+def benchmark_decoders(image_paths, draft_size=None, num_samples=16, repeat=3, seed=42):
+    """
+    image_paths 에 있는 확장자 별로 최대 num_samples 장씩 메모리에 올려두고 각 backend 의 decode 시간을 잽니다.
+    확장자 별 평균 시간에 그 확장자의 파일 수를 곱해서 data_dir 전체를 decode 하는 예상 시간 (초) 을 돌려줍니다.
+    """
+    paths_of = defaultdict(list)
+    for path in image_paths:
+        paths_of[os.path.splitext(path)[1].lower()].append(path)
+
+    rng = random.Random(seed)
+    samples = {}
+    for ext, paths in paths_of.items():
+        chosen = rng.sample(paths, min(num_samples, len(paths)))
+        samples[ext] = []
+        for path in chosen:
+            with open(path, "rb") as f:
+                samples[ext].append(f.read())
+
+    results = {}
+    for name, decoder in available_decoders().items():
+        total = 0.
+        try:
+            for ext, datas in samples.items():
+                decoder.decode(datas[0], draft_size).load()  # warm up
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    for data in datas:
+                        decoder.decode(data, draft_size).load()  # PIL 은 lazy 하므로 load 까지 측정
+                total += (time.perf_counter() - start) / (repeat * len(datas)) * len(paths_of[ext])
+        except Exception as e:  # 특정 format 을 못 읽는 backend 는 제외
+            print(f"[Warning] decoder {name} failed during benchmark: {e}")
+            continue
+        results[name] = total
+    return results
+
+
+def create_decoder(decoder_name, image_paths=None, draft_size=None):
+    """decoder_name 이 'auto' 이면 image_paths 로 benchmark 해서 가장 빠른 backend 를 고릅니다."""
+    if decoder_name == 'auto':
+        results = benchmark_decoders(list(image_paths or []), draft_size)
+        decoder_name = min(results, key=results.get) if results else 'pil'
+        print("Decoder benchmark: " + ", ".join(f"{name} {sec:.2f}s" for name, sec in results.items())
+              + f" -> {decoder_name}")
+
+    if is_decoder(decoder_name):
+        create_fn = decoder_entrypoint(decoder_name)
+        decoder = create_fn()
+    else:
+        raise RuntimeError('Unknown decoder (%s)' % decoder_name)
+    return decoder
@@ -0,0 +1,134 @@
+"""
+model.py 의 model 을 eager 대신 compile 된 graph 로 실행하는 --execution 옵션.
+
+    eager       : 기존처럼 python 에서 module 을 그대로 실행
+    compile     : torch.compile (inductor), 학습 / inference 모두 사용 가능.
+                  compile 결과는 COMPILE_CACHE_DIR 에 저장되어 다음 실행 (다음 fold, 다음 trial) 에서 재사용됩니다.
+    torchscript : torch.jit.trace -> freeze -> optimize_for_inference 한 graph, weight 가 상수로 고정되므로 inference 전용
+
+--memory_format channels_last 는 model 과 모든 input batch 를 channels_last 로 맞춥니다.
+model 은 compile 전에 바꾸고 (create_model), batch 는 device 로 옮길 때 (DeviceLoader) 한 번만 바꾸며,
+layout 을 바꾸는 augmentation / TTA view 뒤에서는 명시적으로 다시 맞춥니다.
+
+compile_model 은 example_inputs 로 warm-up (compile / profiling) 을 미리 끝내고,
+compile 이나 warm-up 이 실패하는 model 은 경고만 출력하고 원래 (eager) model 을 돌려줍니다.
+
+    model = compile_model(model, 'compile', torch.zeros(batch_size, 3, *resize, device=device), amp, train=True)
+"""
+import os
+import time
+
+import torch
+
+from precision import autocast
+
+EXECUTION_MODES = ('eager', 'compile', 'torchscript')
+TRAIN_EXECUTION_MODES = ('eager', 'compile')
+# --memory_format: channels_last (NHWC) 는 oneDNN CPU convolution / tensor core 에서 빠른 layout
+MEMORY_FORMATS = {
+    'contiguous': torch.contiguous_format,
+    'channels_last': torch.channels_last,
+}
+COMPILE_CACHE_DIR = os.environ.get(
+    'TORCHINDUCTOR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'mask_classification', 'inductor'))
+
+
+def enable_compile_cache(cache_dir=COMPILE_CACHE_DIR):
+    """inductor 의 FX graph / autograd cache 를 cache_dir 에 저장해서 process 가 바뀌어도 재사용하게 합니다."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    import torch._functorch.config as functorch_config
+    if hasattr(functorch_config, 'enable_autograd_cache'):
+        functorch_config.enable_autograd_cache = True
+
+
+@torch.no_grad()
+def _snapshot_buffers(model):
+    return [buffer.clone() for buffer in model.buffers()]
+
+
+@torch.no_grad()
+def _restore_buffers(model, buffers):
+    for buffer, saved in zip(model.buffers(), buffers):
+        buffer.copy_(saved)
+
+
+def warm_up(model, example_inputs, amp='off', train=False, steps=2):
+    """
+    compile (torch.compile) / profiling (TorchScript) 을 첫 batch 전에 끝내기 위해 example_inputs 로 미리 실행합니다.
+    train 이면 train mode 의 forward + backward 도 실행하고, 그 동안 바뀐 gradient / BatchNorm running stat /
+    dropout 난수 상태는 원래대로 돌려놓기 때문에 학습 결과에는 영향이 없습니다.
+
+    Returns:
+        float: warm-up 에 걸린 시간 (초)
+    """
+    device = example_inputs.device
+    was_training = getattr(model, 'training', None)  # freeze 된 TorchScript module 은 train / eval mode 가 없음
+    buffers = _snapshot_buffers(model)
+    start = time.perf_counter()
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        if train:
+            model.train()
+            for _ in range(steps):
+                with autocast(device, amp):
+                    outs = model(example_inputs)
+                outs.float().mean().backward()
+            model.zero_grad(set_to_none=True)
+        if was_training is not None:
+            model.eval()
+        with torch.no_grad():
+            for _ in range(steps):
+                with autocast(device, amp):
+                    model(example_inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    _restore_buffers(model, buffers)
+    if was_training is not None:
+        model.train(was_training)
+    return elapsed
+
+
+def _trace(model, example_inputs, amp):
+    model.eval()
+    with torch.no_grad(), autocast(example_inputs.device, amp, cache_enabled=False):
+        traced = torch.jit.trace(model, example_inputs)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+def compile_model(model, execution, example_inputs, amp='off', train=False):
+    """
+    Args:
+        execution (str): 'eager' / 'compile' / 'torchscript' (train=True 이면 'torchscript' 는 사용할 수 없음)
+        example_inputs: warm-up 에 쓸 실제 batch 와 같은 shape / device 의 input
+        amp (str): 학습 / inference 와 같은 autocast 에서 compile 되도록 precision.resolve_amp 결과를 넘겨줍니다
+        train (bool): 학습용이면 backward graph 까지 warm-up
+
+    Returns:
+        compile 된 model, 실패하면 model 그대로
+    """
+    if execution not in EXECUTION_MODES:
+        raise RuntimeError('Unknown execution mode (%s)' % execution)
+    if execution == 'torchscript' and train:
+        raise RuntimeError('TorchScript execution is inference only, use --execution compile for training')
+    if execution == 'eager':
+        return model
+
+    name = type(model).__name__
+    was_training = model.training
+    try:
+        if execution == 'compile':
+            enable_compile_cache()
+            compiled = torch.compile(model)
+        else:
+            compiled = _trace(model, example_inputs, amp)
+        elapsed = warm_up(compiled, example_inputs, amp, train)
+    except Exception as e:  # compile 되지 않는 model 은 eager 로 학습 / inference 합니다
+        print(f"[Warning] {execution} failed for {name}, falling back to eager: {type(e).__name__}: {e}")
+        torch._dynamo.reset()
+        model.train(was_training)
+        return model
+    print(f"{name}: {execution} warm-up done in {elapsed:.1f}s")
+    return compiled
@@ -0,0 +1,117 @@
+"""
+사람(profile) 단위로 나눈 K-fold split 을 만들어서 data_dir 옆에 저장해두고 다시 읽는 모듈.
+
+같은 사람의 사진 7장 (+ 증강 사본) 은 항상 같은 fold 에 들어가고, fold 마다 18 class 비율이 비슷하도록
+StratifiedGroupKFold 로 profile 을 배정합니다. 한 번 만든 split 은
+`.{data_dir 이름}.folds_{dataset}_{n_splits}_{seed}.npz` 에 sample 별 fold 번호로 저장되므로
+skf script 들과 fold 별 worker 들은 같은 split 을 다시 계산하지 않고 읽기만 합니다.
+
+    python folds.py --dataset MaskBaseDataset --n_splits 5 --seed 42   # 미리 만들어두기 (선택)
+"""
+import argparse
+import hashlib
+import os
+from importlib import import_module
+
+import numpy as np
+from sklearn.model_selection import StratifiedGroupKFold
+
+FOLD_MANIFEST_VERSION = 1
+
+
+def fold_manifest_path(data_dir, dataset_name, n_splits, seed):
+    data_dir = os.path.abspath(data_dir)
+    return os.path.join(
+        os.path.dirname(data_dir), f".{os.path.basename(data_dir)}.folds_{dataset_name}_{n_splits}_{seed}.npz")
+
+
+def sample_fingerprint(dataset):
+    """dataset 의 sample 순서 (profile 폴더, 파일 이름) 나 label (e.g. age_thresholds) 이 바뀌었는지 확인하기 위한 hash"""
+    paths = dataset.image_paths
+    digest = hashlib.md5()
+    for array in (paths.dirs, paths.dir_idx, paths.names, paths.name_idx, dataset.multi_class_labels()):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def build_folds(labels, groups, n_splits=5, seed=42):
+    """
+    groups (profile) 를 통째로 fold 에 배정하면서 labels 비율을 맞춥니다.
+
+    Returns:
+        np.ndarray: sample 별 fold 번호 (int8)
+    """
+    folds = np.full(len(labels), -1, dtype=np.int8)
+    splitter = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    for fold, (_, valid_idx) in enumerate(splitter.split(np.zeros(len(labels)), labels, groups)):
+        folds[valid_idx] = fold
+    return folds
+
+
+def load_fold_manifest(dataset, n_splits=5, seed=42):
+    """
+    저장된 fold manifest 를 읽고, 없거나 dataset 의 sample 이 바뀌었으면 새로 만들어서 저장합니다.
+
+    Returns:
+        np.ndarray: dataset index 순서의 sample 별 fold 번호
+    """
+    path = fold_manifest_path(dataset.data_dir, type(dataset).__name__, n_splits, seed)
+    fingerprint = sample_fingerprint(dataset)
+    try:
+        with np.load(path) as f:
+            if int(f["version"]) == FOLD_MANIFEST_VERSION and str(f["fingerprint"]) == fingerprint:
+                return f["folds"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print(f"Building {n_splits} profile-grouped folds (seed: {seed})")
+    folds = build_folds(dataset.multi_class_labels(), dataset.profile_idx, n_splits, seed)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, version=FOLD_MANIFEST_VERSION, fingerprint=fingerprint, folds=folds)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"[Warning] Could not save fold manifest to {path}: {e}")
+    return folds
+
+
+def fold_indices(folds, fold):
+    """fold 번째 fold 를 validation 으로 쓰는 (train_idx, valid_idx)"""
+    return np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+
+def iter_folds(dataset, n_splits=5, seed=42):
+    """
+    StratifiedKFold.split 대신 쓰는 (train_idx, valid_idx) generator.
+    MaskVirtualDataset 의 가상 사본 (random augmentation) 은 validation 에서 빼고 원본만 남깁니다.
+    """
+    folds = load_fold_manifest(dataset, n_splits, seed)
+    virtual_copy = getattr(dataset, "virtual_copy", None)
+    for fold in range(n_splits):
+        train_idx, valid_idx = fold_indices(folds, fold)
+        if virtual_copy is not None:
+            valid_idx = valid_idx[virtual_copy[valid_idx] == 0]
+        yield train_idx, valid_idx
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset', type=str, default='MaskBaseDataset', help='dataset type (default: MaskBaseDataset)')
+    parser.add_argument('--n_splits', type=int, default=5, help='number of folds (default: 5)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: 42)')
+
+    # Container environment
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images'))
+
+    args = parser.parse_args()
+    print(args)
+
+    dataset_module = getattr(import_module("dataset"), args.dataset)  # default: MaskBaseDataset
+    dataset = dataset_module(
+        data_dir=args.data_dir,
+    )
+    folds = load_fold_manifest(dataset, args.n_splits, args.seed)
+    for fold in range(args.n_splits):
+        print(f"fold {fold}: {int((folds == fold).sum())} images")
@@ -5,9 +5,11 @@ from importlib import import_module
 
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader
+import torchvision.transforms.functional as F
 
-from dataset import TestDataset, MaskBaseDataset, MaskMultiLabelDataset
+from dataset import TestDataset, StreamingTestDataset, MaskBaseDataset, MaskMultiLabelDataset, DeviceLoader, create_dataloader
+from execution import EXECUTION_MODES, MEMORY_FORMATS, compile_model
+from precision import AMP_MODES, autocast, resolve_amp
 
 
 def load_model(saved_model, num_classes, device):
@@ -26,6 +28,30 @@ def load_model(saved_model, num_classes, device):
     return model
 
 
+def predict(model, images, amp='off', memory_format=torch.contiguous_format):
+    # 4가지 augmentation에 대하여 예측
+    # flip 은 images 의 layout 을 유지하지만 rotate (grid_sample) 결과는 항상 NCHW 이므로 model 의 layout 으로 다시 맞춥니다.
+    with autocast(images.device, amp):
+        views = [
+            model(images),
+            model(torch.flip(images, dims=(-1,))),
+            model(F.rotate(images, angle=30).contiguous(memory_format=memory_format)),
+            model(F.rotate(images, angle=-30).contiguous(memory_format=memory_format)),
+        ]
+    # bf16 / fp16 출력은 fp32 로 바꿔서 평균을 냅니다.
+    pred = sum(view.float() for view in views) / 4
+
+    (mask_outs, gender_outs, age_outs) = torch.split(
+        pred, [3, 2, 3], dim=1)
+
+    mask_preds = torch.argmax(mask_outs, dim=1)
+    gender_preds = torch.argmax(gender_outs, dim=1)
+    age_preds = torch.argmax(age_outs, dim=1)
+
+    return MaskBaseDataset.encode_multi_class(
+        mask_preds, gender_preds, age_preds)
+
+
 @torch.no_grad()
 def inference(data_dir, model_dir, output_dir, args):
     """
@@ -34,8 +60,13 @@ def inference(data_dir, model_dir, output_dir, args):
     device = torch.device("cuda" if use_cuda else "cpu")
 
     num_classes = MaskMultiLabelDataset.num_classes  # 18
-    model = load_model(model_dir, num_classes, device).to(device)
+    memory_format = MEMORY_FORMATS[args.memory_format]
+    model = load_model(model_dir, num_classes, device).to(device, memory_format=memory_format)
     model.eval()
+    amp = resolve_amp(args.amp, device)
+    # TTA view 는 모두 같은 shape / layout 이므로 batch_size 크기의 input 하나로 warm-up 합니다.
+    example_inputs = torch.zeros(args.batch_size, 3, *args.resize, device=device).contiguous(memory_format=memory_format)
+    model = compile_model(model, args.execution, example_inputs, amp)
 
     img_root = os.path.join(data_dir, 'images')
     info_path = os.path.join(data_dir, 'info.csv')
@@ -43,41 +74,99 @@ def inference(data_dir, model_dir, output_dir, args):
 
     img_paths = [os.path.join(img_root, img_id) for img_id in info.ImageID]
     dataset = TestDataset(img_paths, args.resize)
-    loader = torch.utils.data.DataLoader(
+    loader = create_dataloader(
         dataset,
-        batch_size=args.batch_size,
-        num_workers=multiprocessing.cpu_count() // 2,
+        args.batch_size,
+        multiprocessing.cpu_count() // 2,
         shuffle=False,
-        pin_memory=use_cuda,
         drop_last=False,
     )
 
     print("Calculating inference results..")
     preds = []
     with torch.no_grad():
-        for idx, images in enumerate(loader):
-            images = images.to(device)
+        for idx, images in enumerate(DeviceLoader(loader, device, memory_format)):
+            pred = predict(model, images, amp, memory_format)
+            preds.extend(pred.cpu().numpy())
 
-            # 4 augmentation Ͽ 
-            pred = model(images) / 4
-            pred += model(torch.flip(images, dims=(-1,))) / 4
-            pred += model(F.rotate(images, angle=30)) / 4
-            pred += model(F.rotate(images, angle=-30)) / 4
+    info['ans'] = preds
+    save_path = os.path.join(output_dir, f'output.csv')
+    info.to_csv(save_path, index=False)
+    print(f"Inference Done! Inference result saved at {save_path}")
 
-            (mask_outs, gender_outs, age_outs) = torch.split(
-                pred, [3, 2, 3], dim=1)
 
-            mask_preds = torch.argmax(mask_outs, dim=1)
-            gender_preds = torch.argmax(gender_outs, dim=1)
-            age_preds = torch.argmax(age_outs, dim=1)
+def count_written_rows(save_path):
+    """
+    이전 실행이 남긴 output 의 (header 를 뺀) 완전한 행 수를 셉니다.
+    쓰다가 끊겨서 마지막 줄이 잘렸으면 그 줄은 지웁니다. output 이 없으면 None.
+    """
+    if not os.path.exists(save_path):
+        return None
 
-            pred = MaskBaseDataset.encode_multi_class(
-                mask_preds, gender_preds, age_preds)
-            preds.extend(pred.cpu().numpy())
+    lines, last_newline, offset = 0, 0, 0
+    with open(save_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            if b'\n' in block:
+                last_newline = offset + block.rindex(b'\n') + 1
+            offset += len(block)
+    if last_newline != offset:
+        os.truncate(save_path, last_newline)
+    return max(lines - 1, 0) if last_newline > 0 else None
 
-    info['ans'] = preds
+
+@torch.no_grad()
+def stream_inference(data_dir, model_dir, output_dir, args):
+    """
+    info.csv 를 batch_size 행씩 읽으면서 예측하고 결과를 output.csv 에 바로 이어 씁니다.
+    memory 는 eval set 크기와 관계없이 일정하고, 중간에 끊기면 다시 실행했을 때 이미 쓴 행 다음부터 이어서 합니다.
+    """
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+
+    num_classes = MaskMultiLabelDataset.num_classes  # 18
+    memory_format = MEMORY_FORMATS[args.memory_format]
+    model = load_model(model_dir, num_classes, device).to(device, memory_format=memory_format)
+    model.eval()
+    amp = resolve_amp(args.amp, device)
+    # TTA view 는 모두 같은 shape / layout 이므로 batch_size 크기의 input 하나로 warm-up 합니다.
+    example_inputs = torch.zeros(args.batch_size, 3, *args.resize, device=device).contiguous(memory_format=memory_format)
+    model = compile_model(model, args.execution, example_inputs, amp)
+
+    img_root = os.path.join(data_dir, 'images')
+    info_path = os.path.join(data_dir, 'info.csv')
     save_path = os.path.join(output_dir, f'output.csv')
-    info.to_csv(save_path, index=False)
+
+    start = count_written_rows(save_path)
+    write_header = start is None
+    start = start or 0
+    if start:
+        print(f"Resuming from row {start} of {info_path}")
+
+    dataset = StreamingTestDataset(info_path, img_root, args.resize, start=start, block_size=args.batch_size)
+    loader = create_dataloader(
+        dataset,
+        args.batch_size,
+        multiprocessing.cpu_count() // 2,
+        drop_last=False,
+    )
+    # DataLoader 의 batch 와 같은 행들을 main process 에서도 batch_size 씩 읽어서 ans 만 채워 씁니다.
+    info_chunks = pd.read_csv(info_path, chunksize=args.batch_size, skiprows=range(1, start + 1))
+
+    print("Calculating inference results..")
+    written = start
+    with open(save_path, 'a', newline='') as f:
+        for idx, ((images, rows), info) in enumerate(zip(DeviceLoader(loader, device, memory_format), info_chunks)):
+            assert rows[0].item() == written, f"batch starts at row {rows[0].item()}, expected {written}"
+            info['ans'] = predict(model, images, amp, memory_format).cpu().numpy()
+            info.to_csv(f, header=write_header, index=False)
+            write_header = False
+            written += len(info)
+
+            if (idx + 1) % args.flush_interval == 0:
+                f.flush()
+                os.fsync(f.fileno())
+                print(f"[{written} rows] flushed to {save_path}")
     print(f"Inference Done! Inference result saved at {save_path}")
 
 
@@ -91,6 +180,16 @@ if __name__ == '__main__':
                         default=[128, 96], help='resize size for image when training')
     parser.add_argument('--model', type=str, default='BaseModel',
                         help='model type (default: BaseModel)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read info.csv in chunks and append predictions to the output as they are made, resuming an interrupted run')
+    parser.add_argument('--flush_interval', type=int, default=10,
+                        help='flush the streamed output every N batches (default: 10)')
+    parser.add_argument('--amp', type=str, default='off', choices=AMP_MODES,
+                        help='mixed precision: off, bf16 (CPU / Ampere+ GPU) or fp16 (CUDA) (default: off)')
+    parser.add_argument('--execution', type=str, default='eager', choices=EXECUTION_MODES,
+                        help='eager, compile (torch.compile) or torchscript (frozen, optimize_for_inference) (default: eager)')
+    parser.add_argument('--memory_format', type=str, default='contiguous', choices=list(MEMORY_FORMATS),
+                        help='model / input layout: contiguous (NCHW) or channels_last (default: contiguous)')
 
     # Container environment
     parser.add_argument('--data_dir', type=str,
@@ -108,4 +207,7 @@ if __name__ == '__main__':
 
     os.makedirs(output_dir, exist_ok=True)
 
-    inference(data_dir, model_dir, output_dir, args)
+    if args.stream:
+        stream_inference(data_dir, model_dir, output_dir, args)
+    else:
+        inference(data_dir, model_dir, output_dir, args)
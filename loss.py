@@ -13,7 +13,8 @@ class FocalLoss(nn.Module):
         self.reduction = reduction
 
     def forward(self, input_tensor, target_tensor):
-        log_prob = F.log_softmax(input_tensor, dim=-1)
+        # bf16 / fp16 (autocast) 출력이 들어와도 log_softmax, (1 - prob) ** gamma 는 fp32 로 계산합니다.
+        log_prob = F.log_softmax(input_tensor.float(), dim=-1)
         prob = torch.exp(log_prob)
         return F.nll_loss(
             ((1 - prob) ** self.gamma) * log_prob,
@@ -32,7 +33,7 @@ class LabelSmoothingLoss(nn.Module):
         self.dim = dim
 
     def forward(self, pred, target):
-        pred = pred.log_softmax(dim=self.dim)
+        pred = pred.float().log_softmax(dim=self.dim)
         with torch.no_grad():
             true_dist = torch.zeros_like(pred)
             true_dist.fill_(self.smoothing / (self.cls - 1))
@@ -51,7 +52,8 @@ class F1Loss(nn.Module):
         assert y_pred.ndim == 2
         assert y_true.ndim == 1
         y_true = F.one_hot(y_true, self.classes).to(torch.float32)
-        y_pred = F.softmax(y_pred, dim=1)
+        # fp16 에서는 epsilon (1e-7) 이 subnormal 이라 0 나누기가 될 수 있으므로 softmax 부터 fp32 로 계산합니다.
+        y_pred = F.softmax(y_pred.float(), dim=1)
 
         tp = (y_true * y_pred).sum(dim=0).to(torch.float32)
         tn = ((1 - y_true) * (1 - y_pred)).sum(dim=0).to(torch.float32)
@@ -66,7 +68,7 @@ class F1Loss(nn.Module):
         return 1 - f1.mean()
 
 
-class F1Loss_classes_18(nn.Module):  # classes 
+class F1Loss_classes_18(nn.Module):  # classes 수정
     def __init__(self, classes=18, epsilon=1e-7):
         super().__init__()
         self.classes = classes
@@ -76,7 +78,8 @@ class F1Loss_classes_18(nn.Module):  # classes 
         assert y_pred.ndim == 2
         assert y_true.ndim == 1
         y_true = F.one_hot(y_true, self.classes).to(torch.float32)
-        y_pred = F.softmax(y_pred, dim=1)
+        # fp16 에서는 epsilon (1e-7) 이 subnormal 이라 0 나누기가 될 수 있으므로 softmax 부터 fp32 로 계산합니다.
+        y_pred = F.softmax(y_pred.float(), dim=1)
 
         tp = (y_true * y_pred).sum(dim=0).to(torch.float32)
         tn = ((1 - y_true) * (1 - y_pred)).sum(dim=0).to(torch.float32)
@@ -0,0 +1,43 @@
+import argparse
+import multiprocessing
+import os
+from importlib import import_module
+
+from dataset import pack_dataset
+
+
+def pack(data_dir, pack_dir, args):
+    # -- dataset
+    dataset_module = getattr(import_module("dataset"), args.dataset)  # default: MaskBaseDataset
+    dataset = dataset_module(
+        data_dir=data_dir,
+    )
+
+    # -- augmentation 의 crop 을 resize 전에 미리 적용
+    transform_module = getattr(import_module("dataset"), args.augmentation)  # default: BaseAugmentation
+    crop = getattr(transform_module, "crop", None)
+
+    print(f"Packing {len(dataset)} images into {pack_dir} (crop: {crop}, resize: {args.resize})")
+    pack_dataset(dataset, pack_dir, args.resize, crop=crop, num_workers=args.num_workers)
+    print(f"Pack Done! use --packed_dir {pack_dir} when training")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--dataset', type=str, default='MaskBaseDataset', help='dataset augmentation type (default: MaskBaseDataset)')
+    parser.add_argument('--augmentation', type=str, default='BaseAugmentation', help='data augmentation type which will be used for training (default: BaseAugmentation)')
+    parser.add_argument("--resize", nargs="+", type=int, default=[128, 96], help='resize size for image when training')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count() // 2, help='number of decode processes')
+
+    # Container environment
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images_gen'))
+    parser.add_argument('--pack_dir', type=str, default=None, help='output directory (default: {data_dir}_packed_{H}x{W})')
+
+    args = parser.parse_args()
+    print(args)
+
+    data_dir = args.data_dir
+    pack_dir = args.pack_dir or f"{data_dir.rstrip('/')}_packed_{'x'.join(map(str, args.resize))}"
+
+    pack(data_dir, pack_dir, args)
@@ -0,0 +1,57 @@
+"""
+--amp 옵션 (off / bf16 / fp16) 에 따라 autocast 와 loss scaling 을 고르는 helper.
+
+    bf16 : CPU (AVX512-BF16 / AMX 가 있는 Xeon) 와 Ampere 이후 GPU, 지수 범위가 fp32 와 같아서 loss scaling 이 필요 없음
+    fp16 : CUDA 전용, 작은 gradient 가 0 으로 underflow 되지 않도록 GradScaler 로 loss 를 키워서 backward
+
+parameter / optimizer state / checkpoint 는 항상 fp32 이고 autocast 안의 forward 연산만 낮은 precision 으로 합니다.
+loss 는 autocast 밖에서 fp32 로 바꾼 출력으로 계산합니다.
+
+    amp = resolve_amp(args.amp, device)
+    with autocast(device, amp):
+        outs = model(inputs)
+    loss = criterion(outs.float(), labels)
+"""
+import torch
+
+AMP_MODES = ('off', 'bf16', 'fp16')
+AMP_DTYPES = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def resolve_amp(amp, device):
+    """device 에서 쓸 수 없는 모드는 경고하고 바꿉니다. (CPU 의 fp16 -> off, bf16 을 지원하지 않는 GPU 의 bf16 -> fp16)"""
+    device = torch.device(device)
+    if amp not in AMP_MODES:
+        raise RuntimeError('Unknown amp mode (%s)' % amp)
+    if amp == 'fp16' and device.type != 'cuda':
+        print("[Warning] fp16 autocast needs CUDA, running in fp32 (use --amp bf16 on CPU)")
+        return 'off'
+    if amp == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print("[Warning] this GPU does not support bf16, using fp16 with loss scaling instead")
+        return 'fp16'
+    return amp
+
+
+def autocast(device, amp, cache_enabled=True):
+    """cache_enabled=False 는 torch.jit.trace 용 (cast 된 weight cache 가 graph 상수로 들어가지 않도록)"""
+    device = torch.device(device)
+    return torch.autocast(device.type, dtype=AMP_DTYPES.get(amp), enabled=amp != 'off', cache_enabled=cache_enabled)
+
+
+def grad_scaler(amp):
+    """fp16 일 때만 loss scaling, 그 외에는 scale / step / update 가 그대로 통과하는 (enabled=False) scaler"""
+    return torch.amp.GradScaler('cuda', enabled=amp == 'fp16')
+
+
+def fp32_state_dict(model):
+    """
+    checkpoint 용 state_dict, 혹시 낮은 precision 으로 바뀐 tensor 가 있어도 fp32 로 저장합니다.
+    --memory_format channels_last 로 학습했어도 checkpoint 는 layout 과 관계없이 contiguous 로 저장합니다.
+    """
+    return {
+        key: (value.float() if value.is_floating_point() else value).contiguous()
+        for key, value in model.state_dict().items()
+    }
@@ -1,503 +1,202 @@
+"""
+배경제거(rembg)한 데이터셋용 dataset.
+
+이미지 로드/label 저장 방식은 dataset.py 와 같고, 다음만 다릅니다.
+    - 배경제거한 RGB 사본 대신 rembg_gen.py 가 만든 alpha mask 만 mask_dir 에 저장되어 있고,
+      원본 이미지를 읽을 때 RGB * alpha 로 배경을 검은색으로 합성합니다.
+      mask 는 원본 파일 내용의 md5 이름으로 저장되기 때문에 train / eval 이미지가 같은 mask_dir 을 써도 됩니다.
+      이미지 경로 -> md5 는 rembg_gen.py 가 mask_dir/index.json 에 저장해두므로 학습 중에는 hash 를 계산하지 않습니다.
+    - 나이 기준 (age_thresholds) 이 30 / 57 입니다.
+    - CustomAugmentation 구성이 다릅니다.
+"""
+import json
 import os
-import random
-from collections import defaultdict
-from enum import Enum
-from typing import Tuple, List
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import torch
 from PIL import Image
-from torch.utils.data import Dataset, Subset, random_split
 from torchvision.transforms import *
 
-IMG_EXTENSIONS = [
-    ".jpg", ".JPG", ".jpeg", ".JPEG", ".png",
-    ".PNG", ".ppm", ".PPM", ".bmp", ".BMP",
-]
-
-def getDataloader(dataset, train_idx, valid_idx, batch_size, num_workers):
-    # 인자로 전달받은 dataset에서 train_idx에 해당하는 Subset 추출
-    train_set = torch.utils.data.Subset(dataset,
-                                        indices=train_idx)
-    # 인자로 전달받은 dataset에서 valid_idx에 해당하는 Subset 추출
-    val_set   = torch.utils.data.Subset(dataset,
-                                        indices=valid_idx)
-    
-    # 추출된 Train Subset으로 DataLoader 생성
-    train_loader = torch.utils.data.DataLoader(
-        train_set,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        drop_last=True,
-        shuffle=True
-    )
-    # 추출된 Valid Subset으로 DataLoader 생성
-    val_loader = torch.utils.data.DataLoader(
-        val_set,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        drop_last=True,
-        shuffle=False
-    )
-    
-    # 생성한 DataLoader 반환
-    return train_loader, val_loader
+import dataset
+from decoder import PILDecoder
+from dataset import IMG_EXTENSIONS, is_image_file, draft_size_of, BaseAugmentation, AddGaussianNoise, MaskLabels, GenderLabels, AgeLabels
 
+REMBG_MASK_DIR = '/opt/ml/input/data/rembg_masks'
 
-def is_image_file(filename):
-    return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
 
+def mask_path(mask_dir, digest):
+    # 한 폴더에 파일이 너무 많아지지 않도록 hash 앞 2글자로 나눕니다. e.g. rembg_masks/3f/3f0c...png
+    return os.path.join(mask_dir, digest[:2], f"{digest}.png")
 
-class BaseAugmentation:
-    def __init__(self, resize, mean, std, **args):
-        self.transform = Compose([
-            Resize(resize, Image.BILINEAR),
-            ToTensor(),
-            Normalize(mean=mean, std=std),
-        ])
 
-    def __call__(self, image):
-        return self.transform(image)
+def mask_index_path(mask_dir):
+    return os.path.join(mask_dir, "index.json")
 
 
-class AddGaussianNoise(object):
-    """
-        transform 에 없는 기능들은 이런식으로 __init__, __call__, __repr__ 부분을
-        직접 구현하여 사용할 수 있습니다.
-    """
+def file_stat(image_path):
+    """index.json 에 같이 저장해서 원본 파일이 바뀌었는지 확인하는 [mtime_ns, size], 없는 파일은 None"""
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
 
-    def __init__(self, mean=0., std=1.):
-        self.std = std
-        self.mean = mean
 
-    def __call__(self, tensor):
-        return tensor + torch.randn(tensor.size()) * self.std + self.mean
+def load_mask_index(mask_dir):
+    """rembg_gen.py 가 저장한 {이미지 절대 경로: [mtime_ns, size, md5]}"""
+    try:
+        with open(mask_index_path(mask_dir), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    def __repr__(self):
-        return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
+
+def save_mask_index(mask_dir, index):
+    path = mask_index_path(mask_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+class MaskedImageReader:
+    """
+    원본 이미지와 rembg_gen.py 로 만든 alpha mask 를 읽어서 배경을 검은색으로 합성합니다.
+    dataset 의 image_reader 로 쓰이며 DataLoader worker / process pool 로 pickle 됩니다.
+    load_masks 로 dataset 을 만들 때 한 번 이미지 경로 -> mask 경로 table 을 만들어두고 sample 마다 찾기만 합니다.
+    """
+    def __init__(self, mask_dir=REMBG_MASK_DIR, decoder=None):
+        self.mask_dir = mask_dir
+        self.decoder = decoder or PILDecoder()
+        self.mask_paths = {}
+
+    def load_masks(self, image_paths, num_workers=16):
+        """
+        mask_dir/index.json 에서 image_paths 의 mask 를 찾습니다.
+        index 에 없거나 rembg_gen.py 를 돌린 뒤에 파일이 바뀐 (mtime / size 가 다른) 이미지가 있으면 FileNotFoundError.
+        """
+        index = load_mask_index(self.mask_dir)
+        image_paths = list(dict.fromkeys(str(path) for path in image_paths))
+        with ThreadPoolExecutor(num_workers) as pool:
+            stats = list(pool.map(file_stat, [os.path.abspath(path) for path in image_paths]))
+
+        mask_paths, missing = {}, []
+        for image_path, stat in zip(image_paths, stats):
+            entry = index.get(os.path.abspath(image_path))
+            if entry is None or stat is None or entry[:2] != stat:
+                missing.append(image_path)
+            else:
+                mask_paths[image_path] = mask_path(self.mask_dir, entry[2])
+        if missing:
+            raise FileNotFoundError(
+                f"{len(missing)} images have no rembg mask in {self.mask_dir} or changed after it was made, "
+                f"run rembg_gen.py --data_dir {os.path.dirname(os.path.dirname(missing[0]))} (e.g. {missing[0]})")
+        self.mask_paths = mask_paths
+
+    def __call__(self, image_path, draft_size=None):
+        with open(image_path, "rb") as f:
+            data = f.read()
+        return self.decode(data, draft_size, image_path)
+
+    def decode(self, data, draft_size=None, image_path=None):
+        # dataset.ByteCache 처럼 이미 읽어둔 파일 내용에서 바로 합성할 때도 image_path 로 mask 를 찾습니다
+        path = self.mask_paths.get(image_path)
+        if path is None:
+            raise FileNotFoundError(f"No rembg mask for {image_path}, call load_masks with the dataset image paths first")
+
+        image = self.decoder.decode(data, draft_size)
+        mask = Image.open(path)
+        if mask.size != image.size:  # draft 로 축소 decode 된 경우
+            mask = mask.resize(image.size, Image.BILINEAR)
+        return Image.composite(image, Image.new("RGB", image.size), mask)
 
 
 class CustomAugmentation:
-    def __init__(self, resize, mean, std, **args):
-        self.transform = Compose([
-            Resize(resize, Image.BILINEAR),
+    crop = None
+
+    def __init__(self, resize, mean, std, pre_resized=False, **args):
+        self.draft_size = draft_size_of(resize)
+        self.prefix = Compose([] if pre_resized else [Resize(resize, Image.BILINEAR)])
+        self.suffix = Compose([
             ToTensor(),
             Normalize(mean=mean, std=std),
             CenterCrop((64, 48)),
             ColorJitter(0.1, 0.1, 0.1, 0.1),
             AddGaussianNoise()
         ])
+        self.transform = Compose([self.prefix, self.suffix])
 
     def __call__(self, image):
         return self.transform(image)
     
 class CustomAugmentation2:
-    def __init__(self, resize, mean, std, **args):
-        self.transform = Compose([
-            CenterCrop((320, 256)),
+    crop = (320, 256)
+
+    def __init__(self, resize, mean, std, pre_resized=False, **args):
+        self.draft_size = None  # CenterCrop 이 먼저 오므로 full resolution
+        geometric = [] if pre_resized else [
+            CenterCrop(self.crop),
             Resize(resize, Image.BILINEAR),
+        ]
+        self.prefix = Compose(geometric)
+        self.suffix = Compose([
             ColorJitter(0.1, 0.1, 0.1, 0.1),
             RandomHorizontalFlip(p=0.5),
             ToTensor(),
             Normalize(mean=mean, std=std),
             AddGaussianNoise()
         ])
+        self.transform = Compose([self.prefix, self.suffix])
 
     def __call__(self, image):
         return self.transform(image)
 
 
-class MaskLabels(int, Enum):
-    MASK = 0
-    INCORRECT = 1
-    NORMAL = 2
-
-
-class GenderLabels(int, Enum):
-    MALE = 0
-    FEMALE = 1
-
-    @classmethod
-    def from_str(cls, value: str) -> int:
-        value = value.lower()
-        if value == "male":
-            return cls.MALE
-        elif value == "female":
-            return cls.FEMALE
-        else:
-            raise ValueError(f"Gender value should be either 'male' or 'female', {value}")
-
-
-class AgeLabels(int, Enum):
-    YOUNG = 0
-    MIDDLE = 1
-    OLD = 2
-
-    @classmethod
-    def from_number(cls, value: str) -> int:
-        try:
-            value = int(value)
-        except Exception:
-            raise ValueError(f"Age value should be numeric, {value}")
-
-        if value < 30:
-            return cls.YOUNG
-        elif value < 57:
-            return cls.MIDDLE
-        else:
-            return cls.OLD
-
-
-class MaskBaseDataset(Dataset):
-    num_classes = 3 * 2 * 3
-
-    _file_names = {
-        "mask1": MaskLabels.MASK,
-        "mask2": MaskLabels.MASK,
-        "mask3": MaskLabels.MASK,
-        "mask4": MaskLabels.MASK,
-        "mask5": MaskLabels.MASK,
-        "incorrect_mask": MaskLabels.INCORRECT,
-        "incorrect_mask2": MaskLabels.INCORRECT,
-        "incorrect_mask3": MaskLabels.INCORRECT,
-        "incorrect_mask4": MaskLabels.INCORRECT,
-        "incorrect_mask5": MaskLabels.INCORRECT,
-        "normal": MaskLabels.NORMAL,
-        "normal2": MaskLabels.NORMAL,
-        "normal3": MaskLabels.NORMAL,
-        "normal4": MaskLabels.NORMAL,
-        "normal5": MaskLabels.NORMAL,
-    }
-
-    image_paths = []
-    mask_labels = []
-    gender_labels = []
-    age_labels = []
-
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
-        self.data_dir = data_dir
-        self.mean = mean
-        self.std = std
-        self.val_ratio = val_ratio
-
-        self.transform = None
-        self.setup()
-        self.calc_statistics()
+# dataset.AGE_THRESHOLDS (29, 57) 대신 30 살부터 MIDDLE 로 봅니다
+AGE_THRESHOLDS = (30, 57)
+
 
+class MaskedDatasetMixin:
+    """setup 이 끝나면 image_paths 의 mask table 을 만들고, ByteCache 로 읽을 때도 경로로 mask 를 찾게 합니다."""
     def setup(self):
-        profiles = os.listdir(self.data_dir)
-        for profile in profiles:
-            if profile.startswith("."):  # "." 로 시작하는 파일은 무시합니다
-                continue
-
-            img_folder = os.path.join(self.data_dir, profile)
-            for file_name in os.listdir(img_folder):
-                _file_name, ext = os.path.splitext(file_name)
-                if _file_name not in self._file_names:  # "." 로 시작하는 파일 및 invalid 한 파일들은 무시합니다
-                    continue
-
-                img_path = os.path.join(self.data_dir, profile, file_name)  # (resized_data, 000004_male_Asian_54, mask1.jpg)
-                mask_label = self._file_names[_file_name]
-
-                id, gender, race, age = profile.split("_")
-                gender_label = GenderLabels.from_str(gender)
-                age_label = AgeLabels.from_number(age)
-
-                self.image_paths.append(img_path)
-                self.mask_labels.append(mask_label)
-                self.gender_labels.append(gender_label)
-                self.age_labels.append(age_label)
-
-    def calc_statistics(self):
-        has_statistics = self.mean is not None and self.std is not None
-        if not has_statistics:
-            print("[Warning] Calculating statistics... It can take a long time depending on your CPU machine")
-            sums = []
-            squared = []
-            for image_path in self.image_paths[:3000]:
-                image = np.array(Image.open(image_path).convert('RGB')).astype(np.int32)
-                sums.append(image.mean(axis=(0, 1)))
-                squared.append((image ** 2).mean(axis=(0, 1)))
-
-            self.mean = np.mean(sums, axis=0) / 255
-            self.std = (np.mean(squared, axis=0) - self.mean ** 2) ** 0.5 / 255
-
-    def set_transform(self, transform):
-        self.transform = transform
-
-    def __getitem__(self, index):
-        assert self.transform is not None, ".set_tranform 메소드를 이용하여 transform 을 주입해주세요"
-
-        image = self.read_image(index)
-        mask_label = self.get_mask_label(index)
-        gender_label = self.get_gender_label(index)
-        age_label = self.get_age_label(index)
-        multi_class_label = self.encode_multi_class(mask_label, gender_label, age_label)
-
-        image_transform = self.transform(image)
-        return image_transform, multi_class_label
-
-    def __len__(self):
-        return len(self.image_paths)
-
-    def get_mask_label(self, index) -> MaskLabels:
-        return self.mask_labels[index]
-
-    def get_gender_label(self, index) -> GenderLabels:
-        return self.gender_labels[index]
-
-    def get_age_label(self, index) -> AgeLabels:
-        return self.age_labels[index]
+        super().setup()
+        self.image_reader.load_masks(self.image_paths)
 
     def read_image(self, index):
-        image_path = self.image_paths[index]
-        return Image.open(image_path).convert('RGB')
-
-    @staticmethod
-    def encode_multi_class(mask_label, gender_label, age_label) -> int:
-        return mask_label * 6 + gender_label * 3 + age_label
-
-    @staticmethod
-    def decode_multi_class(multi_class_label) -> Tuple[MaskLabels, GenderLabels, AgeLabels]:
-        mask_label = (multi_class_label // 6) % 3
-        gender_label = (multi_class_label // 3) % 2
-        age_label = multi_class_label % 3
-        return mask_label, gender_label, age_label
-
-    @staticmethod
-    def denormalize_image(image, mean, std):
-        img_cp = image.copy()
-        img_cp *= std
-        img_cp += mean
-        img_cp *= 255.0
-        img_cp = np.clip(img_cp, 0, 255).astype(np.uint8)
-        return img_cp
-
-    def split_dataset(self) -> Tuple[Subset, Subset]:
-        """
-        데이터셋을 train 과 val 로 나눕니다,
-        pytorch 내부의 torch.utils.data.random_split 함수를 사용하여
-        torch.utils.data.Subset 클래스 둘로 나눕니다.
-        구현이 어렵지 않으니 구글링 혹은 IDE (e.g. pycharm) 의 navigation 기능을 통해 코드를 한 번 읽어보는 것을 추천드립니다^^
-        """
-        n_val = int(len(self) * self.val_ratio)
-        n_train = len(self) - n_val
-        train_set, val_set = random_split(self, [n_train, n_val])
-        return train_set, val_set
-
-
-class MaskMultiLabelDataset(Dataset):
-    num_classes = 3 + 2 + 3
-
-    _file_names = {
-        "mask1": MaskLabels.MASK,
-        "mask2": MaskLabels.MASK,
-        "mask3": MaskLabels.MASK,
-        "mask4": MaskLabels.MASK,
-        "mask5": MaskLabels.MASK,
-        "incorrect_mask": MaskLabels.INCORRECT,
-        "incorrect_mask2": MaskLabels.INCORRECT,
-        "incorrect_mask3": MaskLabels.INCORRECT,
-        "incorrect_mask4": MaskLabels.INCORRECT,
-        "incorrect_mask5": MaskLabels.INCORRECT,
-        "normal": MaskLabels.NORMAL,
-        "normal2": MaskLabels.NORMAL,
-        "normal3": MaskLabels.NORMAL,
-        "normal4": MaskLabels.NORMAL,
-        "normal5": MaskLabels.NORMAL,
-    }
-
-    image_paths = []
-    mask_labels = []
-    gender_labels = []
-    age_labels = []
-
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
-        self.data_dir = data_dir
-        self.mean = mean
-        self.std = std
-        self.val_ratio = val_ratio
-
-        self.transform = None
-        self.setup()
-        self.calc_statistics()
+        if self.packed is None and self.byte_cache is not None:
+            return self.image_reader.decode(self.byte_cache.load(index), self.draft_size, self.image_paths[index])
+        return super().read_image(index)
 
-    def setup(self):
-        profiles = os.listdir(self.data_dir)
-        for profile in profiles:
-            if profile.startswith("."):  # "." 로 시작하는 파일은 무시합니다
-                continue
-
-            img_folder = os.path.join(self.data_dir, profile)
-            for file_name in os.listdir(img_folder):
-                _file_name, ext = os.path.splitext(file_name)
-                if _file_name not in self._file_names:  # "." 로 시작하는 파일 및 invalid 한 파일들은 무시합니다
-                    continue
-
-                img_path = os.path.join(self.data_dir, profile, file_name)  # (resized_data, 000004_male_Asian_54, mask1.jpg)
-                mask_label = self._file_names[_file_name]
-
-                id, gender, race, age = profile.split("_")
-                gender_label = GenderLabels.from_str(gender)
-                age_label = AgeLabels.from_number(age)
-
-                self.image_paths.append(img_path)
-                self.mask_labels.append(mask_label)
-                self.gender_labels.append(gender_label)
-                self.age_labels.append(age_label)
-
-    def calc_statistics(self):
-        has_statistics = self.mean is not None and self.std is not None
-        if not has_statistics:
-            print("[Warning] Calculating statistics... It can take a long time depending on your CPU machine")
-            sums = []
-            squared = []
-            for image_path in self.image_paths[:3000]:
-                image = np.array(Image.open(image_path).convert('RGB')).astype(np.int32)
-                sums.append(image.mean(axis=(0, 1)))
-                squared.append((image ** 2).mean(axis=(0, 1)))
-
-            self.mean = np.mean(sums, axis=0) / 255
-            self.std = (np.mean(squared, axis=0) - self.mean ** 2) ** 0.5 / 255
-
-    def set_transform(self, transform):
-        self.transform = transform
-
-    def __getitem__(self, index):
-        assert self.transform is not None, ".set_tranform 메소드를 이용하여 transform 을 주입해주세요"
-
-        image = self.read_image(index)
-        mask_label = self.get_mask_label(index)
-        gender_label = self.get_gender_label(index)
-        age_label = self.get_age_label(index)
-#         multi_class_label = self.encode_multi_class(mask_label, gender_label, age_label)
-
-        image_transform = self.transform(image)
-        return image_transform, (mask_label, gender_label, age_label)
-
-    def __len__(self):
-        return len(self.image_paths)
-
-    def get_mask_label(self, index) -> MaskLabels:
-        return self.mask_labels[index]
-
-    def get_gender_label(self, index) -> GenderLabels:
-        return self.gender_labels[index]
-
-    def get_age_label(self, index) -> AgeLabels:
-        return self.age_labels[index]
 
-    def read_image(self, index):
-        image_path = self.image_paths[index]
-        return Image.open(image_path).convert('RGB')
-
-    @staticmethod
-    def encode_multi_class(mask_label, gender_label, age_label) -> int:
-        return mask_label * 6 + gender_label * 3 + age_label
-
-    @staticmethod
-    def decode_multi_class(multi_class_label) -> Tuple[MaskLabels, GenderLabels, AgeLabels]:
-        mask_label = (multi_class_label // 6) % 3
-        gender_label = (multi_class_label // 3) % 2
-        age_label = multi_class_label % 3
-        return mask_label, gender_label, age_label
-
-    @staticmethod
-    def denormalize_image(image, mean, std):
-        img_cp = image.copy()
-        img_cp *= std
-        img_cp += mean
-        img_cp *= 255.0
-        img_cp = np.clip(img_cp, 0, 255).astype(np.uint8)
-        return img_cp
-
-    def split_dataset(self) -> Tuple[Subset, Subset]:
-        """
-        데이터셋을 train 과 val 로 나눕니다,
-        pytorch 내부의 torch.utils.data.random_split 함수를 사용하여
-        torch.utils.data.Subset 클래스 둘로 나눕니다.
-        구현이 어렵지 않으니 구글링 혹은 IDE (e.g. pycharm) 의 navigation 기능을 통해 코드를 한 번 읽어보는 것을 추천드립니다^^
-        """
-        n_val = int(len(self) * self.val_ratio)
-        n_train = len(self) - n_val
-        train_set, val_set = random_split(self, [n_train, n_val])
-        return train_set, val_set
-    
-    
+class MaskBaseDataset(MaskedDatasetMixin, dataset.MaskBaseDataset):
+    age_thresholds = AGE_THRESHOLDS
+    _statistics_variant = "rembg"
 
-class MaskSplitByProfileDataset(MaskBaseDataset):
-    """
-        train / val 나누는 기준을 이미지에 대해서 random 이 아닌
-        사람(profile)을 기준으로 나눕니다.
-        구현은 val_ratio 에 맞게 train / val 나누는 것을 이미지 전체가 아닌 사람(profile)에 대해서 진행하여 indexing 을 합니다
-        이후 `split_dataset` 에서 index 에 맞게 Subset 으로 dataset 을 분기합니다.
-    """
+    def __init__(self, data_dir, mask_dir=REMBG_MASK_DIR, **kwargs):
+        self.image_reader = MaskedImageReader(mask_dir)
+        super().__init__(data_dir, **kwargs)
 
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
-        self.indices = defaultdict(list)
-        super().__init__(data_dir, mean, std, val_ratio)
 
-    @staticmethod
-    def _split_profile(profiles, val_ratio):
-        length = len(profiles)
-        n_val = int(length * val_ratio)
+class MaskMultiLabelDataset(MaskedDatasetMixin, dataset.MaskMultiLabelDataset):
+    age_thresholds = AGE_THRESHOLDS
+    _statistics_variant = "rembg"
 
-        val_indices = set(random.sample(range(length), k=n_val))
-        train_indices = set(range(length)) - val_indices
-        return {
-            "train": train_indices,
-            "val": val_indices
-        }
+    def __init__(self, data_dir, mask_dir=REMBG_MASK_DIR, **kwargs):
+        self.image_reader = MaskedImageReader(mask_dir)
+        super().__init__(data_dir, **kwargs)
 
-    def setup(self):
-        profiles = os.listdir(self.data_dir)
-        profiles = [profile for profile in profiles if not profile.startswith(".")]
-        split_profiles = self._split_profile(profiles, self.val_ratio)
-
-        cnt = 0
-        for phase, indices in split_profiles.items():
-            for _idx in indices:
-                profile = profiles[_idx]
-                img_folder = os.path.join(self.data_dir, profile)
-                for file_name in os.listdir(img_folder):
-                    _file_name, ext = os.path.splitext(file_name)
-                    if _file_name not in self._file_names:  # "." 로 시작하는 파일 및 invalid 한 파일들은 무시합니다
-                        continue
-
-                    img_path = os.path.join(self.data_dir, profile, file_name)  # (resized_data, 000004_male_Asian_54, mask1.jpg)
-                    mask_label = self._file_names[_file_name]
-
-                    id, gender, race, age = profile.split("_")
-                    gender_label = GenderLabels.from_str(gender)
-                    age_label = AgeLabels.from_number(age)
-
-                    self.image_paths.append(img_path)
-                    self.mask_labels.append(mask_label)
-                    self.gender_labels.append(gender_label)
-                    self.age_labels.append(age_label)
-
-                    self.indices[phase].append(cnt)
-                    cnt += 1
-
-    def split_dataset(self) -> List[Subset]:
-        return [Subset(self, indices) for phase, indices in self.indices.items()]
-
-
-class TestDataset(Dataset):
-    def __init__(self, img_paths, resize, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246)):
-        self.img_paths = img_paths
-        self.transform = Compose([
-            Resize(resize, Image.BILINEAR),
-            ToTensor(),
-            Normalize(mean=mean, std=std),
-        ])
 
-    def __getitem__(self, index):
-        image = Image.open(self.img_paths[index]).convert('RGB')
+class MaskSplitByProfileDataset(MaskedDatasetMixin, dataset.MaskSplitByProfileDataset):
+    age_thresholds = AGE_THRESHOLDS
+    _statistics_variant = "rembg"
+
+    def __init__(self, data_dir, mask_dir=REMBG_MASK_DIR, **kwargs):
+        self.image_reader = MaskedImageReader(mask_dir)
+        super().__init__(data_dir, **kwargs)
 
-        if self.transform:
-            image = self.transform(image)
-        return image
 
-    def __len__(self):
-        return len(self.img_paths)
+class TestDataset(dataset.TestDataset):
+    def __init__(self, img_paths, resize, mask_dir=REMBG_MASK_DIR, **kwargs):
+        self.image_reader = MaskedImageReader(mask_dir)
+        self.image_reader.load_masks(img_paths)
+        super().__init__(img_paths, resize, **kwargs)
@@ -0,0 +1,190 @@
+"""
+rembg_dataset 이 읽을 alpha mask 를 mask_dir 에 만듭니다.
+
+mask 는 원본 파일 내용의 md5 이름으로 저장하고, 이미지 절대 경로 -> [mtime_ns, size, md5] 를
+mask_dir/index.json 에 모아둡니다. dataset 은 이 index 로 mask 를 찾으므로 파일 내용 hash 는 여기서만 계산하고,
+다시 실행하면 index 의 mtime / size 가 그대로인 이미지는 읽지 않고 건너뜁니다.
+"""
+import argparse
+import hashlib
+import io
+import multiprocessing
+import os
+
+from PIL import Image, ImageDraw
+
+from dataset import is_image_file
+from rembg_dataset import REMBG_MASK_DIR, file_stat, load_mask_index, mask_path, save_mask_index
+
+
+def content_hash(data):
+    return hashlib.md5(data).hexdigest()
+
+
+class RembgBackend:
+    """
+    rembg 의 segmentation model, session 을 worker 마다 한 번만 만들어서 재사용합니다.
+    rembg 에는 batch 추론 API 가 없으므로 넘겨받은 이미지들을 하나씩 segment 합니다.
+    """
+    def __init__(self, model_name="u2net"):
+        from rembg import new_session, remove
+        self.session = new_session(model_name)
+        self._remove = remove
+
+    def __call__(self, images):
+        return [self._remove(image, session=self.session, only_mask=True) for image in images]
+
+
+class StubBackend:
+    """model 없이 가운데 타원을 사람으로 보는 backend, 테스트 / 벤치마크용"""
+    def __init__(self, ratio=0.8):
+        self.ratio = ratio
+
+    def __call__(self, images):
+        masks = []
+        for image in images:
+            width, height = image.size
+            dx, dy = width * (1 - self.ratio) / 2, height * (1 - self.ratio) / 2
+            mask = Image.new("L", image.size)
+            ImageDraw.Draw(mask).ellipse((dx, dy, width - dx, height - dy), fill=255)
+            masks.append(mask)
+        return masks
+
+
+_backend_entrypoints = {
+    'rembg': RembgBackend,
+    'stub': StubBackend,
+}
+
+
+def backend_entrypoint(backend_name):
+    return _backend_entrypoints[backend_name]
+
+
+def is_backend(backend_name):
+    return backend_name in _backend_entrypoints
+
+
+def register_backend(backend_name, create_fn):
+    # create_fn(**kwargs) 는 PIL 이미지 list 를 받아 같은 크기의 "L" mask list 를 돌려주는 callable 을 만들어야 합니다.
+    _backend_entrypoints[backend_name] = create_fn
+
+
+def create_backend(backend_name, **kwargs):
+    if is_backend(backend_name):
+        create_fn = backend_entrypoint(backend_name)
+        backend = create_fn(**kwargs)
+    else:
+        raise RuntimeError('Unknown backend (%s)' % backend_name)
+    return backend
+
+
+def list_images(data_dir):
+    # train (profile 폴더) / eval (images 폴더 하나) 구조 모두 지원합니다.
+    image_paths = []
+    for root, dirs, files in os.walk(data_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        image_paths.extend(
+            os.path.join(root, f) for f in sorted(files) if not f.startswith(".") and is_image_file(f))
+    return image_paths
+
+
+_backend = None
+_mask_dir = None
+
+
+def _init_worker(backend_name, mask_dir):
+    global _backend, _mask_dir
+    _backend = create_backend(backend_name)
+    _mask_dir = mask_dir
+
+
+def segment_chunk(image_paths):
+    """
+    worker 한 번에 넘기는 image_paths 중 mask 가 아직 없는 내용만 backend 에 넘기고 alpha mask 를 PNG 로 저장합니다.
+
+    Returns:
+        (새로 segment 한 수, {이미지 절대 경로: [mtime_ns, size, md5]})
+    """
+    todo = {}
+    entries = {}
+    for image_path in image_paths:
+        stat = file_stat(image_path)
+        with open(image_path, "rb") as f:
+            data = f.read()
+        digest = content_hash(data)
+        entries[os.path.abspath(image_path)] = stat + [digest]
+        if digest not in todo and not os.path.exists(mask_path(_mask_dir, digest)):
+            todo[digest] = data
+    if not todo:
+        return 0, entries
+
+    images = [Image.open(io.BytesIO(data)).convert("RGB") for data in todo.values()]
+    for digest, mask in zip(todo, _backend(images)):
+        path = mask_path(_mask_dir, digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        mask.convert("L").save(tmp_path, "PNG")
+        os.replace(tmp_path, path)
+    return len(todo), entries
+
+
+def segment_images(image_paths, mask_dir, backend_name, chunk_size=32, num_workers=None):
+    """
+    image_paths 의 mask 를 만들고 mask_dir/index.json 을 갱신합니다.
+    index 에 있고 mtime / size 가 그대로인 이미지는 파일을 읽지 않고 건너뜁니다.
+    num_workers=0 이면 process pool 없이 현재 process 에서 실행합니다.
+
+    Returns:
+        int: 새로 segment 한 이미지 수
+    """
+    index = load_mask_index(mask_dir)
+    todo = [path for path in image_paths if index.get(os.path.abspath(path), [None, None])[:2] != file_stat(path)]
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    print(f"Segmenting {len(todo)} new or changed images of {len(image_paths)} into {mask_dir} (backend: {backend_name})")
+
+    segmented = 0
+    os.makedirs(mask_dir, exist_ok=True)
+    if num_workers == 0:
+        _init_worker(backend_name, mask_dir)
+        results = map(segment_chunk, chunks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(backend_name, mask_dir))
+        results = pool.imap_unordered(segment_chunk, chunks)
+    try:
+        for idx, (n, entries) in enumerate(results):
+            segmented += n
+            index.update(entries)
+            if (idx + 1) % 100 == 0:
+                print(f"[{idx + 1}/{len(chunks)}] segmented {segmented}")
+                save_mask_index(mask_dir, index)  # 중간에 멈춰도 여기까지는 다시 하지 않도록
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        save_mask_index(mask_dir, index)
+    return segmented
+
+
+def run(data_dir, mask_dir, args):
+    image_paths = list_images(data_dir)
+    segmented = segment_images(image_paths, mask_dir, args.backend, args.chunk_size, args.num_workers)
+    print(f"Rembg Done! segmented {segmented} new images, the others reused masks of the same content")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--backend', type=str, default='rembg', help='segmentation backend (default: rembg)')
+    parser.add_argument('--chunk_size', '--batch_size', type=int, default=32, help='number of images sent to a worker at once, rembg still segments them one by one (default: 32)')
+    parser.add_argument('--num_workers', type=int, default=max(multiprocessing.cpu_count() // 2, 1), help='number of segmentation processes')
+
+    # Container environment
+    parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images'))
+    parser.add_argument('--mask_dir', type=str, default=REMBG_MASK_DIR, help=f'alpha mask store shared by train / eval (default: {REMBG_MASK_DIR})')
+
+    args = parser.parse_args()
+    print(args)
+
+    run(args.data_dir, args.mask_dir, args)
@@ -7,7 +7,8 @@ import pandas as pd
 import torch
 from torch.utils.data import DataLoader
 
-from rembg_dataset import TestDataset, MaskBaseDataset, MaskMultiLabelDataset
+from dataset import create_dataloader
+from rembg_dataset import TestDataset, MaskBaseDataset, MaskMultiLabelDataset, REMBG_MASK_DIR
 from efficientnet_pytorch import EfficientNet 
 import torch
 import torch.nn as nn
@@ -42,13 +43,12 @@ def inference(data_dir, model_dir, output_dir, args):
     info = pd.read_csv(info_path)
 
     img_paths = [os.path.join(img_root, img_id) for img_id in info.ImageID]
-    dataset = TestDataset(img_paths, args.resize)
-    loader = torch.utils.data.DataLoader(
+    dataset = TestDataset(img_paths, args.resize, mask_dir=args.mask_dir)
+    loader = create_dataloader(
         dataset,
-        batch_size=args.batch_size,
-        num_workers=multiprocessing.cpu_count() // 2,
+        args.batch_size,
+        multiprocessing.cpu_count() // 2,
         shuffle=False,
-        pin_memory=use_cuda,
         drop_last=False,
     )
 
@@ -84,6 +84,7 @@ if __name__ == '__main__':
 
     # Container environment
     parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_EVAL', '/opt/ml/input/data/eval'))
+    parser.add_argument('--mask_dir', type=str, default=REMBG_MASK_DIR, help='alpha masks made by rembg_gen.py (default: %(default)s)')
     parser.add_argument('--model_dir', type=str, default=os.environ.get('SM_CHANNEL_MODEL', './model/exp'))
     parser.add_argument('--output_dir', type=str, default=os.environ.get('SM_OUTPUT_DATA_DIR', './output'))
 
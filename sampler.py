@@ -0,0 +1,202 @@
+"""
+class (혹은 나이 구간) 별 index pool 을 한 번만 만들어 두고 epoch 마다 sample 순서를 뽑는 Sampler 들.
+
+pool 은 label 로 argsort 한 index 배열과 class 별 (시작 위치, 개수) 로만 저장되고,
+epoch 순서는 __iter__ 에서 torch 연산 몇 번으로 만들어지므로 학습 loop 에서는 다음 index 를 꺼내기만 합니다.
+
+    train_set, val_set = dataset.split_dataset()
+    labels = subset_labels(train_set, dataset.multi_class_labels())
+    sampler = create_sampler('balanced', labels)
+    DataLoader(train_set, sampler=sampler, ...)
+"""
+import numpy as np
+import torch
+from torch.utils.data import Sampler, Subset
+
+# MaskSplitByProfileDataset 이 undersampling 하려던 나이 (18~29, 48~59)
+UNDERSAMPLE_AGES = list(range(18, 30)) + list(range(48, 60))
+
+
+def subset_labels(dataset, labels):
+    """Subset (split_dataset / random_split 결과) 의 sample 순서에 맞게 전체 label 배열을 잘라줍니다."""
+    labels = np.asarray(labels)
+    if isinstance(dataset, Subset):
+        return subset_labels(dataset.dataset, labels)[np.asarray(dataset.indices)]
+    return labels
+
+
+def age_groups(ages, ages_to_group=UNDERSAMPLE_AGES):
+    """ages_to_group 에 속하는 sample 은 1, 나머지는 0 인 group label"""
+    return np.isin(np.asarray(ages), ages_to_group).astype(np.int64)
+
+
+class ClassPools:
+    """
+    labels 를 class 별로 묶은 index pool.
+    indices[starts[c]:starts[c] + counts[c]] 가 class c 의 sample index 입니다.
+    """
+    def __init__(self, labels, num_classes=None):
+        labels = torch.as_tensor(np.asarray(labels), dtype=torch.int64)
+        if num_classes is None:
+            num_classes = int(labels.max()) + 1 if len(labels) else 0
+        self.num_classes = num_classes
+        self.indices = torch.argsort(labels, stable=True)
+        self.counts = torch.bincount(labels, minlength=self.num_classes)
+        self.starts = torch.cumsum(self.counts, 0) - self.counts
+
+    def __len__(self):
+        return len(self.indices)
+
+    def pool(self, label):
+        start = int(self.starts[label])
+        return self.indices[start:start + int(self.counts[label])]
+
+    def draw(self, classes, generator=None):
+        """classes 의 각 원소마다 해당 class pool 에서 uniform 하게 index 하나를 뽑습니다. (복원 추출)"""
+        offsets = torch.rand(len(classes), generator=generator) * self.counts[classes]
+        return self.indices[self.starts[classes] + offsets.long()]
+
+
+class WeightedClassSampler(Sampler):
+    """
+    class_weights 비율로 class 를 먼저 고르고 그 class pool 에서 sample 을 뽑습니다. (복원 추출)
+
+    Args:
+        labels: sample 별 class (혹은 group) label
+        class_weights: class 별 weight, None 이면 모든 class 동일 (= balanced)
+        num_samples (int): epoch 당 sample 수, None 이면 len(labels)
+    """
+    def __init__(self, labels, class_weights=None, num_samples=None, generator=None):
+        self.pools = ClassPools(labels)
+        if class_weights is None:
+            class_weights = torch.ones(self.pools.num_classes)
+        class_weights = torch.as_tensor(class_weights, dtype=torch.float64)
+        class_weights = class_weights * (self.pools.counts > 0)  # 비어있는 class 는 뽑지 않음
+        self.class_weights = class_weights / class_weights.sum()
+        self.num_samples = num_samples or len(self.pools)
+        self.generator = generator
+
+    def __iter__(self):
+        classes = torch.multinomial(self.class_weights, self.num_samples, replacement=True, generator=self.generator)
+        yield from self.pools.draw(classes, self.generator).tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+
+class BalancedClassSampler(WeightedClassSampler):
+    """모든 class 가 같은 비율로 나오도록 뽑습니다."""
+    def __init__(self, labels, num_samples=None, generator=None):
+        super().__init__(labels, None, num_samples, generator)
+
+
+class UnderSampler(Sampler):
+    """
+    epoch 마다 class 별로 keep_ratios 비율만큼만 비복원 추출하고 전체를 섞습니다.
+    예를 들어 labels=age_groups(ages), keep_ratios={1: 11 / 15} 이면
+    18~29, 48~59 세 sample 을 epoch 마다 다르게 11/15 만 사용합니다.
+
+    Args:
+        keep_ratios (dict): class -> 남길 비율 (0~1), 없는 class 는 전부 사용
+    """
+    def __init__(self, labels, keep_ratios=None, generator=None):
+        self.pools = ClassPools(labels)
+        keep_ratios = keep_ratios or {}
+        self.keep_counts = [
+            int(round(int(count) * keep_ratios.get(label, 1.0))) for label, count in enumerate(self.pools.counts)]
+        self.generator = generator
+
+    def __iter__(self):
+        kept = []
+        for label, keep in enumerate(self.keep_counts):
+            pool = self.pools.pool(label)
+            kept.append(pool[torch.randperm(len(pool), generator=self.generator)[:keep]])
+        kept = torch.cat(kept)
+        yield from kept[torch.randperm(len(kept), generator=self.generator)].tolist()
+
+    def __len__(self):
+        return sum(self.keep_counts)
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    epoch 마다 block (profile 폴더) 순서를 섞어서 이어 붙이고, 연속한 group 개 block 안에서만 sample 을 섞습니다.
+    한 block 의 sample 은 항상 붙어서 나오므로 NFS / HDD 에서 같은 폴더의 파일을 이어서 읽게 되고,
+    batch 안의 섞임은 block 순서에서 옵니다. (batch_size 64, 폴더당 7장이면 batch 마다 약 10명)
+
+    benchmark.py (600 profile, 폴더당 7장, batch_size 64) 에서 1000 번 read 중 폴더가 바뀌는 횟수
+    (dir_switches_per_1k) 는 shuffle=True 가 약 1000, group=1 이 약 143 (= 1000 / 7) 이고,
+    group=2 는 두 폴더를 번갈아 읽게 되어 약 570, group=4 는 약 780 입니다.
+    batch 안의 사람 수 (profiles_per_batch) 는 shuffle=True 의 약 61 에 비해 group=1 이 10 입니다.
+
+    Args:
+        blocks: sample 별 block id (e.g. dataset.profile_idx)
+        group (int): 같이 섞는 연속한 block 수, 1 이면 폴더 하나씩 읽고 클수록 full shuffle 에 가깝습니다
+    """
+    def __init__(self, blocks, group=1, generator=None):
+        self.pools = ClassPools(blocks)
+        self.group = group
+        self.generator = generator
+
+    def __iter__(self):
+        pools = self.pools
+        blocks = torch.randperm(pools.num_classes, generator=self.generator)
+        counts = pools.counts[blocks]
+        # 섞인 block 순서대로 pool 을 이어 붙인 index
+        offsets = torch.arange(len(pools)) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+        order = pools.indices[torch.repeat_interleave(pools.starts[blocks], counts) + offsets]
+        # (섞인 순서에서 block 의 위치 // group) + [0, 1) 난수로 정렬하면 group 안에서만 섞입니다
+        position = torch.repeat_interleave(torch.arange(len(blocks)), counts)
+        keys = torch.div(position, self.group, rounding_mode="floor") + torch.rand(len(order), generator=self.generator)
+        yield from order[torch.argsort(keys)].tolist()
+
+    def __len__(self):
+        return len(self.pools)
+
+
+_sampler_entrypoints = {
+    'weighted': WeightedClassSampler,
+    'balanced': BalancedClassSampler,
+    'undersample': UnderSampler,
+    'block': BlockShuffleSampler,
+}
+
+
+def sampler_entrypoint(sampler_name):
+    return _sampler_entrypoints[sampler_name]
+
+
+def is_sampler(sampler_name):
+    return sampler_name in _sampler_entrypoints
+
+
+def create_sampler(sampler_name, labels, **kwargs):
+    if is_sampler(sampler_name):
+        create_fn = sampler_entrypoint(sampler_name)
+        sampler = create_fn(labels, **kwargs)
+    else:
+        raise RuntimeError('Unknown sampler (%s)' % sampler_name)
+    return sampler
+
+
+def build_train_sampler(sampler_name, train_set, dataset):
+    """
+    train script 의 --sampler 옵션용.
+        none        : 기존처럼 shuffle=True
+        weighted    : 18 class 를 빈도의 제곱근 비율로 (원래 분포와 balanced 의 중간)
+        balanced    : 18 class 를 같은 비율로
+        undersample : 18~29, 48~59 세 sample 을 epoch 마다 11/15 만 사용
+        block       : profile 폴더 단위로 섞어서 폴더별로 이어 읽음 (NFS / HDD 용 shuffle 대체)
+    """
+    if sampler_name == 'none':
+        return None
+    if sampler_name == 'block':
+        return create_sampler(sampler_name, subset_labels(train_set, dataset.profile_idx))
+    if sampler_name == 'undersample':
+        groups = subset_labels(train_set, age_groups(dataset.ages))
+        return create_sampler(sampler_name, groups, keep_ratios={1: 11 / 15})
+
+    labels = subset_labels(train_set, dataset.multi_class_labels())
+    if sampler_name == 'weighted':
+        return create_sampler(sampler_name, labels, class_weights=np.sqrt(np.bincount(labels)))
+    return create_sampler(sampler_name, labels)
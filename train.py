@@ -1,135 +1,19 @@
 import argparse
-import glob
 import json
 import multiprocessing
 import os
-import random
-import re
-from importlib import import_module
-from pathlib import Path
 
-import matplotlib.pyplot as plt
-import numpy as np
 import torch
 import wandb
 from torch.optim.lr_scheduler import StepLR
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from dataset import MaskBaseDataset
+from execution import MEMORY_FORMATS, TRAIN_EXECUTION_MODES
 from loss import create_criterion
-
-# AMP: 빠르게 만들어줌 >> 224가 아닌 더 큰 사이즈의 이미지로 진행 가능
-from torch.cuda.amp import grad_scaler, autocast_mode
-from timm.scheduler.step_lr import StepLRScheduler
-
-class EarlyStopping:
-    def __init__(self, patience=7, verbose=False, delta=0, path='checkpoint.pt'):
-        """
-        Args:
-            patience (int): validation loss가 개선된 후 기다리는 기간
-                            Default: 7
-            verbose (bool): True일 경우 각 validation loss의 개선 사항 메세지 출력
-                            Default: False
-            delta (float): 개선되었다고 인정되는 monitered quantity의 최소 변화
-                            Default: 0
-            path (str): checkpoint저장 경로
-                            Default: 'checkpoint.pt'
-        """
-        self.patience = patience
-        self.verbose = verbose
-        self.counter = 0
-        self.best_score = None
-        self.early_stop = False
-        self.val_loss_min = np.Inf
-        self.delta = delta
-        self.path = path
-
-    def __call__(self, val_loss, model):
-
-        score = -val_loss
-
-        if self.best_score is None:
-            self.best_score = score
-            self.save_checkpoint(val_loss, model)
-        elif score < self.best_score + self.delta:
-            self.counter += 1
-            print(f'EarlyStopping counter: {self.counter} out of {self.patience}')
-            if self.counter >= self.patience:
-                self.early_stop = True
-        else:
-            self.best_score = score
-            self.save_checkpoint(val_loss, model)
-            self.counter = 0
-
-    def save_checkpoint(self, val_loss, model):
-        if self.verbose:
-            print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        torch.save(model.state_dict(), self.path)
-        self.val_loss_min = val_loss
-
-
-def seed_everything(seed):
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)  # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
-    np.random.seed(seed)
-    random.seed(seed)
-
-
-def get_lr(optimizer):
-    for param_group in optimizer.param_groups:
-        return param_group['lr']
-
-
-def grid_image(np_images, gts, preds, n=16, shuffle=False):
-    batch_size = np_images.shape[0]
-    assert n <= batch_size
-
-    choices = random.choices(range(batch_size), k=n) if shuffle else list(range(n))
-    figure = plt.figure(figsize=(12, 18 + 2))  # cautions: hardcoded, 이미지 크기에 따라 figsize 를 조정해야 할 수 있습니다. T.T
-    plt.subplots_adjust(top=0.8)  # cautions: hardcoded, 이미지 크기에 따라 top 를 조정해야 할 수 있습니다. T.T
-    n_grid = int(np.ceil(n ** 0.5))
-    tasks = ["mask", "gender", "age"]
-    for idx, choice in enumerate(choices):
-        gt = gts[choice].item()
-        pred = preds[choice].item()
-        image = np_images[choice]
-        gt_decoded_labels = MaskBaseDataset.decode_multi_class(gt)
-        pred_decoded_labels = MaskBaseDataset.decode_multi_class(pred)
-        title = "\n".join([
-            f"{task} - gt: {gt_label}, pred: {pred_label}"
-            for gt_label, pred_label, task
-            in zip(gt_decoded_labels, pred_decoded_labels, tasks)
-        ])
-
-        plt.subplot(n_grid, n_grid, idx + 1, title=title)
-        plt.xticks([])
-        plt.yticks([])
-        plt.grid(False)
-        plt.imshow(image, cmap=plt.cm.binary)
-
-    return figure
-
-
-def increment_path(path, exist_ok=False):
-    """ Automatically increment path, i.e. runs/exp --> runs/exp0, runs/exp1 etc.
-
-    Args:
-        path (str or pathlib.Path): f"{model_dir}/{args.name}".
-        exist_ok (bool): whether increment path (increment if False).
-    """
-    path = Path(path)
-    if (path.exists() and exist_ok) or (not path.exists()):
-        return str(path)
-    else:
-        dirs = glob.glob(f"{path}*")
-        matches = [re.search(rf"%s(\d+)" % path.stem, d) for d in dirs]
-        i = [int(m.groups()[0]) for m in matches if m]
-        n = max(i) + 1 if i else 2
-        return f"{path}{n}"
+from precision import AMP_MODES
+from sampler import build_train_sampler
+from trainer import (EarlyStopping, SingleLabelTask, Trainer, build_dataset, build_loaders, create_model,
+                     create_optimizer, increment_path, seed_everything)
 
 
 def train(data_dir, model_dir, args):
@@ -142,58 +26,26 @@ def train(data_dir, model_dir, args):
     device = torch.device("cuda" if use_cuda else "cpu")
     print("Training runs through ", device )
 
-    # -- dataset
-    dataset_module = getattr(import_module("dataset"), args.dataset)  # default: MaskBaseDataset
-    dataset = dataset_module(
-        data_dir=data_dir,
-    )
+    # -- dataset & augmentation
+    dataset, transform = build_dataset(data_dir, args)
     num_classes = dataset.num_classes  # 18
 
-    # -- augmentation
-    transform_module = getattr(import_module("dataset"), args.augmentation)  # default: BaseAugmentation
-    transform = transform_module(
-        resize=args.resize,
-        mean=dataset.mean,
-        std=dataset.std,
-    )
-    dataset.set_transform(transform)
-
     # -- data_loader
     train_set, val_set = dataset.split_dataset()
-
-    train_loader = DataLoader(
-        train_set,
-        batch_size=args.batch_size,
-        num_workers=multiprocessing.cpu_count() // 2,
-        shuffle=True,
-        pin_memory=use_cuda,
-        drop_last=True,
-    )
-
-    val_loader = DataLoader(
-        val_set,
-        batch_size=args.valid_batch_size,
-        num_workers=multiprocessing.cpu_count() // 2,
-        shuffle=False,
-        pin_memory=use_cuda,
-        drop_last=True,
-    )
+    train_sampler = build_train_sampler(args.sampler, train_set, dataset)
+    num_workers = multiprocessing.cpu_count() // 2
+    train_loader, val_loader = build_loaders(
+        train_set, val_set, args.batch_size, args.valid_batch_size, num_workers, sampler=train_sampler)
 
     # -- model
-    model_module = getattr(import_module("model"), args.model)  # default: BaseModel
-    model = model_module(
-        num_classes=num_classes
-    ).to(device)
-    model = torch.nn.DataParallel(model)
+    model = create_model(
+        args.model, num_classes, device, data_parallel=True,
+        execution=args.execution, example_shape=(args.batch_size, 3, *args.resize), amp=args.amp,
+        memory_format=args.memory_format)
 
     # -- loss & metric
     criterion = create_criterion(args.criterion)  # default: cross_entropy
-    opt_module = getattr(import_module("torch.optim"), args.optimizer)  # default: SGD
-    optimizer = opt_module(
-        filter(lambda p: p.requires_grad, model.parameters()),
-        lr=args.lr,
-        weight_decay=5e-4
-    )
+    optimizer = create_optimizer(args.optimizer, model, args.lr)
     scheduler = StepLR(optimizer, args.lr_decay_step, gamma=0.5)
 
     # -- logging
@@ -201,120 +53,19 @@ def train(data_dir, model_dir, args):
     with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
         json.dump(vars(args), f, ensure_ascii=False, indent=4)
 
-    best_val_acc = 0
-    best_val_loss = np.inf
-    early_stopping = EarlyStopping(patience=3, verbose=True)
-
-    use_amp = True
-    scaler = grad_scaler.GradScaler(enabled=use_amp)
-
-    for epoch in range(args.epochs):
-        # train loop
-        model.train()
-        loss_value = 0
-        matches = 0
-
-        for idx, train_batch in enumerate(train_loader):
-            inputs, labels = train_batch
-
-            # non_blocking (빨라짐)
-            inputs = inputs.to(device, non_blocking=True)
-            labels = labels.to(device, non_blocking=True)
-
-            optimizer.zero_grad()
-
-            ############## AMP 사용 O ##############################
-            # Runs the forward pass with autocasting.
-            with autocast_mode.autocast(enabled=use_amp):
-                outs = model(inputs)
-                preds = torch.argmax(outs, dim=-1)
-                loss = criterion(outs, labels)
-
-            # Scales Loss.
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-            #######################################################
-            
-            ############## AMP 사용 X ##############################
-            # outs = model(inputs)
-            # preds = torch.argmax(outs, dim=-1)
-            # loss = criterion(outs, labels)
-
-            # loss.backward()
-            # optimizer.step()
-            ########################################################
-
-            loss_value += loss.item()
-            matches += (preds == labels).sum().item()
-            if (idx + 1) % args.log_interval == 0:
-                train_loss = loss_value / args.log_interval
-                train_acc = matches / args.batch_size / args.log_interval
-                current_lr = get_lr(optimizer)
-                print(
-                    f"Epoch[{epoch}/{args.epochs}]({idx + 1}/{len(train_loader)}) || "
-                    f"training loss {train_loss:4.4} || training accuracy {train_acc:4.2%} || lr {current_lr}"
-                )
-                logger.add_scalar("Train/loss", train_loss, epoch * len(train_loader) + idx)
-                logger.add_scalar("Train/accuracy", train_acc, epoch)
-
-                loss_value = 0
-                matches = 0
-        wandb.log({"train_loss" : train_loss}, step = epoch)
-        wandb.log({"train_acc" : train_acc}, step = epoch)
-        scheduler.step()
-
-        # val loop
-        with torch.no_grad():
-            print("Calculating validation results...")
-            model.eval()
-            val_loss_items = []
-            val_acc_items = []
-            figure = None
-            for val_batch in val_loader:
-                inputs, labels = val_batch
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-
-                outs = model(inputs)
-                preds = torch.argmax(outs, dim=-1)
-
-                loss_item = criterion(outs, labels).item()
-                acc_item = (labels == preds).sum().item()
-                val_loss_items.append(loss_item)
-                val_acc_items.append(acc_item)
-
-                if figure is None:
-                    inputs_np = torch.clone(inputs).detach().cpu().permute(0, 2, 3, 1).numpy()
-                    inputs_np = dataset_module.denormalize_image(inputs_np, dataset.mean, dataset.std)
-                    figure = grid_image(
-                        inputs_np, labels, preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
-                    )
-
-            val_loss = np.sum(val_loss_items) / len(val_loader)
-            val_acc = np.sum(val_acc_items) / len(val_set)
-            best_val_loss = min(best_val_loss, val_loss)
-            if val_acc > best_val_acc:
-                print(f"New best model for val accuracy : {val_acc:4.2%}! saving the best model..")
-                torch.save(model.module.state_dict(), f"{save_dir}/best.pth")
-                best_val_acc = val_acc
-            torch.save(model.module.state_dict(), f"{save_dir}/last.pth")
-            print(
-                f"[Val] acc : {val_acc:4.2%}, loss: {val_loss:4.2} || "
-                f"best acc : {best_val_acc:4.2%}, best loss: {best_val_loss:4.2}"
-            )
-            logger.add_scalar("Val/loss", val_loss, epoch)
-            logger.add_scalar("Val/accuracy", val_acc, epoch)
-            logger.add_figure("results", figure, epoch)
-            wandb.log({"valid_loss" : val_loss}, step = epoch)
-            wandb.log({"valid_acc" : val_acc}, step = epoch)
-               
-            print()
-
-        early_stopping (val_loss, model)
-        if early_stopping .early_stop:
-            print("at epoch : ", epoch)
-            break
+    trainer = Trainer(
+        model, SingleLabelTask(criterion), optimizer, scheduler, train_loader, val_loader, device, save_dir,
+        dataset=dataset,
+        # per-sample transform 대신 batch 단위로 적용하는 augmentation (없으면 Identity)
+        batch_transform=getattr(transform, "batch_transform", None),
+        # AMP: 빠르게 만들어줌 >> 224가 아닌 더 큰 사이즈의 이미지로 진행 가능
+        amp=args.amp,
+        memory_format=args.memory_format,
+        log_interval=args.log_interval,
+        early_stopping=EarlyStopping(patience=3, verbose=True, path=os.path.join(save_dir, 'checkpoint.pt')),
+        logger=logger,
+    )
+    trainer.fit(args.epochs)
 
 
 if __name__ == '__main__':
@@ -333,10 +84,20 @@ if __name__ == '__main__':
     parser.add_argument('--optimizer', type=str, default='SGD', help='optimizer type (default: SGD)')
     parser.add_argument('--lr', type=float, default=1e-3, help='learning rate (default: 1e-3)')
     parser.add_argument('--val_ratio', type=float, default=0.2, help='ratio for validaton (default: 0.2)')
+    parser.add_argument('--sampler', type=str, default='none', help='train sampler: none, weighted, balanced, undersample, block (default: none)')
     parser.add_argument('--criterion', type=str, default='cross_entropy', help='criterion type (default: cross_entropy)')
+    parser.add_argument('--amp', type=str, default='fp16', choices=AMP_MODES, help='mixed precision: off, bf16 (CPU / Ampere+ GPU) or fp16 (CUDA, loss scaling) (default: fp16)')
+    parser.add_argument('--execution', type=str, default='eager', choices=TRAIN_EXECUTION_MODES, help='eager or compile (torch.compile with a persistent cache, eager fallback) (default: eager)')
+    parser.add_argument('--memory_format', type=str, default='contiguous', choices=list(MEMORY_FORMATS), help='model / input layout: contiguous (NCHW) or channels_last (default: contiguous)')
     parser.add_argument('--lr_decay_step', type=int, default=20, help='learning rate scheduler deacy step (default: 20)')
     parser.add_argument('--log_interval', type=int, default=20, help='how many batches to wait before logging training status')
     parser.add_argument('--name', default='exp', help='model save at {SM_MODEL_DIR}/{name}')
+    parser.add_argument('--decoder', type=str, default='pil', help='image decoder: pil, cv2, torchvision or auto (benchmark at startup) (default: pil)')
+    parser.add_argument('--packed_dir', type=str, default=None, help='pre-decoded image store made by pack_dataset.py (default: None)')
+    parser.add_argument('--prefix_cache_mb', type=int, default=0, help='cache size per DataLoader worker for the deterministic part of the augmentation, each worker keeps its own RAM copy unless --prefix_cache_dir is set, 0 disables it (default: 0)')
+    parser.add_argument('--prefix_cache_dir', type=str, default=None, help='store the augmentation prefix cache on disk instead of RAM, shared by all workers (default: None)')
+    parser.add_argument('--byte_cache_mb', type=int, default=0, help='shared RAM cache of the encoded image files, filled in the background, 0 disables it (default: 0)')
+    parser.add_argument('--age_thresholds', nargs=2, type=int, default=None, help='ages where MIDDLE and OLD start (default: the dataset default, 29 57)')
 
     # Container environment
     parser.add_argument('--data_dir', type=str, default=os.environ.get('SM_CHANNEL_TRAIN', '/opt/ml/input/data/train/images'))
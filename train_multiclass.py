@@ -1,140 +1,16 @@
 import argparse
-import glob
 import json
-import multiprocessing
 import os
-import random
-import re
-from importlib import import_module
-from pathlib import Path
 
-import matplotlib.pyplot as plt
-import numpy as np
 import torch
 import wandb
 from torch.optim.lr_scheduler import StepLR
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from dataset import MaskBaseDataset
-from loss import create_criterion
-
-
-class EarlyStopping:
-    """주어? patience ??? validation loss? 개선?? ??? ??? 조기 중??"""
-
-    def __init__(self, patience=7, verbose=False, delta=0, path='checkpoint.pt'):
-        """
-        Args:
-            patience (int): validation loss? 개선? ? 기다리는 기간
-                            Default: 7
-            verbose (bool): True? 경우 ? validation loss? 개선 ?? 메세? 출력
-                            Default: False
-            delta (float): 개선???? ???? monitered quantity? 최소 ??
-                            Default: 0
-            path (str): checkpoint???? 경로
-                            Default: 'checkpoint.pt'
-        """
-        self.patience = patience
-        self.verbose = verbose
-        self.counter = 0
-        self.best_score = None
-        self.early_stop = False
-        self.val_loss_min = np.Inf
-        self.delta = delta
-        self.path = path
-
-    def __call__(self, val_loss, model):
-
-        score = -val_loss
-
-        if self.best_score is None:
-            self.best_score = score
-            self.save_checkpoint(val_loss, model)
-        elif score < self.best_score + self.delta:
-            self.counter += 1
-            print(
-                f'EarlyStopping counter: {self.counter} out of {self.patience}')
-            if self.counter >= self.patience:
-                self.early_stop = True
-        else:
-            self.best_score = score
-            self.save_checkpoint(val_loss, model)
-            self.counter = 0
-
-    def save_checkpoint(self, val_loss, model):
-        '''validation loss? 감소?? 모델? ??????.'''
-        if self.verbose:
-            print(
-                f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        torch.save(model.state_dict(), self.path)
-        self.val_loss_min = val_loss
-
-
-def seed_everything(seed):
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)  # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
-    np.random.seed(seed)
-    random.seed(seed)
-
-
-def get_lr(optimizer):
-    for param_group in optimizer.param_groups:
-        return param_group['lr']
-
-
-def grid_image(np_images, gts, preds, n=16, shuffle=False):
-    batch_size = np_images.shape[0]
-    assert n <= batch_size
-
-    choices = random.choices(
-        range(batch_size), k=n) if shuffle else list(range(n))
-    # cautions: hardcoded, ?미?? ?기에 ?? figsize ? 조정?? ? ? ????. T.T
-    figure = plt.figure(figsize=(12, 18 + 2))
-    # cautions: hardcoded, ?미?? ?기에 ?? top ? 조정?? ? ? ????. T.T
-    plt.subplots_adjust(top=0.8)
-    n_grid = int(np.ceil(n ** 0.5))
-    tasks = ["mask", "gender", "age"]
-    for idx, choice in enumerate(choices):
-        gt = gts[choice].item()
-        pred = preds[choice].item()
-        image = np_images[choice]
-        gt_decoded_labels = MaskBaseDataset.decode_multi_class(gt)
-        pred_decoded_labels = MaskBaseDataset.decode_multi_class(pred)
-        title = "\n".join([
-            f"{task} - gt: {gt_label}, pred: {pred_label}"
-            for gt_label, pred_label, task
-            in zip(gt_decoded_labels, pred_decoded_labels, tasks)
-        ])
-
-        plt.subplot(n_grid, n_grid, idx + 1, title=title)
-        plt.xticks([])
-        plt.yticks([])
-        plt.grid(False)
-        plt.imshow(image, cmap=plt.cm.binary)
-
-    return figure
-
-
-def increment_path(path, exist_ok=False):
-    """ Automatically increment path, i.e. runs/exp --> runs/exp0, runs/exp1 etc.
-
-    Args:
-        path (str or pathlib.Path): f"{model_dir}/{args.name}".
-        exist_ok (bool): whether increment path (increment if False).
-    """
-    path = Path(path)
-    if (path.exists() and exist_ok) or (not path.exists()):
-        return str(path)
-    else:
-        dirs = glob.glob(f"{path}*")
-        matches = [re.search(rf"%s(\d+)" % path.stem, d) for d in dirs]
-        i = [int(m.groups()[0]) for m in matches if m]
-        n = max(i) + 1 if i else 2
-        return f"{path}{n}"
+from execution import MEMORY_FORMATS, TRAIN_EXECUTION_MODES
+from precision import AMP_MODES
+from trainer import (EarlyStopping, MultiHeadTask, Trainer, build_dataset, build_loaders, create_head_criteria,
+                     create_model, create_optimizer, increment_path, seed_everything)
 
 
 def train(data_dir, model_dir, args):
@@ -147,62 +23,23 @@ def train(data_dir, model_dir, args):
     device = torch.device("cuda" if use_cuda else "cpu")
     print("Training runs through ", device)
 
-    # -- dataset
-    dataset_module = getattr(import_module("dataset"),
-                             args.dataset)  # default: MaskBaseDataset
-    dataset = dataset_module(
-        data_dir=data_dir,
-    )
-    num_classes = dataset.num_classes  # 18
-
-    # -- augmentation
-    transform_module = getattr(import_module(
-        "dataset"), args.augmentation)  # default: BaseAugmentation
-    transform = transform_module(
-        resize=args.resize,
-        mean=dataset.mean,
-        std=dataset.std,
-    )
-    dataset.set_transform(transform)
+    # -- dataset & augmentation
+    dataset, transform = build_dataset(data_dir, args)
+    num_classes = dataset.num_classes  # 3 + 2 + 3
 
     # -- data_loader
     train_set, val_set = dataset.split_dataset()
-
-    train_loader = DataLoader(
-        train_set,
-        batch_size=args.batch_size,
-        num_workers=4,
-        shuffle=True,
-        pin_memory=use_cuda,
-        drop_last=True,
-    )
-
-    val_loader = DataLoader(
-        val_set,
-        batch_size=args.valid_batch_size,
-        num_workers=4,
-        shuffle=False,
-        pin_memory=use_cuda,
-        drop_last=True,
-    )
+    train_loader, val_loader = build_loaders(train_set, val_set, args.batch_size, args.valid_batch_size, 4)
 
     # -- model
-    model_module = getattr(import_module(
-        "model"), args.model)  # default: BaseModel
-    model = model_module(
-        num_classes=num_classes
-    ).to(device)
-    model = torch.nn.DataParallel(model)
-
-    # -- loss & metric
-    criterion = create_criterion(args.criterion)  # default: cross_entropy
-    opt_module = getattr(import_module("torch.optim"),
-                         args.optimizer)  # default: SGD
-    optimizer = opt_module(
-        filter(lambda p: p.requires_grad, model.parameters()),
-        lr=args.lr,
-        weight_decay=5e-4
-    )
+    model = create_model(
+        args.model, num_classes, device, data_parallel=True,
+        execution=args.execution, example_shape=(args.batch_size, 3, *args.resize), amp=args.amp,
+        memory_format=args.memory_format)
+
+    # -- loss & metric: mask + gender + 1.5 * age
+    task = MultiHeadTask(create_head_criteria(args.criterion))
+    optimizer = create_optimizer(args.optimizer, model, args.lr)
     scheduler = StepLR(optimizer, args.lr_decay_step, gamma=0.5)
 
     # -- logging
@@ -210,184 +47,19 @@ def train(data_dir, model_dir, args):
     with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
         json.dump(vars(args), f, ensure_ascii=False, indent=4)
 
-    best_val_acc = 0
-    best_val_loss = np.inf
-    # early_stopping = EarlyStopping(patience=3, verbose=True)
-    counter = 0
-    patience = args.patience
-
-    for epoch in range(args.epochs):
-        # train loop
-        model.train()
-        loss_value = 0
-        matches = 0
-
-        for idx, train_batch in enumerate(train_loader):
-            inputs, (mask_labels, gender_labels, age_labels) = train_batch
-            inputs = inputs.to(device)
-
-            mask_labels = mask_labels.to(device)
-            gender_labels = gender_labels.to(device)
-            age_labels = age_labels.to(device)
-
-            optimizer.zero_grad()
-
-            outs = model(inputs)
-            (mask_outs, gender_outs, age_outs) = torch.split(
-                outs, [3, 2, 3], dim=1)
-
-            mask_loss = criterion(mask_outs, mask_labels)
-            gender_loss = criterion(gender_outs, gender_labels)
-            age_loss = criterion(age_outs, age_labels)
-
-            mask_preds = torch.argmax(mask_outs, dim=1)
-            gender_preds = torch.argmax(gender_outs, dim=1)
-            age_preds = torch.argmax(age_outs, dim=1)
-
-            loss = mask_loss + gender_loss + 1.5 * age_loss
-
-            loss.backward()
-            optimizer.step()
-
-            preds, labels = dataset.encode_multi_class(
-                mask_labels, gender_labels, age_labels), dataset.encode_multi_class(mask_preds, gender_preds, age_preds)
-
-            loss_value += loss.item()
-            matches += (preds == labels).sum().item()
-            if (idx + 1) % args.log_interval == 0:
-                train_loss = loss_value / args.log_interval
-                train_acc = matches / args.batch_size / args.log_interval
-                current_lr = get_lr(optimizer)
-                print(
-                    f"Epoch[{epoch}/{args.epochs}]({idx + 1}/{len(train_loader)}) || "
-                    f"training loss {train_loss:4.4} || training accuracy {train_acc:4.2%} || lr {current_lr}"
-                )
-                logger.add_scalar("Train/loss", train_loss,
-                                  epoch * len(train_loader) + idx)
-                logger.add_scalar("Train/accuracy", train_acc, epoch)
-
-                loss_value = 0
-                matches = 0
-        wandb.log({"train_loss": train_loss}, step=epoch)
-        wandb.log({"train_acc": train_acc}, step=epoch)
-        scheduler.step()
-
-        # val loop
-        with torch.no_grad():
-            print("Calculating validation results...")
-            model.eval()
-            val_loss_items = []
-            val_acc_items = []
-
-            mask_loss_items = []
-            gender_loss_items = []
-            age_loss_items = []
-
-            mask_val_acc_items = []
-            gender_val_acc_items = []
-            age_val_acc_items = []
-            figure = None
-            for val_batch in val_loader:
-                inputs, (mask_labels, gender_labels, age_labels) = val_batch
-                inputs = inputs.to(device)
-
-                mask_labels = mask_labels.to(device)
-                gender_labels = gender_labels.to(device)
-                age_labels = age_labels.to(device)
-
-                outs = model(inputs)
-                (mask_outs, gender_outs, age_outs) = torch.split(
-                    outs, [3, 2, 3], dim=1)
-
-                mask_preds = torch.argmax(mask_outs, dim=1)
-                gender_preds = torch.argmax(gender_outs, dim=1)
-                age_preds = torch.argmax(age_outs, dim=1)
-
-                mask_loss = criterion(mask_outs, mask_labels).item()
-                gender_loss = criterion(gender_outs, gender_labels).item()
-                age_loss = criterion(age_outs, age_labels).item()
-
-                loss_item = mask_loss + gender_loss + age_loss
-
-                preds, labels = dataset.encode_multi_class(
-                    mask_labels, gender_labels, age_labels), dataset.encode_multi_class(mask_preds, gender_preds, age_preds)
-
-                mask_val_acc = (mask_labels == mask_preds).sum().item()
-                gender_val_acc = (gender_labels == gender_preds).sum().item()
-                age_val_acc = (age_labels == age_preds).sum().item()
-
-                acc_item = (labels == preds).sum().item()
-                val_loss_items.append(loss_item)
-                val_acc_items.append(acc_item)
-
-                mask_val_acc_items.append(mask_val_acc)
-                gender_val_acc_items.append(gender_val_acc)
-                age_val_acc_items.append(age_val_acc)
-
-                mask_loss_items.append(mask_loss)
-                gender_loss_items.append(gender_loss)
-                age_loss_items.append(age_loss)
-
-                if figure is None:
-                    inputs_np = torch.clone(inputs).detach(
-                    ).cpu().permute(0, 2, 3, 1).numpy()
-                    inputs_np = dataset_module.denormalize_image(
-                        inputs_np, dataset.mean, dataset.std)
-                    figure = grid_image(
-                        inputs_np, labels, preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
-                    )
-
-            # mask, genderm age (?? loss,acc 계산)
-
-            mask_val_loss = np.sum(mask_loss_items) / len(val_loader)
-            gender_val_loss = np.sum(gender_loss_items) / len(val_loader)
-            age_val_loss = np.sum(age_loss_items) / len(val_loader)
-
-            mask_val_acc = np.sum(mask_val_acc_items) / len(val_set)
-            gender_val_acc = np.sum(gender_val_acc_items) / len(val_set)
-            age_val_acc = np.sum(age_val_acc_items) / len(val_set)
-
-            # one class loss, acc 계산
-
-            val_loss = np.sum(val_loss_items) / len(val_loader)
-            val_acc = np.sum(val_acc_items) / len(val_set)
-            best_val_loss = min(best_val_loss, val_loss)
-            if val_acc > best_val_acc:
-                print(
-                    f"New best model for val accuracy : {val_acc:4.2%}! saving the best model..")
-                torch.save(model.module.state_dict(), f"{save_dir}/best.pth")
-                best_val_acc = val_acc
-                counter = 0
-            else:
-                counter += 1
-            torch.save(model.module.state_dict(), f"{save_dir}/last.pth")
-            print(
-                f"[Val] acc : {val_acc:4.2%}, loss: {val_loss:4.2} || "
-                f"best acc : {best_val_acc:4.2%}, best loss: {best_val_loss:4.2}"
-            )
-            logger.add_scalar("Val/loss", val_loss, epoch)
-            logger.add_scalar("Val/accuracy", val_acc, epoch)
-            logger.add_figure("results", figure, epoch)
-            wandb.log({"valid_loss": val_loss}, step=epoch)
-            wandb.log({"valid_acc": val_acc}, step=epoch)
-
-            # mask, gender, age (loss & acc)
-            wandb.log({"mask_loss": mask_val_loss}, step=epoch)
-            wandb.log({"mask_acc": mask_val_acc}, step=epoch)
-            wandb.log({"gender_loss": gender_val_loss}, step=epoch)
-            wandb.log({"gender_acc": gender_val_acc}, step=epoch)
-            wandb.log({"age_loss": age_val_loss}, step=epoch)
-            wandb.log({"age_acc": age_val_acc}, step=epoch)
-
-            if(counter >= patience):
-                print("Early Stopping")
-                break
-            print()
-
-        # early_stopping (val_loss, model)
-        # if early_stopping .early_stop:
-        #     print("at epoch : ", epoch)
-        #     break
+    trainer = Trainer(
+        model, task, optimizer, scheduler, train_loader, val_loader, device, save_dir,
+        dataset=dataset,
+        # per-sample transform 대신 batch 단위로 적용하는 augmentation (없으면 Identity)
+        batch_transform=getattr(transform, "batch_transform", None),
+        amp=args.amp,
+        memory_format=args.memory_format,
+        log_interval=args.log_interval,
+        # validation accuracy 가 patience epoch 동안 오르지 않으면 종료
+        early_stopping=EarlyStopping(patience=args.patience, path=None, monitor='valid_acc'),
+        logger=logger,
+    )
+    trainer.fit(args.epochs)
 
 
 if __name__ == '__main__':
@@ -419,6 +91,12 @@ if __name__ == '__main__':
                         help='ratio for validaton (default: 0.2)')
     parser.add_argument('--criterion', type=str, default='cross_entropy',
                         help='criterion type (default: cross_entropy)')
+    parser.add_argument('--amp', type=str, default='off', choices=AMP_MODES,
+                        help='mixed precision: off, bf16 (CPU / Ampere+ GPU) or fp16 (CUDA, loss scaling) (default: off)')
+    parser.add_argument('--execution', type=str, default='eager', choices=TRAIN_EXECUTION_MODES,
+                        help='eager or compile (torch.compile with a persistent cache, eager fallback) (default: eager)')
+    parser.add_argument('--memory_format', type=str, default='contiguous', choices=list(MEMORY_FORMATS),
+                        help='model / input layout: contiguous (NCHW) or channels_last (default: contiguous)')
     parser.add_argument('--lr_decay_step', type=int, default=20,
                         help='learning rate scheduler deacy step (default: 20)')
     parser.add_argument('--log_interval', type=int, default=20,
@@ -427,6 +105,18 @@ if __name__ == '__main__':
                         help='model save at {SM_MODEL_DIR}/{name}')
     parser.add_argument('--patience', type=int, default=5,
                         help='early stop hypermarameter')
+    parser.add_argument('--decoder', type=str, default='pil',
+                        help='image decoder: pil, cv2, torchvision or auto (benchmark at startup) (default: pil)')
+    parser.add_argument('--packed_dir', type=str, default=None,
+                        help='pre-decoded image store made by pack_dataset.py (default: None)')
+    parser.add_argument('--prefix_cache_mb', type=int, default=0,
+                        help='cache size per DataLoader worker for the deterministic part of the augmentation, each worker keeps its own RAM copy unless --prefix_cache_dir is set, 0 disables it (default: 0)')
+    parser.add_argument('--prefix_cache_dir', type=str, default=None,
+                        help='store the augmentation prefix cache on disk instead of RAM, shared by all workers (default: None)')
+    parser.add_argument('--byte_cache_mb', type=int, default=0,
+                        help='shared RAM cache of the encoded image files, filled in the background, 0 disables it (default: 0)')
+    parser.add_argument('--age_thresholds', nargs=2, type=int, default=None,
+                        help='ages where MIDDLE and OLD start (default: the dataset default, 29 57)')
 
     # Container environment
     parser.add_argument('--data_dir', type=str, default=os.environ.get(
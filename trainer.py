@@ -0,0 +1,673 @@
+"""
+train.py / train_multiclass.py / train_cutmix_*.py / skf_train*.py / rembg_train*.py / train_optuna.py 가
+같이 쓰는 학습 engine.
+
+script 마다 다른 부분은 Trainer 에 끼워 넣는 strategy 로만 표현합니다.
+    task           : SingleLabelTask (18 class 하나) / MultiHeadTask (mask, gender, age 3 head)
+    mixer          : CutMix (batch 일부를 다른 sample 의 patch 로 바꾸고 loss 를 섞음), None 이면 사용 안 함
+    early_stopping : EarlyStopping (validation loss 혹은 accuracy 기준)
+    callbacks      : epoch 마다 validation 결과를 받는 hook (e.g. PruneTrial 로 optuna trial report / prune)
+K-fold 는 fold 마다 Trainer 를 새로 만들어서 fit 하는 fit_kfold 로 돌립니다.
+
+    dataset, transform = build_dataset(data_dir, args)
+    train_set, val_set = dataset.split_dataset()
+    train_loader, val_loader = build_loaders(train_set, val_set, args.batch_size, args.valid_batch_size, num_workers)
+    trainer = Trainer(model, SingleLabelTask(criterion), optimizer, scheduler, train_loader, val_loader, device, save_dir)
+    trainer.fit(args.epochs)
+"""
+import glob
+import inspect
+import os
+import random
+import re
+from importlib import import_module
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+import wandb
+from torch.utils.data import Subset
+
+from dataset import MaskBaseDataset, AgeLabels, DeviceLoader, compact_collate, create_dataloader
+from folds import iter_folds
+from execution import MEMORY_FORMATS, compile_model
+from loss import create_criterion, criterion_entrypoint
+from precision import autocast, fp32_state_dict, grad_scaler, resolve_amp
+
+
+class EarlyStopping:
+    def __init__(self, patience=7, verbose=False, delta=0, path='checkpoint.pt', monitor='valid_loss'):
+        """
+        Args:
+            patience (int): validation loss가 개선된 후 기다리는 기간
+                            Default: 7
+            verbose (bool): True일 경우 각 validation loss의 개선 사항 메세지 출력
+                            Default: False
+            delta (float): 개선되었다고 인정되는 monitered quantity의 최소 변화
+                            Default: 0
+            path (str): checkpoint저장 경로, None 이면 저장하지 않음 (best.pth 는 Trainer 가 따로 저장)
+                            Default: 'checkpoint.pt'
+            monitor (str): 'valid_loss' (작을수록 좋음) 혹은 'valid_acc' (클수록 좋음)
+                            Default: 'valid_loss'
+        """
+        self.patience = patience
+        self.verbose = verbose
+        self.counter = 0
+        self.best_score = None
+        self.early_stop = False
+        self.val_loss_min = np.Inf
+        self.delta = delta
+        self.path = path
+        self.monitor = monitor
+
+    def __call__(self, val_loss, model):
+
+        score = -val_loss if self.monitor == 'valid_loss' else val_loss
+
+        if self.best_score is None:
+            self.best_score = score
+            self.save_checkpoint(val_loss, model)
+        elif score < self.best_score + self.delta:
+            self.counter += 1
+            print(f'EarlyStopping counter: {self.counter} out of {self.patience}')
+            if self.counter >= self.patience:
+                self.early_stop = True
+        else:
+            self.best_score = score
+            self.save_checkpoint(val_loss, model)
+            self.counter = 0
+
+    def save_checkpoint(self, val_loss, model):
+        if self.path is None:
+            return
+        if self.verbose:
+            print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
+        torch.save(fp32_state_dict(unwrap_model(model)), self.path)
+        self.val_loss_min = val_loss
+
+
+def seed_everything(seed):
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)  # if use multi-GPU
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def get_lr(optimizer):
+    for param_group in optimizer.param_groups:
+        return param_group['lr']
+
+
+def grid_image(np_images, gts, preds, n=16, shuffle=False):
+    batch_size = np_images.shape[0]
+    assert n <= batch_size
+
+    choices = random.choices(range(batch_size), k=n) if shuffle else list(range(n))
+    figure = plt.figure(figsize=(12, 18 + 2))  # cautions: hardcoded, 이미지 크기에 따라 figsize 를 조정해야 할 수 있습니다. T.T
+    plt.subplots_adjust(top=0.8)  # cautions: hardcoded, 이미지 크기에 따라 top 를 조정해야 할 수 있습니다. T.T
+    n_grid = int(np.ceil(n ** 0.5))
+    tasks = ["mask", "gender", "age"]
+    for idx, choice in enumerate(choices):
+        gt = gts[choice].item()
+        pred = preds[choice].item()
+        image = np_images[choice]
+        gt_decoded_labels = MaskBaseDataset.decode_multi_class(gt)
+        pred_decoded_labels = MaskBaseDataset.decode_multi_class(pred)
+        title = "\n".join([
+            f"{task} - gt: {gt_label}, pred: {pred_label}"
+            for gt_label, pred_label, task
+            in zip(gt_decoded_labels, pred_decoded_labels, tasks)
+        ])
+
+        plt.subplot(n_grid, n_grid, idx + 1, title=title)
+        plt.xticks([])
+        plt.yticks([])
+        plt.grid(False)
+        plt.imshow(image, cmap=plt.cm.binary)
+
+    return figure
+
+
+def increment_path(path, exist_ok=False):
+    """ Automatically increment path, i.e. runs/exp --> runs/exp0, runs/exp1 etc.
+
+    Args:
+        path (str or pathlib.Path): f"{model_dir}/{args.name}".
+        exist_ok (bool): whether increment path (increment if False).
+    """
+    path = Path(path)
+    if (path.exists() and exist_ok) or (not path.exists()):
+        return str(path)
+    else:
+        dirs = glob.glob(f"{path}*")
+        matches = [re.search(rf"%s(\d+)" % path.stem, d) for d in dirs]
+        i = [int(m.groups()[0]) for m in matches if m]
+        n = max(i) + 1 if i else 2
+        return f"{path}{n}"
+
+
+def unwrap_model(model):
+    """DataParallel / torch.compile 로 감싼 model 이면 안쪽 model (checkpoint 는 항상 'module.', '_orig_mod.' prefix 없이 저장)"""
+    model = model.module if isinstance(model, torch.nn.DataParallel) else model
+    return getattr(model, "_orig_mod", model)
+
+
+# -- builders: script 들이 공통으로 쓰는 dataset / loader / model / optimizer 생성
+
+def build_dataset(data_dir, args, module="dataset", **kwargs):
+    """
+    --dataset / --augmentation 으로 dataset 과 transform 을 만듭니다.
+    script 에 --packed_dir, --decoder, --age_thresholds, --prefix_cache_mb, --byte_cache_mb 옵션이 있으면 같이 적용합니다.
+
+    Returns:
+        (dataset, transform)
+    """
+    for key in ("packed_dir", "decoder", "age_thresholds"):
+        if getattr(args, key, None) is not None:
+            kwargs.setdefault(key, getattr(args, key))
+    dataset_module = getattr(import_module(module), args.dataset)  # default: MaskBaseDataset
+    dataset = dataset_module(
+        data_dir=data_dir,
+        **kwargs,
+    )
+
+    transform_module = getattr(import_module("dataset"), args.augmentation)  # default: BaseAugmentation
+    if dataset.packed is not None:
+        dataset.packed.check(args.resize, getattr(transform_module, "crop", None))
+    transform = transform_module(
+        resize=args.resize,
+        mean=dataset.mean,
+        std=dataset.std,
+        pre_resized=dataset.packed is not None,
+    )
+    dataset.set_transform(transform)
+    if getattr(args, "prefix_cache_mb", 0) > 0:
+        dataset.enable_prefix_cache(args.prefix_cache_mb * 2 ** 20, args.prefix_cache_dir)
+    if getattr(args, "byte_cache_mb", 0) > 0 and dataset.packed is None:
+        dataset.enable_byte_cache(args.byte_cache_mb * 2 ** 20)
+    return dataset, transform
+
+
+def build_loaders(train_set, val_set, batch_size, valid_batch_size, num_workers, sampler=None):
+    """
+    compact_collate + pinned memory + persistent worker DataLoader 쌍. (dataset.create_dataloader)
+    train 은 drop_last, validation 은 마지막 batch 까지 전부 사용합니다. (valid_batch_size 보다 작은 val_set 도 평가되도록)
+    """
+    train_loader = create_dataloader(
+        train_set,
+        batch_size,
+        num_workers,
+        shuffle=sampler is None,
+        sampler=sampler,
+        drop_last=True,
+        collate_fn=compact_collate,
+    )
+    val_loader = create_dataloader(
+        val_set,
+        valid_batch_size,
+        num_workers,
+        shuffle=False,
+        drop_last=False,
+        collate_fn=compact_collate,
+    )
+    return train_loader, val_loader
+
+
+def create_model(model_name, num_classes, device, data_parallel=False, execution="eager", example_shape=None, amp="off",
+                 memory_format="contiguous"):
+    """
+    execution 이 'compile' 이면 example_shape (batch_size, 3, H, W) 의 input 으로 forward / backward 를 warm-up 한 뒤
+    DataParallel 로 감쌉니다. (execution.py, compile 되지 않는 model 은 eager 로 학습)
+    memory_format 이 'channels_last' 면 parameter 를 compile 전에 channels_last 로 바꿉니다.
+    """
+    model_module = getattr(import_module("model"), model_name)  # default: BaseModel
+    model = model_module(
+        num_classes=num_classes
+    ).to(device, memory_format=MEMORY_FORMATS[memory_format])
+    if execution != "eager":
+        example_inputs = torch.zeros(example_shape, device=device).contiguous(
+            memory_format=MEMORY_FORMATS[memory_format])  # zeros: 전역 난수 상태 (shuffle 순서) 를 건드리지 않도록
+        model = compile_model(model, execution, example_inputs, resolve_amp(amp, device), train=True)
+    return torch.nn.DataParallel(model) if data_parallel else model
+
+
+def create_optimizer(optimizer_name, model, lr, weight_decay=5e-4):
+    opt_module = getattr(import_module("torch.optim"), optimizer_name)  # default: SGD
+    return opt_module(
+        filter(lambda p: p.requires_grad, model.parameters()),
+        lr=lr,
+        weight_decay=weight_decay
+    )
+
+
+def create_head_criteria(criterion_name, splits=(3, 2, 3)):
+    """head 마다 criterion 을 만듭니다. classes 인자가 있는 loss (f1, label_smoothing) 는 head 의 class 수를 넘겨줍니다."""
+    takes_classes = "classes" in inspect.signature(criterion_entrypoint(criterion_name)).parameters
+    return [
+        create_criterion(criterion_name, classes=classes) if takes_classes else create_criterion(criterion_name)
+        for classes in splits
+    ]
+
+
+# -- task: label 형태에 따른 loss / 18 class 예측
+
+class SingleLabelTask:
+    """18 class 하나를 예측하는 model, label 은 [B] class tensor"""
+    def __init__(self, criterion):
+        self.criterion = criterion
+
+    def encode(self, labels):
+        return labels
+
+    def select(self, labels, index):
+        return labels[index]
+
+    def loss(self, outs, labels):
+        return self.criterion(outs, labels)
+
+    def valid_loss(self, outs, labels):
+        return self.criterion(outs, labels)
+
+    def predict(self, outs):
+        return torch.argmax(outs, dim=-1)
+
+    def correct(self, outs, labels):
+        """sample 별로 18 class 예측이 맞았는지"""
+        return self.predict(outs) == labels
+
+    def head_metrics(self, outs, labels):
+        return {}
+
+
+class MultiHeadTask:
+    """
+    mask (3), gender (2), age (3) logit 을 이어 붙인 출력을 head 별 criterion 으로 학습합니다.
+    label 은 (mask, gender, age) tuple 이고, 예측 / accuracy 는 encode_multi_class 로 합친 18 class 기준입니다.
+
+    Args:
+        criteria: head 별 criterion (create_head_criteria)
+        weights: head 별 loss weight, 기본은 age 에 1.5 배
+    """
+    heads = ("mask", "gender", "age")
+
+    def __init__(self, criteria, weights=(1., 1., 1.5), splits=(3, 2, 3)):
+        self.criteria = criteria
+        self.weights = weights
+        self.splits = list(splits)
+
+    def split(self, outs):
+        return torch.split(outs, self.splits, dim=1)
+
+    def encode(self, labels):
+        return MaskBaseDataset.encode_multi_class(*labels)
+
+    def select(self, labels, index):
+        return tuple(label[index] for label in labels)
+
+    def loss(self, outs, labels):
+        return sum(
+            weight * criterion(out, label)
+            for weight, criterion, out, label in zip(self.weights, self.criteria, self.split(outs), labels)
+        )
+
+    def valid_loss(self, outs, labels):
+        """validation loss 는 기존 script 들과 같이 weight 없이 mask + gender + age loss 를 더합니다."""
+        return sum(criterion(out, label) for criterion, out, label in zip(self.criteria, self.split(outs), labels))
+
+    def predict(self, outs):
+        return self.encode([torch.argmax(out, dim=1) for out in self.split(outs)])
+
+    def correct(self, outs, labels):
+        """세 head 가 모두 맞으면 18 class 도 맞은 것이므로 encode_multi_class 없이 비교합니다."""
+        heads = [torch.argmax(out, dim=1) == label for out, label in zip(self.split(outs), labels)]
+        return heads[0] & heads[1] & heads[2]
+
+    def head_metrics(self, outs, labels):
+        """head 별 (loss, 맞춘 개수)"""
+        return {
+            head: (criterion(out, label), (torch.argmax(out, dim=1) == label).sum())
+            for head, criterion, out, label in zip(self.heads, self.criteria, self.split(outs), labels)
+        }
+
+
+# -- mixer
+
+def rand_bbox(size, cut_size=0):
+    """
+    (B, C, H, W) batch 에서 이미지의 왼쪽 혹은 오른쪽 절반 (y1, x1, y2, x2) 을 고릅니다.
+    cut_size: 가장자리에 남길 여백, 0 이면 5:5 로 나눕니다.
+    """
+    H, W = size[2], size[3]
+    if np.random.randint(2) == 0:
+        x1, x2 = W // 2, W - cut_size
+    else:
+        x1, x2 = cut_size, W // 2
+    return cut_size, x1, H - cut_size, x2
+
+
+def old_age_classes(classes):
+    """18 class 중 60대 이상 (class 2, 5, 8, 11, 14, 17) 인 sample"""
+    return classes % 3 == AgeLabels.OLD
+
+
+class CutMix:
+    """
+    prob 확률로 batch 의 모든 이미지 절반을 다른 sample 의 같은 위치 patch 로 바꾸고 (rand_index, lam) 를 돌려줍니다.
+    loss 는 lam * loss(label) + (1 - lam) * loss(label[rand_index]) 로 섞습니다.
+
+    Args:
+        prob (float): batch 마다 CutMix 를 적용할 확률
+        patch_filter: 18 class 를 받아 patch 를 가져올 sample 을 고르는 함수 (e.g. old_age_classes),
+                      None 이거나 batch 에 해당 sample 이 없으면 batch 전체에서 섞습니다
+    """
+    def __init__(self, prob=0.2, patch_filter=None):
+        self.prob = prob
+        self.patch_filter = patch_filter
+
+    def __call__(self, inputs, classes):
+        if np.random.rand() >= self.prob:
+            return None
+
+        if self.patch_filter is None:
+            rand_index = torch.randperm(inputs.size(0), device=inputs.device)
+        else:
+            # 조건에 맞는 sample 중에서 복원 추출, 하나도 없으면 batch 전체에서 뽑습니다.
+            # (nonzero / len 으로 개수를 확인하면 device 동기화가 생기므로 weight 로만 처리)
+            donors = self.patch_filter(classes).float()
+            weights = donors + (donors.sum() == 0).float()
+            rand_index = torch.multinomial(weights, inputs.size(0), replacement=True)
+
+        y1, x1, y2, x2 = rand_bbox(inputs.size())
+        inputs[:, :, y1:y2, x1:x2] = inputs[rand_index, :, y1:y2, x1:x2]
+        lam = 1 - ((y2 - y1) * (x2 - x1) / (inputs.size(-1) * inputs.size(-2)))
+        return rand_index, lam
+
+
+class MetricAccumulator:
+    """
+    loss 합 / 맞춘 개수 같은 running sum 을 device 위의 float64 tensor 로 모아두고 compute() 에서 한 번에 host 로 가져옵니다.
+    step 마다 .item() 으로 동기화하지 않으므로 device 는 log_interval / epoch 끝까지 다음 batch 를 계속 돌립니다.
+    float64 로 더하므로 .item() 을 Python float 로 더하던 값과 같습니다.
+    """
+    def __init__(self):
+        self.sums = {}
+
+    def add(self, name, value):
+        value = value.detach().to(torch.float64)
+        if name in self.sums:
+            self.sums[name] += value
+        else:
+            self.sums[name] = value.clone()
+
+    def compute(self):
+        """쌓인 합을 {name: float} 로 돌려주고 비웁니다. (device 동기화 한 번)"""
+        names = list(self.sums)
+        values = torch.stack([self.sums[name] for name in names]).tolist() if names else []
+        self.sums = {}
+        return dict(zip(names, values))
+
+
+# -- callbacks
+
+class PruneTrial:
+    """optuna trial 에 epoch 마다 monitor 값을 report 하고, pruner 가 멈추라고 하면 TrialPruned 로 학습을 끝냅니다."""
+    def __init__(self, trial, monitor='valid_loss'):
+        self.trial = trial
+        self.monitor = monitor
+
+    def __call__(self, epoch, metrics):
+        self.trial.report(metrics[self.monitor], epoch)
+        if self.trial.should_prune():
+            import optuna
+            raise optuna.TrialPruned()
+
+
+class Trainer:
+    """
+    모든 train script 가 같이 쓰는 학습 / validation loop.
+
+    step 마다 batch_transform -> (mixer) -> forward -> backward 를 하고, accumulation_steps 마다 optimizer.step 을 합니다.
+    epoch 마다 validation 결과로 best.pth / last.pth 를 저장하고 wandb (init 되어 있으면) 와 tensorboard 에 기록합니다.
+
+    Args:
+        model: 학습할 model (DataParallel 이어도 checkpoint 는 안쪽 model 의 state_dict 로 저장)
+        task: SingleLabelTask / MultiHeadTask
+        dataset: validation figure 를 그릴 때 denormalize 할 dataset, None 이면 figure 생략
+        batch_transform: batch 단위 augmentation (transform.batch_transform), None 이면 Identity
+        mixer: CutMix, None 이면 사용 안 함
+        accumulation_steps (int): 몇 step 의 gradient 를 모아서 optimizer.step 을 할지
+        amp (str): 'off' / 'bf16' / 'fp16' (precision.py), fp16 은 GradScaler 로 loss scaling
+        memory_format (str): 'contiguous' / 'channels_last', model 과 같은 layout 으로 batch 를 넘겨줍니다
+        early_stopping: EarlyStopping, None 이면 epochs 까지 학습
+        logger: tensorboard SummaryWriter, None 이면 기록 생략
+        callbacks: epoch 마다 callback(epoch, metrics) 로 호출
+    """
+    def __init__(self, model, task, optimizer, scheduler, train_loader, val_loader, device, save_dir,
+                 dataset=None, batch_transform=None, mixer=None, accumulation_steps=1, amp='off',
+                 memory_format='contiguous', log_interval=20, early_stopping=None, logger=None, callbacks=()):
+        self.model = model
+        self.task = task
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.train_loader = train_loader
+        self.val_loader = val_loader
+        self.device = torch.device(device)
+        self.save_dir = save_dir
+        self.dataset = dataset
+        self.batch_transform = (batch_transform if batch_transform is not None else torch.nn.Identity()).to(device)
+        self.mixer = mixer
+        self.accumulation_steps = accumulation_steps
+        self.amp = resolve_amp(amp, self.device)
+        self.scaler = grad_scaler(self.amp)
+        self.memory_format = memory_format
+        self.log_interval = log_interval
+        self.early_stopping = early_stopping
+        self.logger = logger
+        self.callbacks = list(callbacks)
+
+        self.best_val_acc = 0
+        self.best_val_loss = np.inf
+        os.makedirs(save_dir, exist_ok=True)
+
+    def autocast(self):
+        return autocast(self.device, self.amp)
+
+    def device_loader(self, loader):
+        # batch 는 device 로 옮기면서 model 과 같은 layout 으로 한 번만 바꾸고, batch_transform / CutMix 는 layout 을 유지합니다
+        return DeviceLoader(loader, self.device, MEMORY_FORMATS[self.memory_format])
+
+    def train_step(self, idx, inputs, labels, classes):
+        mixed = self.mixer(inputs, classes) if self.mixer is not None else None
+        with self.autocast():
+            outs = self.model(inputs)
+        # loss 는 autocast 밖에서 fp32 로 계산합니다. (softmax / log / pow 가 bf16, fp16 에서 부정확)
+        outs = outs.float()
+        if mixed is None:
+            loss = self.task.loss(outs, labels)
+        else:
+            rand_index, lam = mixed
+            loss = self.task.loss(outs, labels) * lam \
+                + self.task.loss(outs, self.task.select(labels, rand_index)) * (1 - lam)
+
+        self.scaler.scale(loss).backward()
+        # -- Gradient Accumulation
+        if (idx + 1) % self.accumulation_steps == 0:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
+        return loss.detach(), outs.detach()
+
+    def train_epoch(self, epoch, epochs):
+        self.model.train()
+        self.batch_transform.train()
+        self.optimizer.zero_grad(set_to_none=True)
+        meter = MetricAccumulator()
+        num_samples = 0
+        num_steps = 0
+        metrics = {}
+        for idx, (inputs, labels) in enumerate(self.device_loader(self.train_loader)):
+            inputs = self.batch_transform(inputs)
+            classes = self.task.encode(labels) if self.mixer is not None else None
+
+            loss, outs = self.train_step(idx, inputs, labels, classes)
+
+            # device 에 더해두기만 하고 log_interval 마다 한 번만 동기화합니다.
+            meter.add("loss", loss)
+            meter.add("matches", self.task.correct(outs, labels).sum())
+            num_samples += len(inputs)
+            num_steps += 1
+            if (idx + 1) % self.log_interval == 0:
+                metrics = self.log_train(epoch, epochs, idx, meter.compute(), num_steps, num_samples)
+                num_samples = 0
+                num_steps = 0
+
+        if not metrics and num_steps > 0:  # log_interval 보다 step 이 적은 epoch
+            metrics = self.log_train(epoch, epochs, idx, meter.compute(), num_steps, num_samples)
+        return metrics
+
+    def log_train(self, epoch, epochs, idx, sums, num_steps, num_samples):
+        train_loss = sums["loss"] / num_steps
+        train_acc = sums["matches"] / num_samples
+        current_lr = get_lr(self.optimizer)
+        print(
+            f"Epoch[{epoch}/{epochs}]({idx + 1}/{len(self.train_loader)}) || "
+            f"training loss {train_loss:4.4} || training accuracy {train_acc:4.2%} || lr {current_lr}"
+        )
+        if self.logger is not None:
+            self.logger.add_scalar("Train/loss", train_loss, epoch * len(self.train_loader) + idx)
+            self.logger.add_scalar("Train/accuracy", train_acc, epoch)
+        return {"train_loss": train_loss, "train_acc": train_acc}
+
+    @torch.no_grad()
+    def validate(self):
+        print("Calculating validation results...")
+        self.model.eval()
+        self.batch_transform.eval()
+        meter = MetricAccumulator()
+        num_batches = 0
+        num_samples = 0
+        first_batch = None
+        for inputs, labels in self.device_loader(self.val_loader):
+            inputs = self.batch_transform(inputs)
+            with self.autocast():
+                outs = self.model(inputs)
+            outs = outs.float()
+
+            meter.add("valid_loss", self.task.valid_loss(outs, labels))
+            meter.add("valid_acc", self.task.correct(outs, labels).sum())
+            for head, (loss, correct) in self.task.head_metrics(outs, labels).items():
+                meter.add(f"{head}_loss", loss)
+                meter.add(f"{head}_acc", correct)
+            num_batches += 1
+            num_samples += len(inputs)
+
+            if first_batch is None and self.logger is not None and self.dataset is not None:
+                first_batch = (inputs, labels, outs)
+
+        if num_batches == 0:
+            return {"valid_loss": np.nan, "valid_acc": 0.}, None
+        # 기존 script 들과 같이 loss 는 batch 평균, accuracy 는 평가한 sample 수로 나눕니다.
+        metrics = {
+            key: value / (num_batches if key.endswith("_loss") else num_samples)
+            for key, value in meter.compute().items()
+        }
+        # figure 는 CPU 로 가져와야 하므로 validation 이 끝난 뒤에 그립니다.
+        figure = self.figure(*first_batch) if first_batch is not None else None
+        return metrics, figure
+
+    def figure(self, inputs, labels, outs):
+        classes, preds = self.task.encode(labels), self.task.predict(outs)
+        inputs_np = torch.clone(inputs).detach().cpu().permute(0, 2, 3, 1).numpy()
+        inputs_np = self.dataset.denormalize_image(inputs_np, self.dataset.mean, self.dataset.std)
+        return grid_image(
+            inputs_np, classes, preds, n=min(16, len(inputs_np)),
+            shuffle=type(self.dataset).__name__ != "MaskSplitByProfileDataset"
+        )
+
+    def save(self, val_acc):
+        model = unwrap_model(self.model)
+        if val_acc > self.best_val_acc:
+            print(f"New best model for val accuracy : {val_acc:4.2%}! saving the best model..")
+            torch.save(fp32_state_dict(model), f"{self.save_dir}/best.pth")
+            self.best_val_acc = val_acc
+        torch.save(fp32_state_dict(model), f"{self.save_dir}/last.pth")
+
+    def fit(self, epochs, step_offset=0):
+        """
+        Args:
+            step_offset (int): wandb step 은 step_offset + epoch, k-fold 에서 fold 가 바뀌어도 step 이 줄어들지 않게 합니다
+
+        Returns:
+            dict: best_val_acc, best_val_loss
+        """
+        for epoch in range(epochs):
+            metrics = self.train_epoch(epoch, epochs)
+            self.scheduler.step()
+
+            val_metrics, figure = self.validate()
+            metrics.update(val_metrics)
+            val_loss, val_acc = metrics["valid_loss"], metrics["valid_acc"]
+            self.best_val_loss = min(self.best_val_loss, val_loss)
+            self.save(val_acc)
+            print(
+                f"[Val] acc : {val_acc:4.2%}, loss: {val_loss:4.2} || "
+                f"best acc : {self.best_val_acc:4.2%}, best loss: {self.best_val_loss:4.2}"
+            )
+            print()
+            if self.logger is not None:
+                self.logger.add_scalar("Val/loss", val_loss, epoch)
+                self.logger.add_scalar("Val/accuracy", val_acc, epoch)
+                if figure is not None:
+                    self.logger.add_figure("results", figure, epoch)
+            if wandb.run is not None:
+                wandb.log(metrics, step=step_offset + epoch)
+
+            for callback in self.callbacks:
+                callback(epoch, metrics)
+
+            if self.early_stopping is not None:
+                self.early_stopping(metrics[self.early_stopping.monitor], self.model)
+                if self.early_stopping.early_stop:
+                    print("Early Stopping at epoch : ", epoch)
+                    break
+        return {"best_val_acc": self.best_val_acc, "best_val_loss": self.best_val_loss}
+
+
+@torch.no_grad()
+def predict_tta(model, loader, device, amp='off', memory_format='contiguous'):
+    """원본 이미지와 horizontal flip 한 이미지의 출력 평균 (Test Time Augmentation), [N, num_outputs] numpy"""
+    model.eval()
+    all_predictions = []
+    for images in DeviceLoader(loader, device, MEMORY_FORMATS[memory_format]):  # flip 은 layout 을 유지
+        with autocast(device, amp):
+            outs = model(images)  # 원본 이미지를 예측하고
+            flipped = model(torch.flip(images, dims=(-1,)))  # horizontal_flip으로 뒤집어 예측합니다.
+        all_predictions.append((outs.float() + flipped.float()) / 2)
+    return torch.cat(all_predictions).cpu().numpy()
+
+
+def fit_kfold(dataset, build_trainer, epochs, batch_size, num_workers, n_splits=5, seed=42, test_loader=None):
+    """
+    profile 단위로 나눈 fold 마다 build_trainer(fold, train_loader, val_loader) 로 Trainer 를 새로 만들어 학습합니다.
+    fold 의 validation 은 기존 skf script 들과 같이 batch_size 로 돌립니다. (valid_batch_size 는 test_loader 용)
+    test_loader 가 있으면 fold 마다 마지막 model 로 TTA 예측을 해서 n_splits 로 나눈 평균 (앙상블) 을 돌려줍니다.
+    """
+    oof_pred = None
+    for fold, (train_idx, valid_idx) in enumerate(iter_folds(dataset, n_splits, seed)):
+        print(f"-- fold {fold} / {n_splits}")
+        train_loader, val_loader = build_loaders(
+            Subset(dataset, train_idx), Subset(dataset, valid_idx), batch_size, batch_size, num_workers)
+        trainer = build_trainer(fold, train_loader, val_loader)
+        trainer.fit(epochs, step_offset=fold * epochs)
+
+        if test_loader is None:
+            continue
+        # 확률 값으로 앙상블을 진행하기 때문에 'k'개로 나누어줍니다.
+        fold_pred = predict_tta(
+            trainer.model, test_loader, trainer.device, trainer.amp, trainer.memory_format) / n_splits
+        oof_pred = fold_pred if oof_pred is None else oof_pred + fold_pred
+    return oof_pred